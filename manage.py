@@ -1,10 +1,24 @@
+import asyncio
 import coverage
+import json
 import unittest
+from datetime import timedelta
 
 from flask_migrate import MigrateCommand
 from flask_script import Manager
 from project import create_app, db
+from project.api.invalidation import (
+    prune_revoked_tokens as run_prune_revoked_tokens,
+)
 from project.api.models import User
+from project.api.outbox import OutboxDispatcher
+from project.api.shards import get_shards
+from project.api.stats import rebuild_stats as run_rebuild_stats
+from project.bench import bench_logging as run_bench_logging
+from project.bench import bench_queries as run_bench_queries
+from project.bench import bench_records as run_bench_records
+from project.bench import bench_servers as run_bench_servers
+from project.loadgen import Target, load_capture, parse_access_log, replay
 
 
 COV = coverage.coverage(
@@ -20,9 +34,17 @@ app = create_app()
 manager = Manager(app)
 manager.add_command("db", MigrateCommand)
 
-@manager.command
-def test():
+@manager.option("-p", "--parallel", dest="parallel", type=int, default=1,
+                help="Number of processes to spread the test modules over")
+@manager.option("-c", "--compare", dest="compare", action="store_true",
+                help="Run the tests in one process first, and report the "
+                     "speedup of the parallel run")
+def test(parallel=1, compare=False):
     """Runs the tests without code coverage"""
+    if parallel > 1:
+        # the test helpers are not needed by the other commands
+        from project.tests.parallel import run_parallel
+        return 0 if run_parallel(parallel, compare) else 1
     loader = unittest.TestLoader()
     tests = loader.discover("project/tests", pattern="test*.py")
     runner = unittest.TextTestRunner(verbosity=2)
@@ -52,6 +74,9 @@ def recreate_db():
     db.drop_all()
     db.create_all()
     db.session.commit()
+    shards = get_shards()
+    if shards:
+        shards.create_schema()
 
 @manager.command
 def seed_db():
@@ -68,6 +93,113 @@ def seed_db():
     ))
     db.session.commit()
 
+@manager.command
+def rebuild_stats():
+    """Recomputes the user stats rollup tables from the users table"""
+    run_rebuild_stats()
+
+@manager.command
+def prune_revoked_tokens():
+    """Deletes the revoked tokens that have expired"""
+    print(f"Deleted {run_prune_revoked_tokens()} expired revoked tokens")
+
+@manager.command
+def rebalance_shards():
+    """Moves users to the shards they belong on after shards were added
+    to USER_SHARDS, and creates the users table on new shards
+    """
+    shards = get_shards()
+    if shards is None:
+        print("USER_SHARDS is not set")
+        return
+    moved, deleted = shards.rebalance(
+        app.config.get("SHARD_REBALANCE_BATCH_SIZE"),
+        app.config.get("SHARD_STRAY_GRACE"),
+    )
+    print(f"Moved {moved} users, deleted {deleted} stray rows")
+
+@manager.option("--once", dest="once", action="store_true",
+                help="Deliver what is pending and exit")
+def dispatch_outbox(once=False):
+    """Delivers outbox events to OUTBOX_SINK"""
+    dispatcher = OutboxDispatcher.from_config(app)
+    if once:
+        while dispatcher.dispatch_batch() == dispatcher.batch_size:
+            pass
+        print(f"Delivered {dispatcher.delivered}, failed {dispatcher.failed}")
+        return
+    dispatcher.run(
+        app.config.get("OUTBOX_POLL_INTERVAL"),
+        timedelta(days=app.config.get("OUTBOX_RETENTION_DAYS")),
+    )
+
+@manager.option("-h", "--host", dest="host", default="127.0.0.1")
+@manager.option("-p", "--port", dest="port", type=int, default=5000)
+def runserver_async(host, port):
+    """Serves the api from an asyncio event loop, see project/aio"""
+    from aiohttp import web
+    from project.aio import create_async_app
+    web.run_app(create_async_app(app), host=host, port=port)
+
+@manager.option("-l", "--log", dest="log", help="gunicorn access log")
+@manager.option("-o", "--out", dest="out", help="capture file to write")
+def record_traffic(log, out):
+    """Converts an access log into a capture file for replay_traffic"""
+    with open(log) as f:
+        records = parse_access_log(app, f)
+    with open(out, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    print(f"Recorded {len(records)} requests to {out}")
+
+@manager.option("-c", "--capture", dest="capture", help="capture file")
+@manager.option("-t", "--target", dest="target",
+                default="http://localhost:5000")
+@manager.option("-r", "--rates", dest="rates", default="50,100,200,400",
+                help="comma separated requests per second to offer")
+@manager.option("-d", "--duration", dest="duration", type=float, default=10,
+                help="seconds to run each rate for")
+@manager.option("-e", "--email", dest="email", help="user to log in as")
+@manager.option("-p", "--password", dest="password")
+def replay_traffic(capture, target, rates, duration, email, password):
+    """Replays a capture file against a running instance"""
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(replay(
+        Target(target, email, password),
+        load_capture(capture),
+        [float(rate) for rate in rates.split(",")],
+        duration,
+    ))
+
+@manager.option("-n", "--count", dest="count", type=int, default=1000000)
+def bench_records(count):
+    """Compares memory per user of User instances and UserRecords"""
+    run_bench_records(count)
+
+@manager.option("-n", "--count", dest="count", type=int, default=10000)
+def bench_logging(count):
+    """Compares request round trips with no, sync and queued access logs"""
+    run_bench_logging(count)
+
+@manager.option("-n", "--count", dest="count", type=int, default=10000)
+def bench_queries(count):
+    """Compares cpu per lookup of built and baked user queries"""
+    run_bench_queries(count)
+
+@manager.option("-t", "--targets", dest="targets",
+                default="http://localhost:5000,http://localhost:5001",
+                help="comma separated instances to compare")
+@manager.option("-e", "--email", dest="email", help="user to log in as")
+@manager.option("-p", "--password", dest="password")
+@manager.option("-c", "--concurrency", dest="concurrency", type=int,
+                default=200)
+@manager.option("-d", "--duration", dest="duration", type=float, default=10)
+def bench_servers(targets, email, password, concurrency, duration):
+    """Compares running sync and async instances at high concurrency"""
+    run_bench_servers(
+        targets.split(","), email, password, concurrency, duration
+    )
+
 
 if __name__ == "__main__":
     manager.run()
@@ -18,6 +18,7 @@ logger = logging.getLogger('alembic.env')
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
 from flask import current_app
+from project import online_migrations
 config.set_main_option('sqlalchemy.url',
                        current_app.config.get('SQLALCHEMY_DATABASE_URI'))
 target_metadata = current_app.extensions['migrate'].db.metadata
@@ -69,15 +70,39 @@ def run_migrations_online():
                                 prefix='sqlalchemy.',
                                 poolclass=pool.NullPool)
 
+    app_config = current_app.config
+    online = context.get_x_argument(as_dictionary=True).get('online')
+    online = app_config.get('ONLINE_MIGRATIONS') if online is None \
+        else online.lower() in ('1', 'true')
+    online_migrations.configure(
+        online=online,
+        lock_timeout=app_config.get('MIGRATION_LOCK_TIMEOUT'),
+        lock_retries=app_config.get('MIGRATION_LOCK_RETRIES'),
+        backfill_batch_size=app_config.get('MIGRATION_BACKFILL_BATCH_SIZE'),
+        backfill_pause=app_config.get('MIGRATION_BACKFILL_PAUSE'),
+    )
+
     connection = engine.connect()
-    context.configure(connection=connection,
+    migration_connection = connection
+    if online and connection.dialect.name == 'postgresql':
+        # every statement commits on its own, steps that need a
+        # transaction open one themselves, see project/online_migrations.py
+        migration_connection = connection.execution_options(
+            isolation_level='AUTOCOMMIT')
+        migration_connection.execute(
+            'SET lock_timeout = %d' % app_config.get('MIGRATION_LOCK_TIMEOUT'))
+        logger.info('Running migrations online.')
+
+    context.configure(connection=migration_connection,
                       target_metadata=target_metadata,
                       process_revision_directives=process_revision_directives,
+                      transaction_per_migration=online,
                       **current_app.extensions['migrate'].configure_args)
 
     try:
         with context.begin_transaction():
             context.run_migrations()
+        online_migrations.report()
     finally:
         connection.close()
 
@@ -0,0 +1,28 @@
+"""add user_invalidation_seq
+
+Revision ID: a41c7e9d2b63
+Revises: 5b9d0e2c7f14
+Create Date: 2026-10-19 20:31:09.118402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a41c7e9d2b63'
+down_revision = '5b9d0e2c7f14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # numbers the messages of the postgres invalidation bus. workers used
+    # to create it when they started listening
+    if op.get_context().dialect.name == 'postgresql':
+        op.execute('CREATE SEQUENCE IF NOT EXISTS user_invalidation_seq')
+
+
+def downgrade():
+    if op.get_context().dialect.name == 'postgresql':
+        op.execute('DROP SEQUENCE IF EXISTS user_invalidation_seq')
@@ -8,6 +8,8 @@ Create Date: 2018-01-01 20:16:59.950013
 from alembic import op
 import sqlalchemy as sa
 
+from project.online_migrations import add_unique_constraint
+
 
 # revision identifiers, used by Alembic.
 revision = 'f06310fe05f2'
@@ -17,14 +19,12 @@ depends_on = None
 
 
 def upgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    op.create_unique_constraint(None, 'users', ['email'])
-    op.create_unique_constraint(None, 'users', ['username'])
-    # ### end Alembic commands ###
+    # named like the constraints postgres created when this used None.
+    # online they are added from indexes built concurrently
+    add_unique_constraint('users_email_key', 'users', ['email'])
+    add_unique_constraint('users_username_key', 'users', ['username'])
 
 
 def downgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    op.drop_constraint(None, 'users', type_='unique')
-    op.drop_constraint(None, 'users', type_='unique')
-    # ### end Alembic commands ###
+    op.drop_constraint('users_email_key', 'users', type_='unique')
+    op.drop_constraint('users_username_key', 'users', type_='unique')
@@ -4,10 +4,21 @@ import os
 import datetime
 from flask import Flask, jsonify
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy as _SQLAlchemy
 from flask_migrate import Migrate
 from flask_bcrypt import Bcrypt
 
+
+class SQLAlchemy(_SQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        if info.drivername.startswith("postgresql"):
+            # pool checkout timeouts per route class, see
+            # project/api/resilience.py
+            from project.api.resilience import RouteTimeoutQueuePool
+            options["poolclass"] = RouteTimeoutQueuePool
+
+
 # instantiate db
 db = SQLAlchemy()
 # instantiate flask migrate
@@ -33,8 +44,21 @@ def create_app():
     
     from project.api.users import users_blueprint
     from project.api.auth import auth_blueprint
+    from project.api.profiling import profiling_blueprint
     
     app.register_blueprint(users_blueprint)
     app.register_blueprint(auth_blueprint)
+    app.register_blueprint(profiling_blueprint)
+
+    from project.api import resilience
+    from project.api.invalidation import init_bus
+    from project.loadgen import init_capture
+    from project.logs import init_access_log
+    from project.profiler import init_profiler
+    resilience.init_app(app)
+    init_access_log(app)
+    init_capture(app)
+    init_profiler(app)
+    init_bus(app)
 
     return app
\ No newline at end of file
@@ -0,0 +1,47 @@
+"""asyncio deployment of the api, on aiohttp
+
+    python manage.py runserver_async
+
+serves the routes of the auth and users blueprints from one event loop,
+see project/aio/views.py. The flask app is still created: it holds the
+config, and its app context is kept pushed on the loop's thread for the
+token, cache and logging code shared with the sync views.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from project import create_app
+from project.aio.db import AsyncDatabase
+from project.aio.views import db_unavailable, routes
+from project.api.invalidation import get_bus
+
+
+async def _startup(app):
+    app["flask_context"] = app["flask_app"].app_context()
+    app["flask_context"].push()
+    await app["db"].connect()
+    # created and synced here rather than by the first request
+    get_bus()
+
+
+async def _cleanup(app):
+    await app["db"].disconnect()
+    app["bcrypt_executor"].shutdown(wait=False)
+    app["flask_context"].pop()
+
+
+def create_async_app(flask_app=None):
+    flask_app = flask_app or create_app()
+    if flask_app.config.get("USER_SHARDS"):
+        raise RuntimeError("The async mode does not support USER_SHARDS")
+    app = web.Application(middlewares=[db_unavailable])
+    app["flask_app"] = flask_app
+    app["db"] = AsyncDatabase.from_config(flask_app.config)
+    app["bcrypt_executor"] = ThreadPoolExecutor(
+        flask_app.config.get("ASYNC_BCRYPT_WORKERS")
+    )
+    app.add_routes(routes)
+    app.on_startup.append(_startup)
+    app.on_cleanup.append(_cleanup)
+    return app
@@ -0,0 +1,313 @@
+"""Async access to the app's db for the asyncio views
+
+Statements are SQLAlchemy core, built from the models' tables, and are
+compiled for the driver once and reused. postgres goes through asyncpg and
+its pool, sqlite through aiosqlite with a small pool of connections.
+
+    async with database.session("read") as session:
+        row = await session.fetch_one(statement, user_id=1)
+
+A session is one connection and one transaction. It is committed when the
+block exits and rolled back if it raises. Checking a connection out, and
+on postgres every statement, are bounded by the timeouts of the route
+class, like the sync views in project/api/resilience.py.
+"""
+import asyncio
+import re
+import sqlite3
+import weakref
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql import Select
+
+from project.api.singleflight import SingleFlightTimeout
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+# answered with 503, like the errors is_db_unavailable() picks out in the
+# sync views
+DB_UNAVAILABLE_ERRORS = (
+    asyncio.TimeoutError, OSError, SingleFlightTimeout,
+) + (
+    (asyncpg.PostgresConnectionError, asyncpg.QueryCanceledError)
+    if asyncpg else ()
+)
+INTEGRITY_ERRORS = (sqlite3.IntegrityError,) + (
+    (asyncpg.IntegrityConstraintViolationError,) if asyncpg else ()
+)
+
+_FORMAT_PARAM = re.compile(r"%(s|%)")
+
+
+class CompiledStatement:
+    """A statement compiled for a dialect, with its type processors"""
+
+    def __init__(self, statement, dialect, numbered=False):
+        compiled = statement.compile(dialect=dialect)
+        self.sql = compiled.string
+        if numbered:
+            # asyncpg wants $1, $2... where the format paramstyle has %s
+            numbers = iter(range(1, len(compiled.positiontup) + 1))
+            self.sql = _FORMAT_PARAM.sub(
+                lambda m: f"${next(numbers)}" if m.group(1) == "s" else "%",
+                self.sql,
+            )
+        self.names = compiled.positiontup
+        self.defaults = {
+            name: compiled.binds[name].effective_value for name in self.names
+        }
+        self.bind_processors = [
+            compiled.binds[name].type.dialect_impl(dialect).bind_processor(
+                dialect
+            )
+            for name in self.names
+        ]
+        columns = statement.inner_columns \
+            if isinstance(statement, Select) else ()
+        self.result_processors = [
+            column.type.dialect_impl(dialect).result_processor(dialect, None)
+            for column in columns
+        ]
+
+    def args(self, params):
+        values = dict(self.defaults, **params) if params else self.defaults
+        return [
+            processor(values[name]) if processor else values[name]
+            for name, processor in zip(self.names, self.bind_processors)
+        ]
+
+    def row(self, row):
+        if not self.result_processors:
+            return tuple(row)
+        return tuple(
+            processor(value) if processor else value
+            for value, processor in zip(row, self.result_processors)
+        )
+
+
+class AsyncSession:
+    """One connection and transaction, see AsyncDatabase.session()"""
+
+    def __init__(self, database, route_class):
+        self.database = database
+        self.route_class = route_class
+        self.timeout = database.statement_timeouts.get(route_class)
+        self.connection = None
+        self._transaction = None
+
+    async def __aenter__(self):
+        self.connection = await self.database.driver.acquire(
+            self.database.checkout_timeouts.get(self.route_class)
+        )
+        try:
+            self._transaction = await self.database.driver.begin(
+                self.connection
+            )
+        except BaseException:
+            await self.database.driver.release(self.connection, broken=True)
+            raise
+        return self
+
+    async def __aexit__(self, error_type, error, traceback):
+        driver = self.database.driver
+        broken = False
+        try:
+            if error_type is None:
+                await driver.commit(self.connection, self._transaction)
+            else:
+                await driver.rollback(self.connection, self._transaction)
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            await driver.release(self.connection, broken=broken)
+            self.connection = None
+
+    def _compiled(self, statement):
+        return self.database.compiled(statement)
+
+    async def fetch_all(self, statement, **params):
+        compiled = self._compiled(statement)
+        rows = await self.database.driver.fetch(
+            self.connection, compiled.sql, compiled.args(params),
+            self.timeout,
+        )
+        return [compiled.row(row) for row in rows]
+
+    async def fetch_one(self, statement, **params):
+        rows = await self.fetch_all(statement, **params)
+        return rows[0] if rows else None
+
+    async def execute(self, statement, **params):
+        """Run an insert, update or delete, returns the rowcount"""
+        compiled = self._compiled(statement)
+        return await self.database.driver.execute(
+            self.connection, compiled.sql, compiled.args(params),
+            self.timeout,
+        )
+
+    async def insert(self, statement, **params):
+        """Run an insert, returns the new row's primary key"""
+        table = statement.table
+        key = list(table.primary_key.columns)[0]
+        if self.database.dialect.name == "postgresql":
+            row = await self.fetch_one(statement.returning(key), **params)
+            return row[0]
+        compiled = self._compiled(statement)
+        return await self.database.driver.insert(
+            self.connection, compiled.sql, compiled.args(params),
+            self.timeout,
+        )
+
+
+class SqliteDriver:
+    """aiosqlite connections, handed out from a queue"""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._idle = None
+
+    async def connect(self):
+        import aiosqlite
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            # transactions are begun and ended explicitly
+            connection = await aiosqlite.connect(
+                self.path, isolation_level=None
+            )
+            await connection.execute("PRAGMA busy_timeout = 5000")
+            self._idle.put_nowait(connection)
+
+    async def disconnect(self):
+        while not self._idle.empty():
+            await self._idle.get_nowait().close()
+
+    async def acquire(self, timeout):
+        return await asyncio.wait_for(self._idle.get(), timeout)
+
+    async def release(self, connection, broken=False):
+        self._idle.put_nowait(connection)
+
+    async def begin(self, connection):
+        await connection.execute("BEGIN")
+
+    async def commit(self, connection, transaction):
+        await connection.execute("COMMIT")
+
+    async def rollback(self, connection, transaction):
+        await connection.execute("ROLLBACK")
+
+    async def fetch(self, connection, sql, args, timeout):
+        async with connection.execute(sql, args) as cursor:
+            return await cursor.fetchall()
+
+    async def execute(self, connection, sql, args, timeout):
+        async with connection.execute(sql, args) as cursor:
+            return cursor.rowcount
+
+    async def insert(self, connection, sql, args, timeout):
+        async with connection.execute(sql, args) as cursor:
+            return cursor.lastrowid
+
+
+class PostgresDriver:
+    """An asyncpg pool"""
+
+    def __init__(self, dsn, size):
+        self.dsn = dsn
+        self.size = size
+        self._pool = None
+
+    async def connect(self):
+        self._pool = await asyncpg.create_pool(
+            self.dsn, min_size=1, max_size=self.size
+        )
+
+    async def disconnect(self):
+        await self._pool.close()
+
+    async def acquire(self, timeout):
+        return await self._pool.acquire(timeout=timeout)
+
+    async def release(self, connection, broken=False):
+        if broken:
+            connection.terminate()
+        await self._pool.release(connection)
+
+    async def begin(self, connection):
+        transaction = connection.transaction()
+        await transaction.start()
+        return transaction
+
+    async def commit(self, connection, transaction):
+        await transaction.commit()
+
+    async def rollback(self, connection, transaction):
+        await transaction.rollback()
+
+    async def fetch(self, connection, sql, args, timeout):
+        return await connection.fetch(sql, *args, timeout=timeout)
+
+    async def execute(self, connection, sql, args, timeout):
+        status = await connection.execute(sql, *args, timeout=timeout)
+        # "UPDATE 3", "INSERT 0 1"...
+        return int(status.rsplit(" ", 1)[-1])
+
+
+class AsyncDatabase:
+    """The db of SQLALCHEMY_DATABASE_URI, for asyncio"""
+
+    def __init__(self, uri, pool_size=10, statement_timeouts=None,
+                 checkout_timeouts=None):
+        url = make_url(uri)
+        if url.drivername.startswith("postgresql"):
+            if asyncpg is None:
+                raise RuntimeError("The async mode needs asyncpg")
+            url.drivername = "postgresql"
+            self.dialect = postgresql.dialect(paramstyle="format")
+            self.driver = PostgresDriver(str(url), pool_size)
+            self._numbered = True
+        elif url.drivername.startswith("sqlite") and url.database:
+            self.dialect = sqlite.dialect()
+            self.driver = SqliteDriver(url.database, pool_size)
+            self._numbered = False
+        else:
+            raise ValueError(f"No async driver for {uri}")
+        # statement timeouts are configured in ms, asyncpg takes seconds
+        self.statement_timeouts = {
+            name: ms / 1000 for name, ms in (statement_timeouts or {}).items()
+        }
+        self.checkout_timeouts = checkout_timeouts or {}
+        self._compiled = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get("SQLALCHEMY_DATABASE_URI"),
+            config.get("ASYNC_DB_POOL_SIZE"),
+            config.get("DB_STATEMENT_TIMEOUTS"),
+            config.get("DB_CHECKOUT_TIMEOUTS"),
+        )
+
+    async def connect(self):
+        await self.driver.connect()
+
+    async def disconnect(self):
+        await self.driver.disconnect()
+
+    def session(self, route_class):
+        return AsyncSession(self, route_class)
+
+    def compiled(self, statement):
+        """The statement compiled for this db, cached while it is alive"""
+        compiled = self._compiled.get(statement)
+        if compiled is None:
+            compiled = self._compiled[statement] = CompiledStatement(
+                statement, self.dialect, self._numbered
+            )
+        return compiled
@@ -0,0 +1,617 @@
+"""The routes of auth_blueprint and users_blueprint, on aiohttp
+
+Same urls, payloads and answers as project/api/auth.py and
+project/api/users.py. Tokens, user caches, single-flight loads, the
+invalidation bus, the outbox, the stats rollup and audit records are
+shared with the sync views. The db work goes through project/aio/db.py
+and bcrypt runs in an executor, outside of any db transaction.
+"""
+import asyncio
+import uuid
+from datetime import datetime
+
+from aiohttp import web
+from flask import current_app, json
+from sqlalchemy import and_, bindparam, or_, select
+
+from project import bcrypt
+from project.aio.db import DB_UNAVAILABLE_ERRORS, INTEGRITY_ERRORS
+from project.api.cache import user_cache
+from project.api.invalidation import (
+    NOTIFY, PostgresInvalidationBus, get_bus, notify_params
+)
+from project.api.keys import get_jwks
+from project.api.models import OutboxEvent, RevokedToken, User
+from project.api.outbox import user_registered_event
+from project.api.records import USER_RECORD_COLUMNS, UserRecord, user_loads
+from project.api.stats import format_stats, new_user_increments, stats_queries
+from project.api.users import page_args, stats_range
+from project.logs import audit
+
+routes = web.RouteTableDef()
+
+USER_BY_ID = select(list(USER_RECORD_COLUMNS)).where(
+    User.id == bindparam("user_id")
+)
+CREDENTIALS_BY_EMAIL = select(
+    list(USER_RECORD_COLUMNS) + [User.password]
+).where(User.email == bindparam("email"))
+ALL_USERS = select(list(USER_RECORD_COLUMNS)).order_by(
+    User.created_at.desc(), User.id.desc()
+)
+USERS_PAGE = ALL_USERS.limit(bindparam("limit")).offset(bindparam("offset"))
+USER_EXISTS = select([User.id]).where(or_(
+    User.username == bindparam("username"),
+    User.email == bindparam("email"),
+)).limit(1)
+EMAIL_EXISTS = select([User.id]).where(
+    User.email == bindparam("email")
+).limit(1)
+
+
+def respond(response_object, status=200, headers=None):
+    # flask's encoder, so dates look like they do from jsonify
+    return web.Response(
+        body=json.dumps(response_object).encode(),
+        status=status,
+        content_type="application/json",
+        headers=headers,
+    )
+
+
+async def get_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def auth_token(request):
+    auth_header = request.headers.get("Authorization")
+    return auth_header.split(" ")[1] if auth_header else None
+
+
+def _hash_password(password, rounds):
+    return bcrypt.generate_password_hash(password, rounds).decode()
+
+
+async def hash_password(request, password):
+    return await asyncio.get_event_loop().run_in_executor(
+        request.app["bcrypt_executor"], _hash_password, password,
+        current_app.config.get("BCRYPT_LOG_ROUNDS"),
+    )
+
+
+async def check_password(request, password_hash, password):
+    return await asyncio.get_event_loop().run_in_executor(
+        request.app["bcrypt_executor"], bcrypt.check_password_hash,
+        password_hash, password,
+    )
+
+
+async def load_user(request, user_id, route_class):
+    """UserRecord|None, from the worker's cache when it is there"""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
+    version = user_cache.version
+
+    async def load():
+        async with request.app["db"].session(route_class) as session:
+            row = await session.fetch_one(USER_BY_ID, user_id=user_id)
+        return UserRecord.from_row(row) if row else None
+    user = await user_loads.do_async(
+        ("id", user_id), load, current_app.config.get("SINGLE_FLIGHT_TIMEOUT")
+    )
+    if user is not None:
+        user_cache.set(
+            user_id, user, current_app.config.get("USER_CACHE_TTL"), version
+        )
+    return user
+
+
+async def load_credentials(request, email):
+    """(UserRecord, password hash)|None for logging in"""
+    async def load():
+        async with request.app["db"].session("auth") as session:
+            row = await session.fetch_one(CREDENTIALS_BY_EMAIL, email=email)
+        return (UserRecord.from_row(row[:-1]), row[-1]) if row else None
+    return await user_loads.do_async(
+        ("email", email), load,
+        current_app.config.get("SINGLE_FLIGHT_TIMEOUT"),
+    )
+
+
+async def publish(session, kind, key):
+    """Publish on the invalidation bus in the session's transaction"""
+    bus = get_bus()
+    if isinstance(bus, PostgresInvalidationBus):
+        await session.execute(NOTIFY, **notify_params(kind, key))
+    else:
+        bus.publish(kind, key)
+
+
+async def create_user(request, username, email, password, route_class):
+    """Insert a user with its invalidation, outbox and stats writes, like
+    the sync views do through the orm
+    """
+    # hashed before the transaction so it does not hold a connection
+    password_hash = await hash_password(request, password)
+    created_at = datetime.utcnow()
+    database = request.app["db"]
+    async with database.session(route_class) as session:
+        user_id = await session.insert(User.__table__.insert().values(
+            username=username,
+            email=email,
+            password=password_hash,
+            active=True,
+            admin=False,
+            created_at=created_at,
+        ))
+        user = UserRecord.from_row(
+            (user_id, username, email, True, False, created_at)
+        )
+        await publish(session, "user", user_id)
+        await session.execute(OutboxEvent.__table__.insert().values(
+            attempts=0, **user_registered_event(user)
+        ))
+        for statement, insert in new_user_increments(
+                database.dialect.name, user):
+            if await session.execute(statement) == 0 and insert is not None:
+                await session.execute(insert)
+    return user
+
+
+async def admin_error(request):
+    """The answer to a request without the auth token of an active
+    admin, None if it has one
+    """
+    response_object = {
+        "status": "fail",
+        "message": "Provide a valid auth token."
+    }
+    token = auth_token(request)
+    if not token:
+        return respond(response_object, 401)
+    resp = User.decode_auth_payload(token)
+    if isinstance(resp, str):
+        response_object["message"] = resp
+        return respond(response_object, 401)
+    user = await load_user(request, resp["sub"], "read")
+    if not user or not user.active or not user.admin:
+        response_object["message"] = "You do not have permission to do that."
+        return respond(response_object, 403)
+    return None
+
+
+@web.middleware
+async def db_unavailable(request, handler):
+    try:
+        return await handler(request)
+    except DB_UNAVAILABLE_ERRORS:
+        response_object = {
+            "status": "fail",
+            "message": "Service unavailable. Please try again.",
+        }
+        return respond(response_object, 503, {
+            "Retry-After": str(current_app.config.get("DB_RETRY_AFTER")),
+        })
+
+
+@routes.get("/.well-known/jwks.json")
+async def jwks(request):
+    return respond(get_jwks(), 200, {
+        "Cache-Control": "public, max-age={}".format(
+            current_app.config.get("JWKS_MAX_AGE")
+        ),
+    })
+
+
+@routes.post("/auth/register")
+async def register_user(request):
+    post_data = await get_json(request)
+    response_object = {
+        "status": "fail",
+        "message": "Invalid payload.",
+    }
+    if not post_data:
+        return respond(response_object)
+    username = post_data.get("username")
+    email = post_data.get("email")
+    password = post_data.get("password")
+    try:
+        async with request.app["db"].session("auth") as session:
+            exists = await session.fetch_one(
+                USER_EXISTS, username=username, email=email
+            )
+        if exists:
+            audit(
+                "register", success=False, email=email,
+                remote_addr=request.remote,
+            )
+            response_object["message"] = "Sorry. That user already exists."
+            return respond(response_object, 400)
+        user = await create_user(request, username, email, password, "auth")
+    except INTEGRITY_ERRORS + (ValueError,):
+        return respond(response_object, 400)
+
+    session_id = uuid.uuid4().hex
+    auth_token = user.encode_auth_token(user.id, session_id)
+    refresh_token = user.encode_refresh_token(user.id, session_id)
+    audit(
+        "register", success=True, user_id=user.id, email=email,
+        remote_addr=request.remote,
+    )
+    response_object.update({
+        "status": "success",
+        "message": "Successfully registered.",
+        "auth_token": auth_token.decode(),
+        "refresh_token": refresh_token.decode(),
+    })
+    return respond(response_object, 201)
+
+
+@routes.post("/auth/login")
+async def login_user(request):
+    post_data = await get_json(request)
+    response_object = {
+        "status": "fail",
+        "message": "Invalid payload.",
+    }
+    if not post_data:
+        return respond(response_object, 400)
+    email = post_data.get("email")
+    password = post_data.get("password")
+    try:
+        credentials = await load_credentials(request, email)
+        if credentials and await check_password(
+                request, credentials[1], password):
+            user = credentials[0]
+            session_id = uuid.uuid4().hex
+            auth_token = user.encode_auth_token(user.id, session_id)
+            refresh_token = user.encode_refresh_token(user.id, session_id)
+            audit(
+                "login", success=True, user_id=user.id, email=email,
+                remote_addr=request.remote,
+            )
+            response_object.update({
+                "status": "success",
+                "message": "Successfully logged in.",
+                "auth_token": auth_token.decode(),
+                "refresh_token": refresh_token.decode(),
+            })
+            return respond(response_object, 200)
+        audit(
+            "login", success=False, email=email, remote_addr=request.remote,
+        )
+        response_object["message"] = "User does not exist."
+        return respond(response_object, 404)
+    except DB_UNAVAILABLE_ERRORS:
+        raise
+    except Exception:
+        response_object["message"] = "Try again."
+        return respond(response_object, 500)
+
+
+@routes.get("/auth/logout")
+async def logout(request):
+    token = auth_token(request)
+    response_object = {
+        "status": "fail",
+        "message": "Provide a valid auth token."
+    }
+    if not token:
+        return respond(response_object, 403)
+    resp = User.decode_auth_payload(token)
+    if isinstance(resp, str):
+        response_object["message"] = resp
+        return respond(response_object, 401)
+    revocations = User.logout_revocations(resp)
+    if revocations:
+        async with request.app["db"].session("auth") as session:
+            for jti, exp in revocations:
+                await session.execute(RevokedToken.__table__.insert().values(
+                    jti=jti, expires_at=datetime.utcfromtimestamp(exp),
+                ))
+                await publish(session, "token", [jti, exp])
+    audit(
+        "logout", success=True, user_id=resp["sub"],
+        remote_addr=request.remote,
+    )
+    response_object["status"] = "success"
+    response_object["message"] = "Successfully logged out."
+    return respond(response_object, 200)
+
+
+@routes.post("/auth/refresh")
+async def refresh_auth_token(request):
+    refresh_token = auth_token(request)
+    response_object = {
+        "status": "fail",
+        "message": "Provide a valid refresh token."
+    }
+    if not refresh_token:
+        return respond(response_object, 403)
+    resp = User.decode_auth_payload(refresh_token, token_type="refresh")
+    if isinstance(resp, str):
+        response_object["message"] = resp
+        return respond(response_object, 401)
+    user = await load_user(request, resp["sub"], "auth")
+    if not user or not user.active:
+        response_object["message"] = "User does not exist."
+        return respond(response_object, 401)
+    response_object.update({
+        "status": "success",
+        "message": "Successfully refreshed.",
+        "auth_token": user.encode_auth_token(
+            user.id, resp.get("jti")
+        ).decode(),
+    })
+    return respond(response_object, 200)
+
+
+@routes.get("/auth/status")
+async def get_user_status(request):
+    token = auth_token(request)
+    response_object = {
+        "status": "fail",
+        "message": "Provide a valid auth token."
+    }
+    if not token:
+        return respond(response_object, 401)
+    resp = User.decode_auth_payload(token)
+    if isinstance(resp, str):
+        response_object["message"] = resp
+        return respond(response_object, 401)
+    if current_app.config.get("AUTH_STATUS_FROM_CLAIMS") and \
+            "username" in resp:
+        data = {
+            "id": resp["sub"],
+            "username": resp["username"],
+            "email": resp["email"],
+            "active": resp["active"],
+            "created_at": datetime.utcfromtimestamp(resp["created_at"]),
+        }
+    else:
+        user = await load_user(request, resp["sub"], "auth")
+        if not user:
+            response_object["message"] = "User does not exist."
+            return respond(response_object, 401)
+        data = user.to_dict("id", "username", "email", "active", "created_at")
+    response_object.update({
+        "status": "success",
+        "message": "Success",
+        "data": data,
+    })
+    return respond(response_object, 200)
+
+
+@routes.post("/auth/introspect")
+async def introspect_tokens(request):
+    """Validate a batch of auth tokens"""
+    post_data = await get_json(request)
+    response_object = {
+        "status": "fail",
+        "message": "Invalid payload.",
+    }
+    auth_tokens = post_data.get("tokens") \
+        if isinstance(post_data, dict) else None
+    if (not isinstance(auth_tokens, list) or
+            not all(isinstance(token, str) for token in auth_tokens)):
+        return respond(response_object, 400)
+    max_tokens = current_app.config.get("AUTH_INTROSPECT_MAX_TOKENS")
+    if len(auth_tokens) > max_tokens:
+        response_object["message"] = (
+            f"Too many tokens. The maximum is {max_tokens}."
+        )
+        return respond(response_object, 400)
+
+    payloads = {}
+    for token in auth_tokens:
+        if token not in payloads:
+            payloads[token] = User.decode_auth_payload(token)
+    user_ids = {
+        payload["sub"] for payload in payloads.values()
+        if not isinstance(payload, str)
+    }
+    active_ids = set()
+    if user_ids:
+        async with request.app["db"].session("auth") as session:
+            rows = await session.fetch_all(select([User.id]).where(and_(
+                User.id.in_(user_ids), User.active.is_(True)
+            )))
+        active_ids = {user_id for user_id, in rows}
+
+    results = []
+    for token in auth_tokens:
+        payload = payloads[token]
+        if isinstance(payload, str):
+            results.append({"active": False, "message": payload})
+        elif payload["sub"] not in active_ids:
+            results.append({"active": False, "message": "User is not active."})
+        else:
+            results.append({
+                "active": True,
+                "sub": payload["sub"],
+                "exp": payload["exp"],
+            })
+    del response_object["message"]
+    response_object.update({
+        "status": "success",
+        "data": {
+            "tokens": results,
+        },
+    })
+    return respond(response_object, 200)
+
+
+@routes.get("/ping")
+async def ping_pong(request):
+    return respond({
+        "status": "success",
+        "message": "pong!",
+    })
+
+
+@routes.post("/users")
+async def add_user(request):
+    invalid_response = {
+        "status": "fail",
+        "message": "Invalid payload."
+    }
+    post_data = await get_json(request)
+    if not post_data:
+        return respond(invalid_response, 400)
+    email = post_data.get("email")
+    username = post_data.get("username")
+    password = post_data.get("password")
+    if email is None or username is None:
+        return respond(invalid_response, 400)
+
+    async with request.app["db"].session("write") as session:
+        exists = await session.fetch_one(EMAIL_EXISTS, email=email)
+    if exists:
+        response_object = {
+            "status": "fail",
+            "message": "Sorry. That email already exists."
+        }
+        return respond(response_object, 400)
+    try:
+        await create_user(request, username, email, password, "write")
+    except INTEGRITY_ERRORS + (ValueError,):
+        return respond(invalid_response, 400)
+    response_object = {
+        "status": "success",
+        "message": f"{email} was added!"
+    }
+    return respond(response_object, 201)
+
+
+@routes.get("/users/stats")
+async def get_user_stats(request):
+    """User totals and signups per day, from the rollup tables"""
+    error = await admin_error(request)
+    if error is not None:
+        return error
+    try:
+        start, end = stats_range(request.query)
+    except ValueError as e:
+        return respond({"status": "fail", "message": str(e)}, 400)
+
+    totals, signups = stats_queries(start, end)
+    async with request.app["db"].session("read") as session:
+        totals = await session.fetch_one(totals)
+        signups = await session.fetch_all(signups)
+    response_object = {
+        "status": "success",
+        "data": format_stats(totals, signups, start, end),
+    }
+    return respond(response_object, 200)
+
+
+@routes.get("/users/{user_id}")
+async def get_single_user(request):
+    """Get single user details"""
+    response_object = {
+        "status": "fail",
+        "message": "User does not exist"
+    }
+    try:
+        user_id = int(request.match_info["user_id"])
+    except ValueError:
+        return respond(response_object, 404)
+
+    user = await load_user(request, user_id, "read")
+    if not user:
+        return respond(response_object, 404)
+    del response_object["message"]
+    response_object.update({
+        "status": "success",
+        "data": user.to_dict("username", "email", "created_at"),
+    })
+    return respond(response_object, 200)
+
+
+@routes.get("/users")
+async def get_all_users(request):
+    """Get all users, or the users of a comma separated list of ids"""
+    if "ids" in request.query:
+        return await lookup_users(request, request.query["ids"])
+    try:
+        limit, offset = page_args(request.query)
+    except ValueError as e:
+        return respond({"status": "fail", "message": str(e)}, 400)
+    async with request.app["db"].session("read") as session:
+        if limit is None:
+            rows = await session.fetch_all(ALL_USERS)
+        else:
+            rows = await session.fetch_all(
+                USERS_PAGE, limit=limit, offset=offset
+            )
+    response_object = {
+        "status": "success",
+        "data": {
+            "users": [
+                UserRecord.from_row(row).to_dict(
+                    "id", "username", "email", "created_at"
+                )
+                for row in rows
+            ],
+        },
+    }
+    return respond(response_object, 200)
+
+
+async def lookup_users(request, ids_arg):
+    response_object = {
+        "status": "fail",
+        "message": "Invalid payload."
+    }
+    try:
+        user_ids = [int(user_id) for user_id in ids_arg.split(",")]
+    except ValueError:
+        return respond(response_object, 400)
+    max_ids = current_app.config.get("USERS_LOOKUP_MAX_IDS")
+    if len(user_ids) > max_ids:
+        response_object["message"] = f"Too many ids. The maximum is {max_ids}."
+        return respond(response_object, 400)
+
+    users_by_id = {}
+    misses = set()
+    for user_id in user_ids:
+        user = user_cache.get(user_id)
+        if user is not None:
+            users_by_id[user_id] = user
+        else:
+            misses.add(user_id)
+    if misses:
+        version = user_cache.version
+        ttl = current_app.config.get("USER_CACHE_TTL")
+        async with request.app["db"].session("read") as session:
+            rows = await session.fetch_all(
+                select(list(USER_RECORD_COLUMNS)).where(User.id.in_(misses))
+            )
+        for row in rows:
+            user = users_by_id[row[0]] = UserRecord.from_row(row)
+            user_cache.set(user.id, user, ttl, version)
+
+    users_list = []
+    missing = []
+    for user_id in user_ids:
+        user = users_by_id.get(user_id)
+        if not user:
+            missing.append(user_id)
+            continue
+        users_list.append(
+            user.to_dict("id", "username", "email", "created_at")
+        )
+    del response_object["message"]
+    response_object.update({
+        "status": "success",
+        "data": {
+            "users": users_list,
+            "missing": missing,
+        },
+    })
+    return respond(response_object, 200)
@@ -1,12 +1,57 @@
-from flask import Blueprint, jsonify, request
-from sqlalchemy import exc, or_
+import uuid
+from datetime import datetime
+from functools import wraps
 
-from project.api.models import User
+from flask import Blueprint, current_app, jsonify, request
+from sqlalchemy import exc
+
+from project.api.invalidation import get_bus
+from project.api.keys import get_jwks
+from project.api.models import RevokedToken, User
+from project.api.outbox import user_registered
+from project.api.records import (
+    active_user_ids, add_sharded_user, find_user_id, load_credentials,
+    load_user,
+)
+from project.api.resilience import db_route, is_db_unavailable
+from project.api.shards import get_shards
 from project import db, bcrypt
+from project.logs import audit
 
 auth_blueprint = Blueprint("auth", __name__)
 
+def admin_required(view):
+    """Only lets requests with the auth token of an active admin through"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        auth_header = request.headers.get("Authorization")
+        response_object = {
+            "status": "fail",
+            "message": "Provide a valid auth token."
+        }
+        if not auth_header:
+            return jsonify(response_object), 401
+        resp = User.decode_auth_payload(auth_header.split(" ")[1])
+        if isinstance(resp, str):
+            response_object["message"] = resp
+            return jsonify(response_object), 401
+        user = load_user(resp["sub"])
+        if not user or not user.active or not user.admin:
+            response_object["message"] = "You do not have permission to do that."
+            return jsonify(response_object), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@auth_blueprint.route("/.well-known/jwks.json", methods=["GET"])
+def jwks():
+    response = jsonify(get_jwks())
+    response.headers["Cache-Control"] = "public, max-age={}".format(
+        current_app.config.get("JWKS_MAX_AGE")
+    )
+    return response, 200
+
 @auth_blueprint.route("/auth/register", methods=["POST"])
+@db_route("auth")
 def register_user():
     post_data = request.get_json()
     response_object = {
@@ -19,27 +64,43 @@ def register_user():
     email = post_data.get("email")
     password = post_data.get("password")
     try:
-        user = User.query.filter(
-            or_(User.username == username, User.email == email)
-        ).first()
-        if not user:
+        if find_user_id(username, email) is None:
             # add User to db
-            new_user = User(
-                username=username,
-                email=email,
-                password=password,
-            )
-            db.session.add(new_user)
+            if get_shards():
+                new_user = add_sharded_user(username, email, password)
+            else:
+                new_user = User(
+                    username=username,
+                    email=email,
+                    password=password,
+                )
+                db.session.add(new_user)
+                db.session.flush()
+            get_bus().publish_user_changed(new_user.id)
+            user_registered(new_user)
             db.session.commit()
             # generate auth token
-            auth_token = new_user.encode_auth_token(new_user.id)
+            session_id = uuid.uuid4().hex
+            auth_token = new_user.encode_auth_token(new_user.id, session_id)
+            refresh_token = new_user.encode_refresh_token(
+                new_user.id, session_id
+            )
+            audit(
+                "register", success=True, user_id=new_user.id, email=email,
+                remote_addr=request.remote_addr,
+            )
             response_object.update({
                 "status": "success",
                 "message": "Successfully registered.",
                 "auth_token": auth_token.decode(),
+                "refresh_token": refresh_token.decode(),
             })
             return jsonify(response_object), 201
         else:
+            audit(
+                "register", success=False, email=email,
+                remote_addr=request.remote_addr,
+            )
             response_object.update({"message": "Sorry. That user already exists."})
             return jsonify(response_object), 400
     except (exc.IntegrityError, ValueError) as e:
@@ -47,6 +108,7 @@ def register_user():
         return jsonify(response_object), 400
 
 @auth_blueprint.route("/auth/login", methods=["POST"])
+@db_route("auth")
 def login_user():
     post_data = request.get_json()
     response_object = {
@@ -59,24 +121,39 @@ def login_user():
     password = post_data.get("password")
     try:
         # fetch the user data
-        user = User.query.filter_by(email=email).first()
-        if user and bcrypt.check_password_hash(user.password, password):
-            auth_token = user.encode_auth_token(user.id)
-            if auth_token:
+        credentials = load_credentials(email)
+        if credentials and bcrypt.check_password_hash(credentials[1], password):
+            user = credentials[0]
+            session_id = uuid.uuid4().hex
+            auth_token = user.encode_auth_token(user.id, session_id)
+            refresh_token = user.encode_refresh_token(user.id, session_id)
+            if auth_token and refresh_token:
+                audit(
+                    "login", success=True, user_id=user.id, email=email,
+                    remote_addr=request.remote_addr,
+                )
                 response_object.update({
                     "status": "success",
                     "message": "Successfully logged in.",
                     "auth_token": auth_token.decode(),
+                    "refresh_token": refresh_token.decode(),
                 })
                 return jsonify(response_object), 200
         else:
+            audit(
+                "login", success=False, email=email,
+                remote_addr=request.remote_addr,
+            )
             response_object["message"] = "User does not exist."
             return jsonify(response_object), 404
     except Exception as e:
+        if is_db_unavailable(e):
+            raise
         response_object["message"] = "Try again."
         return jsonify(response_object), 500
 
 @auth_blueprint.route("/auth/logout", methods=["GET"])
+@db_route("auth")
 def logout():
     auth_header = request.headers.get("Authorization")
     response_object = {
@@ -85,8 +162,20 @@ def logout():
     }
     if auth_header:
         auth_token = auth_header.split(" ")[1]
-        resp = User.decode_auth_token(auth_token)
+        resp = User.decode_auth_payload(auth_token)
         if not isinstance(resp, str):
+            revocations = User.logout_revocations(resp)
+            for jti, exp in revocations:
+                db.session.add(RevokedToken(
+                    jti=jti, expires_at=datetime.utcfromtimestamp(exp),
+                ))
+                get_bus().publish_token_revoked(jti, exp)
+            if revocations:
+                db.session.commit()
+            audit(
+                "logout", success=True, user_id=resp["sub"],
+                remote_addr=request.remote_addr,
+            )
             response_object["status"] = "success"
             response_object["message"] = "Successfully logged out."
             return jsonify(response_object), 200
@@ -96,7 +185,38 @@ def logout():
     else:
         return jsonify(response_object), 403
 
+@auth_blueprint.route("/auth/refresh", methods=["POST"])
+@db_route("auth")
+def refresh_auth_token():
+    # get refresh token
+    auth_header = request.headers.get("Authorization")
+    response_object = {
+        "status": "fail",
+        "message": "Provide a valid refresh token."
+    }
+    if auth_header:
+        refresh_token = auth_header.split(" ")[1]
+        resp = User.decode_auth_payload(refresh_token, token_type="refresh")
+        if not isinstance(resp, str):
+            # the user row is only re-read here, not on every status check
+            user = load_user(resp["sub"])
+            if not user or not user.active:
+                response_object["message"] = "User does not exist."
+                return jsonify(response_object), 401
+            auth_token = user.encode_auth_token(user.id, resp.get("jti"))
+            response_object.update({
+                "status": "success",
+                "message": "Successfully refreshed.",
+                "auth_token": auth_token.decode(),
+            })
+            return jsonify(response_object), 200
+        response_object["message"] = resp
+        return jsonify(response_object), 401
+    else:
+        return jsonify(response_object), 403
+
 @auth_blueprint.route("/auth/status", methods=["GET"])
+@db_route("auth")
 def get_user_status():
     # get auth token
     auth_header = request.headers.get("Authorization")
@@ -106,22 +226,88 @@ def get_user_status():
     }
     if auth_header:
         auth_token = auth_header.split(" ")[1]
-        resp = User.decode_auth_token(auth_token)
+        resp = User.decode_auth_payload(auth_token)
         if not isinstance(resp, str):
-            user = User.query.filter_by(id=resp).first()
+            if (current_app.config.get("AUTH_STATUS_FROM_CLAIMS") and
+                    "username" in resp):
+                data = {
+                    "id": resp["sub"],
+                    "username": resp["username"],
+                    "email": resp["email"],
+                    "active": resp["active"],
+                    "created_at": datetime.utcfromtimestamp(
+                        resp["created_at"]
+                    ),
+                }
+            else:
+                user = load_user(resp["sub"])
+                data = user.to_dict(
+                    "id", "username", "email", "active", "created_at"
+                )
             response_object.update({
                 "status": "success",
                 "message": "Success",
-                "data": {
-                    "id": user.id,
-                    "username": user.username,
-                    "email": user.email,
-                    "active": user.active,
-                    "created_at": user.created_at,
-                }
+                "data": data,
             })
             return jsonify(response_object), 200
         response_object["message"] = resp
         return jsonify(response_object), 401
     else:
-        return jsonify(response_object), 401
\ No newline at end of file
+        return jsonify(response_object), 401
+
+@auth_blueprint.route("/auth/introspect", methods=["POST"])
+@db_route("auth")
+def introspect_tokens():
+    """Validate a batch of auth tokens"""
+    post_data = request.get_json()
+    response_object = {
+        "status": "fail",
+        "message": "Invalid payload.",
+    }
+    auth_tokens = post_data.get("tokens") \
+        if isinstance(post_data, dict) else None
+    if (not isinstance(auth_tokens, list) or
+            not all(isinstance(token, str) for token in auth_tokens)):
+        return jsonify(response_object), 400
+    max_tokens = current_app.config.get("AUTH_INTROSPECT_MAX_TOKENS")
+    if len(auth_tokens) > max_tokens:
+        response_object["message"] = (
+            f"Too many tokens. The maximum is {max_tokens}."
+        )
+        return jsonify(response_object), 400
+
+    # verify each distinct token once
+    payloads = {}
+    for auth_token in auth_tokens:
+        if auth_token not in payloads:
+            payloads[auth_token] = User.decode_auth_payload(auth_token)
+
+    # then check all the subjects at once
+    user_ids = {
+        payload["sub"] for payload in payloads.values()
+        if not isinstance(payload, str)
+    }
+    active_ids = active_user_ids(user_ids) if user_ids else set()
+
+    results = []
+    for auth_token in auth_tokens:
+        payload = payloads[auth_token]
+        if isinstance(payload, str):
+            results.append({"active": False, "message": payload})
+        elif payload["sub"] not in active_ids:
+            results.append({"active": False, "message": "User is not active."})
+        else:
+            results.append({
+                "active": True,
+                "sub": payload["sub"],
+                "exp": payload["exp"],
+            })
+
+    del response_object["message"]
+    response_object.update({
+        "status": "success",
+        "data": {
+            "tokens": results,
+        },
+    })
+    return jsonify(response_object), 200
@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import util
+
+# entries kept per worker
+USER_CACHE_SIZE = 10000
+
+
+class LocalCache:
+    """Per worker LRU cache with a ttl per entry
+
+    `version` changes on every delete or clear, so a loader that read the
+    db before an invalidation can tell it must not cache what it read.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl, version=None):
+        """Cache value for ttl seconds, unless an invalidation happened
+        since `version` was read
+        """
+        if ttl <= 0:
+            return
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self.version += 1
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_MISSING = object()
+
+
+class CountingLRUCache(util.LRUCache):
+    """SQLAlchemy's LRU cache, counting the hits and misses of get()
+
+    Used as the bakery of the baked queries in project/api/records.py,
+    which looks up both the baked queries and, keyed by dialect, their
+    compiled statements with get().
+    """
+
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = super().get(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+
+class RevokedTokens:
+    """jtis of revoked tokens, each kept until the token would expire"""
+
+    def __init__(self):
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def add(self, jti, exp):
+        now = time.time()
+        with self._lock:
+            self._expires[jti] = exp
+            if len(self._expires) % 1000 == 0:
+                self._expires = {
+                    jti: exp for jti, exp in self._expires.items()
+                    if exp > now
+                }
+
+    def replace(self, revoked):
+        """Swap in the full list of (jti, exp) after a resync"""
+        with self._lock:
+            self._expires = dict(revoked)
+
+    def __contains__(self, jti):
+        return jti in self._expires
+
+
+# UserRecords by id
+user_cache = LocalCache(USER_CACHE_SIZE)
+# the bakery of the hot user and directory lookups
+query_cache = CountingLRUCache(200)
+revoked_tokens = RevokedTokens()
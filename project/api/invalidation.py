@@ -0,0 +1,218 @@
+"""Keeps every worker's local caches in line with the db
+
+Write paths publish "user" (a user row changed) and "token" (an access
+token was revoked) messages. Every worker applies them to its caches in
+project/api/cache.py. Messages carry a sequence number. When a worker
+sees a jump in it, the messages in between may still come, from writers
+that committed later. If one has not come within INVALIDATION_GAP_WAIT
+seconds the worker may have missed it and resyncs: it drops its user
+cache and reloads the revoked tokens from the db.
+"""
+import json
+import logging
+import select
+import threading
+import time
+from calendar import timegm
+from datetime import datetime
+
+from flask import current_app, has_app_context
+from sqlalchemy import text
+
+from project import db
+from project.api.cache import revoked_tokens, user_cache
+from project.api.models import INVALIDATION_SEQUENCE, RevokedToken
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "user_invalidation"
+# created by the migrations, and by db.create_all() with the models
+SEQUENCE = INVALIDATION_SEQUENCE.name
+
+# missing sequence numbers waited on at most, a bigger gap resyncs at once
+MAX_MISSING = 1000
+
+NOTIFY = text(
+    "SELECT pg_notify(:channel, json_build_object("
+    "'seq', nextval(:sequence), 'kind', :kind, "
+    "'key', CAST(:key AS json))::text)"
+)
+
+
+def notify_params(kind, key):
+    """The parameters of NOTIFY, for a message of the postgres bus"""
+    return {
+        "channel": CHANNEL,
+        "sequence": SEQUENCE,
+        "kind": kind,
+        "key": json.dumps(key),
+    }
+
+
+class InvalidationBus:
+    """In process bus, for a single worker and for tests"""
+
+    def __init__(self, app):
+        self.app = app
+        self.gap_wait = app.config.get("INVALIDATION_GAP_WAIT")
+        self.last_seq = None
+        self.resyncs = 0
+        self._seq = 0
+        # missing sequence number -> when to stop waiting for it
+        self._missing = {}
+        self._lock = threading.Lock()
+
+    def publish_user_changed(self, user_id):
+        self.publish("user", user_id)
+
+    def publish_token_revoked(self, jti, exp):
+        self.publish("token", [jti, exp])
+
+    def publish(self, kind, key):
+        with self._lock:
+            self._seq += 1
+            message = {"seq": self._seq, "kind": kind, "key": key}
+        self.apply(message)
+
+    def apply(self, message):
+        seq = message["seq"]
+        with self._lock:
+            gap = 0 if self.last_seq is None else seq - self.last_seq - 1
+            if 0 < gap <= MAX_MISSING:
+                deadline = time.monotonic() + self.gap_wait
+                for missing in range(self.last_seq + 1, seq):
+                    self._missing[missing] = deadline
+            self._missing.pop(seq, None)
+            self.last_seq = max(seq, self.last_seq or 0)
+            overflow = gap > MAX_MISSING or len(self._missing) > MAX_MISSING
+        if overflow:
+            self.resync()
+        # applying is idempotent, so late and repeated messages are fine
+        if message["kind"] == "user":
+            user_cache.delete(message["key"])
+        elif message["kind"] == "token":
+            revoked_tokens.add(*message["key"])
+
+    def check_gaps(self):
+        """Resync if a message missing from the sequence did not come
+        within gap_wait seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = any(
+                deadline <= now for deadline in self._missing.values()
+            )
+        if expired:
+            self.resync()
+
+    def resync(self):
+        """Forget everything cached and reload the revoked tokens"""
+        self.resyncs += 1
+        with self._lock:
+            self._missing.clear()
+        user_cache.clear()
+        if has_app_context():
+            rows = self._load_revoked()
+        else:
+            with self.app.app_context():
+                rows = self._load_revoked()
+        revoked_tokens.replace(
+            (jti, timegm(expires_at.utctimetuple()))
+            for jti, expires_at in rows
+        )
+
+    def _load_revoked(self):
+        return db.session.query(
+            RevokedToken.jti, RevokedToken.expires_at
+        ).filter(RevokedToken.expires_at > datetime.utcnow()).all()
+
+
+def prune_revoked_tokens():
+    """Delete the revoked tokens that have expired, returns how many"""
+    deleted = RevokedToken.query.filter(
+        RevokedToken.expires_at <= datetime.utcnow()
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+class PostgresInvalidationBus(InvalidationBus):
+    """Bus over postgres LISTEN/NOTIFY
+
+    Messages are sent with pg_notify in the writer's transaction, so they
+    are only delivered if it commits. The sequence number comes from a db
+    sequence. Transactions that commit out of order leave gaps that fill
+    within the gap wait. Those that roll back after publishing leave gaps
+    that never fill, and cause a harmless extra resync.
+
+    The listener holds a connection of its own, detached from the pool,
+    for as long as it listens.
+    """
+
+    def __init__(self, app):
+        super().__init__(app)
+        self._listener = None
+
+    def publish(self, kind, key):
+        db.session.execute(NOTIFY, notify_params(kind, key))
+
+    def start(self):
+        if self._listener is None:
+            self._listener = threading.Thread(target=self._listen, daemon=True)
+            self._listener.start()
+
+    def _listen(self):
+        while True:
+            connection = None
+            try:
+                connection = db.get_engine(self.app).raw_connection()
+                # closing a detached connection closes it for good, instead
+                # of handing a LISTENing autocommit connection to a request
+                connection.detach()
+                listener = connection.connection
+                listener.autocommit = True
+                listener.cursor().execute(f"LISTEN {CHANNEL}")
+                # anything published while we were not listening is lost
+                self.resync()
+                self.last_seq = None
+                while True:
+                    select.select([listener], [], [], self.gap_wait)
+                    listener.poll()
+                    while listener.notifies:
+                        notify = listener.notifies.pop(0)
+                        self.apply(json.loads(notify.payload))
+                    self.check_gaps()
+            except Exception:
+                logger.exception("invalidation listener failed, reconnecting")
+                time.sleep(1)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+
+BACKENDS = {
+    "memory": InvalidationBus,
+    "postgres": PostgresInvalidationBus,
+}
+
+
+def init_bus(app):
+
+    @app.before_first_request
+    def start_bus():
+        # synced and listening before the worker serves anything, or it
+        # would accept revoked tokens until its first write
+        get_bus()
+
+
+def get_bus():
+    """The app's bus, created and synced on first use"""
+    app = current_app._get_current_object()
+    bus = app.extensions.get("invalidation_bus")
+    if bus is None:
+        bus = BACKENDS[app.config.get("INVALIDATION_BUS")](app)
+        bus.resync()
+        if isinstance(bus, PostgresInvalidationBus):
+            bus.start()
+        app.extensions["invalidation_bus"] = bus
+    return bus
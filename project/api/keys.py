@@ -0,0 +1,140 @@
+import base64
+import os
+
+import jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.hazmat.primitives.serialization import (
+    load_pem_private_key, load_pem_public_key,
+)
+from flask import current_app
+
+# the algorithms that sign with the keys of JWT_KEYS_DIR, the others are
+# HMACs keyed with SECRET_KEY
+ASYMMETRIC_ALGORITHMS = frozenset({
+    "RS256", "RS384", "RS512", "ES256", "ES384", "ES512",
+})
+
+# loaded key sets, by keys dir
+_key_sets = {}
+
+
+class KeySet:
+    """The asymmetric keys found in JWT_KEYS_DIR
+
+    Every `<kid>.pem` file holds a private or a public key. Private keys
+    can sign, and all keys verify, so a retired key can be kept around as
+    a public key until the tokens it signed have expired.
+    """
+
+    def __init__(self, keys_dir):
+        self.private_keys = {}
+        self.public_keys = {}
+        for filename in sorted(os.listdir(keys_dir)):
+            kid, ext = os.path.splitext(filename)
+            if ext != ".pem":
+                continue
+            with open(os.path.join(keys_dir, filename), "rb") as f:
+                pem = f.read()
+            if b"PRIVATE KEY" in pem:
+                key = load_pem_private_key(pem, None, default_backend())
+                self.private_keys[kid] = key
+                self.public_keys[kid] = key.public_key()
+            else:
+                self.public_keys[kid] = load_pem_public_key(
+                    pem, default_backend()
+                )
+
+    def jwks(self, algorithm):
+        """Public keys in JWK format"""
+        return [
+            _to_jwk(kid, key, algorithm)
+            for kid, key in self.public_keys.items()
+        ]
+
+
+def _b64(number, size=None):
+    """base64url of a big-endian integer, left-padded to size bytes"""
+    if size is None:
+        size = (number.bit_length() + 7) // 8
+    data = number.to_bytes(size, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _to_jwk(kid, key, algorithm):
+    jwk = {"kid": kid, "use": "sig", "alg": algorithm}
+    numbers = key.public_numbers()
+    if isinstance(key, rsa.RSAPublicKey):
+        jwk.update({
+            "kty": "RSA",
+            "n": _b64(numbers.n),
+            "e": _b64(numbers.e),
+        })
+    elif isinstance(key, ec.EllipticCurvePublicKey):
+        # coordinates are always the full size of the curve (RFC 7518)
+        size = (key.curve.key_size + 7) // 8
+        jwk.update({
+            "kty": "EC",
+            "crv": "P-" + str(key.curve.key_size),
+            "x": _b64(numbers.x, size),
+            "y": _b64(numbers.y, size),
+        })
+    return jwk
+
+
+def get_key_set():
+    keys_dir = current_app.config.get("JWT_KEYS_DIR")
+    if not keys_dir:
+        raise RuntimeError(
+            f"JWT_ALGORITHM {current_app.config.get('JWT_ALGORITHM')} "
+            "needs JWT_KEYS_DIR"
+        )
+    if keys_dir not in _key_sets:
+        _key_sets[keys_dir] = KeySet(keys_dir)
+    return _key_sets[keys_dir]
+
+
+def is_asymmetric():
+    return current_app.config.get("JWT_ALGORITHM") in ASYMMETRIC_ALGORITHMS
+
+
+def encode_token(payload):
+    """Signs the payload with the configured algorithm and signing key"""
+    algorithm = current_app.config.get("JWT_ALGORITHM")
+    if not is_asymmetric():
+        return jwt.encode(
+            payload,
+            current_app.config.get("SECRET_KEY"),
+            algorithm=algorithm,
+        )
+    kid = current_app.config.get("JWT_SIGNING_KID")
+    return jwt.encode(
+        payload,
+        get_key_set().private_keys[kid],
+        algorithm=algorithm,
+        headers={"kid": kid},
+    )
+
+
+def decode_token(token):
+    """Verifies the token and returns its payload
+    raises: jwt.InvalidTokenError
+    """
+    algorithm = current_app.config.get("JWT_ALGORITHM")
+    if not is_asymmetric():
+        key = current_app.config.get("SECRET_KEY")
+    else:
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = get_key_set().public_keys.get(kid)
+        if key is None:
+            raise jwt.InvalidTokenError(f"Unknown key id {kid}")
+    return jwt.decode(token, key, algorithms=[algorithm])
+
+
+def get_jwks():
+    """The JWKS document for the verification keys"""
+    if not is_asymmetric():
+        return {"keys": []}
+    return {
+        "keys": get_key_set().jwks(current_app.config.get("JWT_ALGORITHM"))
+    }
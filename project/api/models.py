@@ -1,8 +1,13 @@
+from calendar import timegm
 from datetime import datetime, timedelta
+import uuid
+
 import jwt
 
 from flask import current_app
 from project import db, bcrypt
+from project.api.cache import revoked_tokens
+from project.api.keys import decode_token, encode_token
 
 
 class User(db.Model):
@@ -11,23 +16,36 @@ class User(db.Model):
     username = db.Column(db.String(128), unique=True, nullable=False)
     email = db.Column(db.String(128), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
-    active = db.Column(db.Boolean, default=True, server_default="false", nullable=False)
-    admin = db.Column(db.Boolean, default=False, server_default="false", nullable=False)
+    # active_history loads the old value when these change, so the stats
+    # rollup in project/api/stats.py can tell what to count
+    active = db.column_property(
+        db.Column(db.Boolean, default=True, server_default="false", nullable=False),
+        active_history=True,
+    )
+    admin = db.column_property(
+        db.Column(db.Boolean, default=False, server_default="false", nullable=False),
+        active_history=True,
+    )
     created_at = db.Column(db.DateTime, nullable=False)
 
     def __init__(
             self, username, email, password,
-            created_at=datetime.utcnow()):
+            created_at=None):
         self.username = username
         self.email = email
         self.password = bcrypt.generate_password_hash(
             password,
             current_app.config.get("BCRYPT_LOG_ROUNDS")
         ).decode()
-        self.created_at = created_at
+        self.created_at = created_at or datetime.utcnow()
     
-    def encode_auth_token(self, user_id):
-        """Generates the auth token"""
+    def encode_auth_token(self, user_id, session_id=None):
+        """Generates the auth token
+
+        The profile fields are carried as claims so /auth/status can be
+        answered without a db query. session_id is the jti of the refresh
+        token the auth token belongs with, logging out revokes both.
+        """
         expire_delta = timedelta(
             days=current_app.config.get("TOKEN_EXPIRATION_DAYS"),
             seconds=current_app.config.get("TOKEN_EXPIRATION_SECONDS"),
@@ -38,28 +56,157 @@ class User(db.Model):
                 "exp": datetime.utcnow() + expire_delta,
                 "iat": datetime.utcnow(),
                 "sub": user_id,
+                "jti": uuid.uuid4().hex,
+                "type": "access",
+                "username": self.username,
+                "email": self.email,
+                "active": self.active,
+                "created_at": timegm(self.created_at.utctimetuple()),
             }
-            return jwt.encode(
-                payload,
-                current_app.config.get("SECRET_KEY"),
-                algorithm="HS256",
-            )
+            if session_id is not None:
+                payload["sid"] = session_id
+            return encode_token(payload)
         except Exception as e:
             return e
-    
+
+    def encode_refresh_token(self, user_id, session_id=None):
+        """Generates the long lived token used to get new auth tokens
+
+        Its jti is session_id, which the auth tokens of the session carry
+        as their sid.
+        """
+        expire_delta = timedelta(
+            days=current_app.config.get("REFRESH_TOKEN_EXPIRATION_DAYS"),
+        )
+
+        try:
+            payload = {
+                "exp": datetime.utcnow() + expire_delta,
+                "iat": datetime.utcnow(),
+                "sub": user_id,
+                "jti": session_id or uuid.uuid4().hex,
+                "type": "refresh",
+            }
+            return encode_token(payload)
+        except Exception as e:
+            return e
+
     @staticmethod
-    def decode_auth_token(auth_token):
-        """Decodes the auth_token
+    def decode_auth_payload(auth_token, token_type="access"):
+        """Decodes the auth_token and checks its type
         param: auth_token
-        return: string|int
+        param: token_type: "access"|"refresh"
+        return: string|dict
         """
         try:
-            payload = jwt.decode(
-                auth_token,
-                current_app.config.get("SECRET_KEY")
-            )
-            return payload["sub"]
+            payload = decode_token(auth_token)
         except jwt.ExpiredSignature:
             return "Signature Expired. Please log in again."
         except jwt.InvalidTokenError:
-            return "Invalid Token. Please log in again."
\ No newline at end of file
+            return "Invalid Token. Please log in again."
+        # tokens issued before refresh tokens existed have no type
+        if payload.get("type", "access") != token_type:
+            return "Invalid Token. Please log in again."
+        if (payload.get("jti") in revoked_tokens or
+                payload.get("sid") in revoked_tokens):
+            return "Token revoked. Please log in again."
+        return payload
+
+    @staticmethod
+    def logout_revocations(payload):
+        """[(jti, exp)] to revoke when logging out with an auth token: the
+        token itself, and the refresh token of its session
+        """
+        revocations = []
+        if "jti" in payload:
+            revocations.append((payload["jti"], payload["exp"]))
+        if "sid" in payload:
+            # no later than the refresh token expires, as it is older
+            # than this auth token
+            expires_at = datetime.utcnow() + timedelta(
+                days=current_app.config.get("REFRESH_TOKEN_EXPIRATION_DAYS"),
+            )
+            revocations.append(
+                (payload["sid"], timegm(expires_at.utctimetuple()))
+            )
+        return revocations
+
+    @staticmethod
+    def decode_auth_token(auth_token):
+        """Decodes the auth_token
+        param: auth_token
+        return: string|int
+        """
+        payload = User.decode_auth_payload(auth_token)
+        if isinstance(payload, str):
+            return payload
+        return payload["sub"]
+
+
+# numbers the messages of the postgres invalidation bus, see
+# project/api/invalidation.py
+INVALIDATION_SEQUENCE = db.Sequence(
+    "user_invalidation_seq", metadata=db.Model.metadata
+)
+
+
+class RevokedToken(db.Model):
+    """Access tokens revoked by logging out, until they expire"""
+    __tablename__ = "revoked_tokens"
+    jti = db.Column(db.String(32), primary_key=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class UserTotals(db.Model):
+    """Running user counts, a single row kept up to date on every flush"""
+    __tablename__ = "user_totals"
+    id = db.Column(db.Integer, primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    active = db.Column(db.Integer, nullable=False, default=0)
+    admin = db.Column(db.Integer, nullable=False, default=0)
+
+
+class SignupDay(db.Model):
+    """Number of users created on each day (utc)"""
+    __tablename__ = "signup_days"
+    day = db.Column(db.Date, primary_key=True)
+    signups = db.Column(db.Integer, nullable=False, default=0)
+
+
+class OutboxEvent(db.Model):
+    """An event for other services, written in the transaction that
+    caused it and delivered later by project/api/outbox.py
+    """
+    __tablename__ = "outbox_events"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    event_type = db.Column(db.String(64), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime)
+    dispatched_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    __table_args__ = (
+        # the dispatcher only ever looks for undelivered events
+        db.Index(
+            "ix_outbox_events_pending", "id",
+            postgresql_where=db.text("dispatched_at IS NULL"),
+        ),
+        db.Index("ix_outbox_events_dispatched_at", "dispatched_at"),
+    )
+
+
+class UserDirectory(db.Model):
+    """Where each user lives when users are sharded, see
+    project/api/shards.py
+
+    Allocates the user ids, and keeps 64 bit hashes of the emails and
+    usernames rather than the strings, which keeps the rows small and
+    the names unique across all shards.
+    """
+    __tablename__ = "user_directory"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    email_hash = db.Column(db.BigInteger, unique=True, nullable=False)
+    username_hash = db.Column(db.BigInteger, unique=True, nullable=False)
+    shard = db.Column(db.SmallInteger, nullable=False)
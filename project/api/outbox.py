@@ -0,0 +1,189 @@
+"""Transactional outbox for events other services need to hear about
+
+Request handlers call record_event() before they commit, which only adds
+a row to outbox_events in the same transaction. If the transaction rolls
+back the event is gone with it, and nothing is sent over the network on
+the request path.
+
+`manage.py dispatch_outbox` runs an OutboxDispatcher. It takes pending
+events in batches, hands them to a sink and marks each one delivered, or
+schedules a retry with exponential backoff. Events that failed
+OUTBOX_MAX_ATTEMPTS times stay in the table with their last error.
+"""
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_
+
+from project import db
+from project.api.models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+
+def new_event(event_type, payload):
+    """The column values of an outbox_events row"""
+    return {
+        "event_type": event_type,
+        "payload": json.dumps(payload, default=str),
+        "created_at": datetime.utcnow(),
+    }
+
+
+def record_event(event_type, payload):
+    """Add an event to the outbox, in the caller's transaction"""
+    db.session.add(OutboxEvent(**new_event(event_type, payload)))
+
+
+def user_registered_payload(user):
+    return {
+        "id": user.id,
+        "username": user.username,
+        "email": user.email,
+        "created_at": user.created_at.isoformat(),
+    }
+
+
+def user_registered_event(user):
+    return new_event("user.registered", user_registered_payload(user))
+
+
+def user_registered(user):
+    record_event("user.registered", user_registered_payload(user))
+
+
+class FileSink:
+    """Appends events as json lines to a file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, events):
+        with open(self.path, "a") as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+        return {}
+
+
+class MemorySink:
+    """Keeps events in a list, for tests
+
+    `fail` maps event ids to the error to fail them with.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.fail = {}
+
+    def send(self, events):
+        errors = {}
+        for event in events:
+            if event["id"] in self.fail:
+                errors[event["id"]] = self.fail[event["id"]]
+            else:
+                self.events.append(event)
+        return errors
+
+
+SINKS = {
+    "file": lambda app: FileSink(app.config.get("OUTBOX_FILE")),
+    "memory": lambda app: MemorySink(),
+}
+
+
+class OutboxDispatcher:
+    """Delivers pending outbox events to a sink
+
+    A sink has send(events), which gets a list of event dicts and returns
+    {event id: error} for the ones it could not deliver. Raising fails
+    the whole batch.
+    """
+
+    def __init__(self, sink, batch_size=100, max_attempts=10,
+                 backoff=1, max_backoff=600):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.delivered = 0
+        self.failed = 0
+
+    @classmethod
+    def from_config(cls, app):
+        config = app.config
+        return cls(
+            SINKS[config.get("OUTBOX_SINK")](app),
+            config.get("OUTBOX_BATCH_SIZE"),
+            config.get("OUTBOX_MAX_ATTEMPTS"),
+            config.get("OUTBOX_BACKOFF"),
+            config.get("OUTBOX_MAX_BACKOFF"),
+        )
+
+    def _retry_at(self, attempts, now):
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        return now + timedelta(seconds=delay)
+
+    def dispatch_batch(self, now=None):
+        """Deliver one batch, returns how many events it held"""
+        now = now or datetime.utcnow()
+        # SKIP LOCKED lets several dispatchers share the table on postgres
+        events = OutboxEvent.query.filter(
+            OutboxEvent.dispatched_at.is_(None),
+            OutboxEvent.attempts < self.max_attempts,
+            or_(
+                OutboxEvent.next_attempt_at.is_(None),
+                OutboxEvent.next_attempt_at <= now,
+            ),
+        ).order_by(OutboxEvent.id).limit(self.batch_size).with_for_update(
+            skip_locked=True
+        ).all()
+        if not events:
+            db.session.rollback()
+            return 0
+
+        try:
+            errors = self.sink.send([{
+                "id": event.id,
+                "type": event.event_type,
+                "payload": json.loads(event.payload),
+                "created_at": event.created_at.isoformat(),
+            } for event in events])
+        except Exception as e:
+            logger.exception("outbox sink failed")
+            errors = {event.id: repr(e) for event in events}
+
+        for event in events:
+            event.attempts += 1
+            if event.id in errors:
+                event.last_error = str(errors[event.id])
+                event.next_attempt_at = self._retry_at(event.attempts, now)
+                self.failed += 1
+            else:
+                event.dispatched_at = now
+                event.last_error = None
+                self.delivered += 1
+        db.session.commit()
+        return len(events)
+
+    def purge(self, older_than):
+        """Delete events delivered before older_than"""
+        deleted = OutboxEvent.query.filter(
+            OutboxEvent.dispatched_at < older_than
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+    def run(self, poll_interval=1, retention=timedelta(days=7)):
+        """Dispatch until stopped, waiting poll_interval when idle"""
+        while True:
+            try:
+                if self.dispatch_batch() == self.batch_size:
+                    continue
+                self.purge(datetime.utcnow() - retention)
+            except Exception:
+                db.session.rollback()
+                logger.exception("outbox dispatch failed")
+            time.sleep(poll_interval)
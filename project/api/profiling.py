@@ -0,0 +1,128 @@
+from flask import Blueprint, Response, current_app, jsonify, request
+
+from project.api.auth import admin_required
+from project.api.resilience import db_route
+from project.profiler import get_profiler
+
+profiling_blueprint = Blueprint("profiling", __name__)
+
+
+def profile_args(post_data):
+    """(routes, sample_rate, duration) of a profile request, or ValueError
+    with the message to answer with
+    """
+    routes = post_data.get("routes")
+    sample_rate = post_data.get("sample_rate", 1)
+    duration = post_data.get("duration", 60)
+    if (not isinstance(routes, list) or not routes or
+            not all(isinstance(route, str) for route in routes)):
+        raise ValueError("Invalid payload.")
+    known = {rule.rule for rule in current_app.url_map.iter_rules()}
+    for route in routes:
+        if route not in known:
+            raise ValueError(f"Unknown route {route}.")
+    if (not isinstance(sample_rate, (int, float)) or
+            not 0 < sample_rate <= 1):
+        raise ValueError("The sample rate must be above 0 and at most 1.")
+    max_duration = current_app.config.get("PROFILER_MAX_DURATION")
+    if not isinstance(duration, (int, float)) or \
+            not 0 < duration <= max_duration:
+        raise ValueError(
+            f"The duration must be above 0 and at most {max_duration} "
+            "seconds."
+        )
+    return routes, sample_rate, duration
+
+@profiling_blueprint.route("/admin/profile", methods=["POST"])
+@db_route("read")
+@admin_required
+def start_profile():
+    """Profile a fraction of the requests to some routes for a while, in
+    every worker
+
+    {"routes": ["/auth/login"], "sample_rate": 0.1, "duration": 60}
+    """
+    post_data = request.get_json()
+    response_object = {
+        "status": "fail",
+        "message": "Invalid payload.",
+    }
+    if not post_data:
+        return jsonify(response_object), 400
+    try:
+        routes, sample_rate, duration = profile_args(post_data)
+    except ValueError as e:
+        response_object["message"] = str(e)
+        return jsonify(response_object), 400
+
+    profile = get_profiler().start(
+        routes, sample_rate, duration,
+        current_app.config.get("PROFILER_INTERVAL"),
+    )
+    if profile is None:
+        response_object["message"] = "A profile is already running."
+        return jsonify(response_object), 409
+
+    response_object = {
+        "status": "success",
+        "data": profile,
+    }
+    return jsonify(response_object), 201
+
+@profiling_blueprint.route("/admin/profile", methods=["GET"])
+@db_route("read")
+@admin_required
+def get_profile():
+    """The running or last profile, without its stacks"""
+    profile = get_profiler().summary()
+    if profile is None:
+        response_object = {
+            "status": "fail",
+            "message": "No profile has been taken.",
+        }
+        return jsonify(response_object), 404
+    response_object = {
+        "status": "success",
+        "data": profile,
+    }
+    return jsonify(response_object), 200
+
+@profiling_blueprint.route("/admin/profile", methods=["DELETE"])
+@db_route("read")
+@admin_required
+def stop_profile():
+    """Stop the running profile before its window is over, in every
+    worker
+    """
+    profile = get_profiler().stop()
+    if profile is None:
+        response_object = {
+            "status": "fail",
+            "message": "No profile is running.",
+        }
+        return jsonify(response_object), 404
+    response_object = {
+        "status": "success",
+        "data": profile,
+    }
+    return jsonify(response_object), 200
+
+@profiling_blueprint.route("/admin/profile/collapsed", methods=["GET"])
+@db_route("read")
+@admin_required
+def download_profile():
+    """The stacks of the running or last profile, in collapsed format"""
+    collapsed = get_profiler().collapsed()
+    if collapsed is None:
+        response_object = {
+            "status": "fail",
+            "message": "No profile has been taken.",
+        }
+        return jsonify(response_object), 404
+    return Response(
+        collapsed,
+        mimetype="text/plain",
+        headers={
+            "Content-Disposition": "attachment; filename=profile.collapsed",
+        },
+    )
@@ -0,0 +1,204 @@
+from calendar import timegm
+from datetime import datetime
+from operator import itemgetter
+
+from flask import current_app
+from sqlalchemy import bindparam, or_
+from sqlalchemy.ext.baked import BakedQuery
+
+from project import db
+from project.api.cache import query_cache, user_cache
+from project.api.models import User
+from project.api.shards import get_shards
+from project.api.singleflight import SingleFlight
+from project.api.stats import count_new_user
+
+# concurrent loads of the same user share one query
+user_loads = SingleFlight()
+
+
+class UserRecord(tuple):
+    """Read only user, built straight from a row tuple
+
+    Holds no password hash and no orm state, so it is a few hundred bytes
+    instead of a few kilobytes and can be shared between threads. The
+    booleans are the interned True/False and created_at is kept as
+    seconds since the epoch.
+    """
+    __slots__ = ()
+
+    id = property(itemgetter(0))
+    username = property(itemgetter(1))
+    email = property(itemgetter(2))
+    active = property(itemgetter(3))
+    admin = property(itemgetter(4))
+    created_ts = property(itemgetter(5))
+
+    @classmethod
+    def from_row(cls, row):
+        user_id, username, email, active, admin, created_at = row
+        return tuple.__new__(cls, (
+            user_id,
+            username,
+            email,
+            True if active else False,
+            True if admin else False,
+            timegm(created_at.utctimetuple()),
+        ))
+
+    @property
+    def created_at(self):
+        return datetime.utcfromtimestamp(self[5])
+
+    def to_dict(self, *fields):
+        return {field: getattr(self, field) for field in fields}
+
+    # the token helpers only read the profile fields
+    encode_auth_token = User.encode_auth_token
+    encode_refresh_token = User.encode_refresh_token
+
+
+# the columns from_row expects, in order
+USER_RECORD_COLUMNS = (
+    User.id, User.username, User.email, User.active, User.admin,
+    User.created_at,
+)
+
+
+# the hot lookups are built and compiled once, instead of per request
+USER_BY_ID = BakedQuery(
+    query_cache, lambda session: session.query(*USER_RECORD_COLUMNS)
+)
+USER_BY_ID += lambda q: q.filter(User.id == bindparam("user_id"))
+
+CREDENTIALS_BY_EMAIL = BakedQuery(
+    query_cache,
+    lambda session: session.query(*USER_RECORD_COLUMNS, User.password),
+)
+CREDENTIALS_BY_EMAIL += lambda q: q.filter(User.email == bindparam("email"))
+
+USER_ID_BY_USERNAME_OR_EMAIL = BakedQuery(
+    query_cache, lambda session: session.query(User.id)
+)
+USER_ID_BY_USERNAME_OR_EMAIL += lambda q: q.filter(or_(
+    User.username == bindparam("username"),
+    User.email == bindparam("email"),
+))
+
+
+def _single_flight(key, load):
+    return user_loads.do(
+        key, load, current_app.config.get("SINGLE_FLIGHT_TIMEOUT")
+    )
+
+
+def load_user(user_id):
+    """UserRecord|None, from the worker's cache when it is there"""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+
+    version = user_cache.version
+
+    def load():
+        shards = get_shards()
+        if shards:
+            row = shards.user_row(user_id)
+        else:
+            row = USER_BY_ID(db.session()).params(user_id=user_id).first()
+        return UserRecord.from_row(row) if row else None
+    user = _single_flight(("id", user_id), load)
+    if user is not None:
+        user_cache.set(
+            user_id, user, current_app.config.get("USER_CACHE_TTL"), version
+        )
+    return user
+
+
+def load_credentials(email):
+    """(UserRecord, password hash)|None for logging in"""
+    def load():
+        shards = get_shards()
+        if shards:
+            row = shards.credentials_row(email)
+        else:
+            row = CREDENTIALS_BY_EMAIL(db.session()).params(
+                email=email
+            ).first()
+        return (UserRecord.from_row(row[:-1]), row[-1]) if row else None
+    return _single_flight(("email", email), load)
+
+
+def find_user_id(username=None, email=None):
+    """The id of a user with the username or the email, or None"""
+    shards = get_shards()
+    if shards:
+        return shards.find_user_id(username, email)
+    row = USER_ID_BY_USERNAME_OR_EMAIL(db.session()).params(
+        username=username, email=email
+    ).first()
+    return row[0] if row else None
+
+
+def load_users(user_ids):
+    """UserRecords by id for the ids that exist
+
+    Cached users are served from the cache and only the rest is queried.
+    """
+    users = {}
+    misses = set()
+    for user_id in user_ids:
+        user = user_cache.get(user_id)
+        if user is not None:
+            users[user_id] = user
+        else:
+            misses.add(user_id)
+    if not misses:
+        return users
+
+    version = user_cache.version
+    ttl = current_app.config.get("USER_CACHE_TTL")
+    shards = get_shards()
+    if shards:
+        rows = shards.user_rows(misses)
+    else:
+        rows = db.session.query(*USER_RECORD_COLUMNS).filter(
+            User.id.in_(misses)
+        )
+    for row in rows:
+        user = users[row[0]] = UserRecord.from_row(row)
+        user_cache.set(user.id, user, ttl, version)
+    return users
+
+
+def list_users(limit=None, offset=0):
+    """UserRecords, newest first, all of them unless limit is given"""
+    shards = get_shards()
+    if shards:
+        rows = shards.newest_rows(limit, offset)
+    else:
+        rows = db.session.query(*USER_RECORD_COLUMNS).order_by(
+            User.created_at.desc(), User.id.desc()
+        ).limit(limit).offset(offset)
+    return [UserRecord.from_row(row) for row in rows]
+
+
+def active_user_ids(user_ids):
+    """The ids of user_ids that belong to active users"""
+    shards = get_shards()
+    if shards:
+        return {row[0] for row in shards.user_rows(user_ids) if row[3]}
+    return {
+        user_id for user_id, in db.session.query(User.id).filter(
+            User.id.in_(user_ids), User.active.is_(True)
+        )
+    }
+
+
+def add_sharded_user(username, email, password):
+    """Add a user to its shard and count it in the stats, returns its
+    UserRecord. Commit db.session to finish, as with an added User
+    """
+    user = get_shards().add_user(username, email, password)
+    count_new_user(db.session.connection(), user)
+    return user
@@ -0,0 +1,205 @@
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, has_app_context, jsonify
+from sqlalchemy import event, exc, text
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+from project import db
+from project.api.singleflight import SingleFlightTimeout
+
+# pg's query_canceled, what a statement timeout raises
+QUERY_CANCELED = "57014"
+
+# the errors that can say the db is slow or down, see is_db_unavailable
+DB_ERRORS = (exc.DBAPIError, exc.TimeoutError, SingleFlightTimeout)
+
+
+def is_db_unavailable(error):
+    """Whether error says the db is slow or down, rather than a bug
+
+    Statement timeouts, lost connections, failures to connect, pool
+    checkout timeouts and waiting too long on another request's load are
+    answered with 503 and count towards the circuit breaker. Other db
+    errors are 500s.
+    """
+    if isinstance(error, exc.OperationalError):
+        pgcode = getattr(error.orig, "pgcode", None)
+        if error.statement is None or pgcode == QUERY_CANCELED:
+            # raised connecting, or by the db giving up on a statement
+            return True
+        if pgcode is None and type(error.orig).__module__.startswith(
+                "psycopg2"):
+            # the server never answered, psycopg2 does not always see
+            # that as a disconnect
+            return True
+    if isinstance(error, exc.DBAPIError):
+        return error.connection_invalidated
+    return isinstance(error, (exc.TimeoutError, SingleFlightTimeout))
+
+
+class CircuitOpen(Exception):
+    """The db has failed too often and traffic to it is being shed"""
+
+
+class CircuitBreaker:
+    """Sheds db bound requests after `threshold` failures in a row
+
+    While open, a background thread runs `probe` every `reset_seconds`
+    and closes the breaker again once it succeeds.
+    """
+
+    def __init__(self, threshold, reset_seconds, probe):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.probe = probe
+        self.failures = 0
+        self.is_open = False
+        self._lock = threading.Lock()
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.is_open or self.failures < self.threshold:
+                return
+            self.is_open = True
+        threading.Thread(target=self._probe_until_closed, daemon=True).start()
+
+    def try_close(self):
+        """Run the probe once, closing the breaker if it succeeds"""
+        try:
+            self.probe()
+        except Exception:
+            return False
+        with self._lock:
+            self.failures = 0
+            self.is_open = False
+        return True
+
+    def _probe_until_closed(self):
+        while self.is_open:
+            time.sleep(self.reset_seconds)
+            self.try_close()
+
+
+class RouteTimeoutQueuePool(QueuePool):
+    """QueuePool whose checkout timeout depends on the current route class"""
+
+    @property
+    def _timeout(self):
+        timeout = _route_setting("DB_CHECKOUT_TIMEOUTS")
+        return self._default_timeout if timeout is None else timeout
+
+    @_timeout.setter
+    def _timeout(self, value):
+        self._default_timeout = value
+
+
+def _route_setting(name):
+    if not has_app_context() or "db_route_class" not in g:
+        return None
+    return current_app.config.get(name, {}).get(g.db_route_class)
+
+
+def apply_statement_timeout(connection):
+    """SET LOCAL the statement timeout of the route class on connection"""
+    timeout = _route_setting("DB_STATEMENT_TIMEOUTS")
+    if timeout and connection.dialect.name == "postgresql":
+        connection.execute(
+            text(f"SET LOCAL statement_timeout = {int(timeout)}")
+        )
+
+
+@event.listens_for(Session, "after_begin")
+def set_statement_timeout(session, transaction, connection):
+    apply_statement_timeout(connection)
+
+
+def copy_route_class(function):
+    """function, run in an app context with the db route class of the
+    current one, so its timeouts also apply on other threads
+    """
+    app = current_app._get_current_object()
+    route_class = g.get("db_route_class")
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with app.app_context():
+            if route_class is not None:
+                g.db_route_class = route_class
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def get_circuit_breaker():
+    """The app's CircuitBreaker, None unless DB_CIRCUIT_BREAKER is set"""
+    if not current_app.config.get("DB_CIRCUIT_BREAKER"):
+        return None
+    breaker = current_app.extensions.get("db_circuit_breaker")
+    if breaker is None:
+        app = current_app._get_current_object()
+
+        def probe():
+            with app.app_context():
+                db.session.execute("SELECT 1")
+                db.session.remove()
+        breaker = CircuitBreaker(
+            app.config.get("DB_CIRCUIT_BREAKER_THRESHOLD"),
+            app.config.get("DB_CIRCUIT_BREAKER_RESET_SECONDS"),
+            probe,
+        )
+        app.extensions["db_circuit_breaker"] = breaker
+    return breaker
+
+
+def db_route(route_class):
+    """Apply the timeouts of route_class ("read", "write" or "auth") to the
+    db work of a view and feed its outcome to the circuit breaker
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            breaker = get_circuit_breaker()
+            if breaker and breaker.is_open:
+                raise CircuitOpen()
+            g.db_route_class = route_class
+            try:
+                response = view(*args, **kwargs)
+            except DB_ERRORS as e:
+                if breaker and is_db_unavailable(e):
+                    breaker.record_failure()
+                raise
+            finally:
+                g.pop("db_route_class", None)
+            if breaker:
+                breaker.record_success()
+            return response
+        return wrapper
+    return decorator
+
+
+def init_app(app):
+    def db_unavailable(e):
+        db.session.rollback()
+        response_object = {
+            "status": "fail",
+            "message": "Service unavailable. Please try again.",
+        }
+        return jsonify(response_object), 503, {
+            "Retry-After": str(app.config.get("DB_RETRY_AFTER")),
+        }
+
+    def db_error(e):
+        if not is_db_unavailable(e):
+            # a 500, like any other uncaught error
+            raise e
+        return db_unavailable(e)
+
+    for error in DB_ERRORS:
+        app.register_error_handler(error, db_error)
+    app.register_error_handler(CircuitOpen, db_unavailable)
@@ -0,0 +1,336 @@
+"""Users spread over several databases by a hash of their email
+
+Off unless USER_SHARDS lists the shard databases. Users then live in the
+users tables of the shards, and user_directory in the main db allocates
+their ids and says which shard each one is on:
+
+    id -> shard              by its primary key
+    hash(email) -> shard     by its unique email_hash
+
+so a lookup by id or email is one indexed read of a small directory row
+and one query on the right shard. New users are placed by a jump
+consistent hash of their email, which moves only 1/N of the users when
+an Nth shard is added. `manage.py rebalance_shards` does the moving.
+Listing users queries every shard in parallel and merges their pages.
+
+The directory and the shards are separate databases, so adding a user
+commits its shard row first and its directory row with the caller's
+session. A failure in between leaves a shard row no directory entry
+points at, which rebalance() deletes.
+"""
+import hashlib
+import heapq
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import bindparam, create_engine, or_, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.baked import BakedQuery
+
+from project import bcrypt, db
+from project.api.cache import query_cache
+from project.api.models import User, UserDirectory
+from project.api.resilience import (
+    RouteTimeoutQueuePool, apply_statement_timeout, copy_route_class,
+)
+
+SHARD_BY_ID = BakedQuery(
+    query_cache, lambda session: session.query(UserDirectory.shard)
+)
+SHARD_BY_ID += lambda q: q.filter(UserDirectory.id == bindparam("user_id"))
+
+SHARD_BY_EMAIL_HASH = BakedQuery(
+    query_cache, lambda session: session.query(UserDirectory.shard)
+)
+SHARD_BY_EMAIL_HASH += lambda q: q.filter(
+    UserDirectory.email_hash == bindparam("email_hash")
+)
+
+ID_BY_USERNAME_OR_EMAIL_HASH = BakedQuery(
+    query_cache, lambda session: session.query(UserDirectory.id)
+)
+ID_BY_USERNAME_OR_EMAIL_HASH += lambda q: q.filter(or_(
+    UserDirectory.username_hash == bindparam("username_hash"),
+    UserDirectory.email_hash == bindparam("email_hash"),
+))
+
+
+def name_hash(value):
+    """63 bit hash of an email or username, the same in every process"""
+    if value is None:
+        return None
+    digest = hashlib.blake2b(value.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") >> 1
+
+
+def jump_hash(key, buckets):
+    """The bucket of key, by Lamping and Veach's jump consistent hash"""
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+class ShardSet:
+    """The shard dbs of USER_SHARDS, numbered in the order they are listed"""
+
+    def __init__(self, uris):
+        # records imports this module
+        from project.api.records import USER_RECORD_COLUMNS, UserRecord
+        self.uris = list(uris)
+        self.engines = [self._create_engine(uri) for uri in self.uris]
+        self._record = UserRecord.from_row
+        self._executor = ThreadPoolExecutor(len(self.engines))
+        columns = list(USER_RECORD_COLUMNS)
+        self._by_id = select(columns).where(User.id == bindparam("user_id"))
+        self._by_ids = select(columns).where(
+            User.id.in_(bindparam("user_ids", expanding=True))
+        )
+        self._credentials = select(columns + [User.password]).where(
+            User.email == bindparam("email")
+        )
+        self._newest_first = select(columns).order_by(
+            User.created_at.desc(), User.id.desc()
+        )
+
+    @staticmethod
+    def _create_engine(uri):
+        options = {}
+        if make_url(uri).drivername.startswith("postgresql"):
+            # the checkout timeouts of the main db, see
+            # SQLAlchemy.apply_driver_hacks in project/__init__.py
+            options["poolclass"] = RouteTimeoutQueuePool
+        return create_engine(uri, **options)
+
+    def __len__(self):
+        return len(self.engines)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        for engine in self.engines:
+            engine.dispose()
+
+    def create_schema(self):
+        for engine in self.engines:
+            User.__table__.create(engine, checkfirst=True)
+
+    def placement(self, email):
+        """The shard a user with email is added to"""
+        return jump_hash(name_hash(email), len(self))
+
+    @contextmanager
+    def _connect(self, shard, begin=False):
+        """A connection to shard, in a transaction committed at the end of
+        the block if begin, under the statement timeout of the route class
+        """
+        engine = self.engines[shard]
+        with (engine.begin() if begin else engine.connect()) as connection:
+            apply_statement_timeout(connection)
+            yield connection
+
+    def _fetch(self, shard, statement, **params):
+        with self._connect(shard) as connection:
+            return connection.execute(statement, **params).fetchall()
+
+    def _map(self, function, items):
+        """function(item) for every item, on the executor's threads"""
+        return self._executor.map(copy_route_class(function), items)
+
+    def scatter(self, statement, **params):
+        """The rows of statement from every shard, queried in parallel"""
+        return list(self._map(
+            lambda shard: self._fetch(shard, statement, **params),
+            range(len(self)),
+        ))
+
+    def shard_of(self, user_id):
+        row = SHARD_BY_ID(db.session()).params(user_id=user_id).first()
+        return row[0] if row else None
+
+    def user_row(self, user_id):
+        shard = self.shard_of(user_id)
+        if shard is None:
+            return None
+        rows = self._fetch(shard, self._by_id, user_id=user_id)
+        return rows[0] if rows else None
+
+    def credentials_row(self, email):
+        row = SHARD_BY_EMAIL_HASH(db.session()).params(
+            email_hash=name_hash(email)
+        ).first()
+        if row is None:
+            return None
+        rows = self._fetch(row[0], self._credentials, email=email)
+        return rows[0] if rows else None
+
+    def user_rows(self, user_ids):
+        """The rows of the users that exist, from their shards in parallel"""
+        by_shard = defaultdict(list)
+        for user_id, shard in db.session.query(
+                UserDirectory.id, UserDirectory.shard).filter(
+                UserDirectory.id.in_(user_ids)):
+            by_shard[shard].append(user_id)
+        pages = self._map(
+            lambda item: self._fetch(item[0], self._by_ids, user_ids=item[1]),
+            by_shard.items(),
+        )
+        return [row for rows in pages for row in rows]
+
+    def newest_rows(self, limit=None, offset=0):
+        """Rows of users, newest first, from offset on
+
+        Every shard returns its own first offset + limit rows, which are
+        enough to merge the page from.
+        """
+        statement = self._newest_first
+        if limit is not None:
+            statement = statement.limit(offset + limit)
+        merged = heapq.merge(
+            *self.scatter(statement),
+            key=lambda row: (row[5], row[0]), reverse=True
+        )
+        return list(islice(
+            merged, offset, None if limit is None else offset + limit
+        ))
+
+    def find_user_id(self, username=None, email=None):
+        row = ID_BY_USERNAME_OR_EMAIL_HASH(db.session()).params(
+            username_hash=name_hash(username), email_hash=name_hash(email),
+        ).first()
+        return row[0] if row else None
+
+    def add_user(self, username, email, password):
+        """Add a user to its shard, returns its UserRecord
+
+        The shard row is committed here, the directory row is only
+        flushed and commits with db.session. Unique hashes in the
+        directory keep usernames and emails unique across shards.
+        """
+        if username is None or email is None:
+            raise ValueError("A username and an email are required.")
+        password_hash = bcrypt.generate_password_hash(
+            password, current_app.config.get("BCRYPT_LOG_ROUNDS")
+        ).decode()
+        email_hash = name_hash(email)
+        entry = UserDirectory(
+            email_hash=email_hash,
+            username_hash=name_hash(username),
+            shard=jump_hash(email_hash, len(self)),
+        )
+        db.session.add(entry)
+        db.session.flush()
+        created_at = datetime.utcnow()
+        with self._connect(entry.shard, begin=True) as connection:
+            connection.execute(User.__table__.insert().values(
+                id=entry.id,
+                username=username,
+                email=email,
+                password=password_hash,
+                active=True,
+                admin=False,
+                created_at=created_at,
+            ))
+        return self._record(
+            (entry.id, username, email, True, False, created_at)
+        )
+
+    def rebalance(self, batch_size=1000, stray_grace=600):
+        """Move users to the shards their emails are placed on now, and
+        delete shard rows no directory entry points at
+
+        Rows younger than stray_grace seconds are not deleted, they may
+        belong to a user whose directory row is being committed. Returns
+        (moved, deleted). Run one rebalance at a time.
+        """
+        self.create_schema()
+        cutoff = datetime.utcnow() - timedelta(seconds=stray_grace)
+        # strays first, so copies left by an interrupted move do not
+        # collide with the move being redone
+        deleted = sum(
+            self._delete_strays(shard, cutoff, batch_size)
+            for shard in range(len(self))
+        )
+        moved = 0
+        last_id = 0
+        while True:
+            entries = db.session.query(
+                UserDirectory.id, UserDirectory.email_hash, UserDirectory.shard
+            ).filter(UserDirectory.id > last_id).order_by(
+                UserDirectory.id
+            ).limit(batch_size).all()
+            if not entries:
+                return moved, deleted
+            last_id = entries[-1][0]
+            moves = defaultdict(list)
+            for user_id, email_hash, shard in entries:
+                target = jump_hash(email_hash, len(self))
+                if target != shard:
+                    moves[shard, target].append(user_id)
+            for (source, target), user_ids in sorted(moves.items()):
+                moved += self._move(source, target, user_ids)
+
+    def _move(self, source, target, user_ids):
+        """Copy, repoint, then delete, so a user is never unreachable"""
+        users = User.__table__
+        rows = self._fetch(
+            source, users.select().where(users.c.id.in_(user_ids))
+        )
+        if not rows:
+            return 0
+        with self._connect(target, begin=True) as connection:
+            connection.execute(users.insert(), [dict(row) for row in rows])
+        moved_ids = [row.id for row in rows]
+        db.session.query(UserDirectory).filter(
+            UserDirectory.id.in_(moved_ids)
+        ).update({"shard": target}, synchronize_session=False)
+        db.session.commit()
+        with self._connect(source, begin=True) as connection:
+            connection.execute(users.delete().where(users.c.id.in_(moved_ids)))
+        return len(moved_ids)
+
+    def _delete_strays(self, shard, cutoff, batch_size):
+        users = User.__table__
+        deleted = 0
+        last_id = 0
+        while True:
+            user_ids = [user_id for user_id, in self._fetch(
+                shard,
+                select([users.c.id]).where(
+                    (users.c.id > last_id) & (users.c.created_at < cutoff)
+                ).order_by(users.c.id).limit(batch_size),
+            )]
+            if not user_ids:
+                return deleted
+            last_id = user_ids[-1]
+            here = {user_id for user_id, in db.session.query(
+                UserDirectory.id
+            ).filter(
+                UserDirectory.id.in_(user_ids), UserDirectory.shard == shard
+            )}
+            strays = [user_id for user_id in user_ids if user_id not in here]
+            if strays:
+                with self._connect(shard, begin=True) as connection:
+                    connection.execute(
+                        users.delete().where(users.c.id.in_(strays))
+                    )
+                deleted += len(strays)
+
+
+def get_shards():
+    """The app's ShardSet, None unless USER_SHARDS is set"""
+    uris = current_app.config.get("USER_SHARDS")
+    if not uris:
+        return None
+    shards = current_app.extensions.get("user_shards")
+    if shards is None or shards.uris != list(uris):
+        if shards is not None:
+            shards.close()
+        shards = ShardSet(uris)
+        current_app.extensions["user_shards"] = shards
+    return shards
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+
+
+class SingleFlightTimeout(Exception):
+    """Waited too long on another caller's load"""
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent loads of the same key within a worker
+
+    The first caller for a key runs the load, callers arriving while it
+    is in flight wait for it and share its result or exception. Results
+    are shared between threads, so loads must return immutable values.
+    Works with threads (and monkeypatched green threads) through `do`,
+    and with asyncio through `do_async`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._futures = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def _count(self, coalesced):
+        with self._lock:
+            self.calls += 1
+            if coalesced:
+                self.coalesced += 1
+
+    def do(self, key, load, timeout=None):
+        """load() once for all threads asking for key at the same time"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        self._count(not leader)
+
+        if leader:
+            try:
+                call.result = load()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.event.set()
+            return call.result
+
+        if not call.event.wait(timeout):
+            raise SingleFlightTimeout(key)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def do_async(self, key, load, timeout=None):
+        """await load() once for all tasks of a loop asking for key"""
+        loop = asyncio.get_event_loop()
+        future = self._futures.get((loop, key))
+        self._count(future is not None)
+        if future is not None:
+            try:
+                return await asyncio.wait_for(
+                    asyncio.shield(future), timeout
+                )
+            except asyncio.TimeoutError:
+                raise SingleFlightTimeout(key)
+
+        future = self._futures[(loop, key)] = loop.create_future()
+        try:
+            result = await load()
+        except Exception as e:
+            future.set_exception(e)
+            # only the waiters need to see it
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._futures[(loop, key)]
+
+    def stats(self):
+        return {"calls": self.calls, "coalesced": self.coalesced}
@@ -0,0 +1,219 @@
+"""User counts and signups per day, kept in rollup tables
+
+Every flush that creates, deletes or (de)activates users adds its deltas
+to user_totals and signup_days in the same transaction, so reading the
+stats costs one row plus one row per day asked for, however many users
+there are. rebuild_stats() recomputes both tables from users. Users
+added to shards are counted by project/api/records.py instead.
+"""
+from collections import Counter
+from datetime import timedelta
+
+from sqlalchemy import and_, case, event, func, literal, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from project import db
+from project.api.models import SignupDay, User, UserTotals
+from project.api.shards import get_shards
+
+# the id of the only user_totals row
+TOTALS_ID = 1
+
+
+def user_counts(user):
+    return {
+        "total": 1,
+        "active": 1 if user.active else 0,
+        "admin": 1 if user.admin else 0,
+    }
+
+
+def _changed(user, field):
+    """+1, -1 or 0 as the flag goes on, off or stays"""
+    added, _, deleted = get_history(user, field)
+    if not added or not deleted:
+        return 0
+    return (1 if added[0] else 0) - (1 if deleted[0] else 0)
+
+
+def increment_statements(dialect_name, table, key, deltas):
+    """The statement adding deltas to the row of table with key, and the
+    insert to run when it updated nothing (None if it creates the row)
+    """
+    if dialect_name == "postgresql":
+        insert = postgresql.insert(table).values(**key, **deltas)
+        return insert.on_conflict_do_update(
+            index_elements=list(key),
+            set_={
+                name: table.c[name] + insert.excluded[name]
+                for name in deltas
+            },
+        ), None
+
+    condition = and_(*(
+        table.c[name] == value for name, value in key.items()
+    ))
+    update = table.update().where(condition).values(**{
+        name: table.c[name] + delta for name, delta in deltas.items()
+    })
+    return update, table.insert().values(**key, **deltas)
+
+
+def new_user_increments(dialect_name, user):
+    """increment_statements() counting a user created outside the orm"""
+    return [
+        increment_statements(
+            dialect_name, UserTotals.__table__, {"id": TOTALS_ID},
+            user_counts(user),
+        ),
+        increment_statements(
+            dialect_name, SignupDay.__table__,
+            {"day": user.created_at.date()}, {"signups": 1},
+        ),
+    ]
+
+
+def count_new_user(connection, user):
+    """Count a user created outside the orm"""
+    for statement, insert in new_user_increments(
+            connection.dialect.name, user):
+        if connection.execute(statement).rowcount == 0 and \
+                insert is not None:
+            connection.execute(insert)
+
+
+def _increment(connection, table, key, deltas):
+    """Add deltas to the row of table with key, creating it if needed"""
+    statement, insert = increment_statements(
+        connection.dialect.name, table, key, deltas
+    )
+    if connection.execute(statement).rowcount == 0 and insert is not None:
+        connection.execute(insert)
+
+
+@event.listens_for(Session, "after_flush")
+def update_stats(session, flush_context):
+    totals = Counter()
+    signups = Counter()
+    for user in session.new:
+        if isinstance(user, User):
+            totals.update(user_counts(user))
+            signups[user.created_at.date()] += 1
+    for user in session.deleted:
+        if isinstance(user, User):
+            totals.subtract(user_counts(user))
+            signups[user.created_at.date()] -= 1
+    for user in session.dirty:
+        if isinstance(user, User):
+            totals["active"] += _changed(user, "active")
+            totals["admin"] += _changed(user, "admin")
+
+    totals = {name: delta for name, delta in totals.items() if delta}
+    signups = {day: delta for day, delta in signups.items() if delta}
+    if not totals and not signups:
+        return
+    connection = session.connection()
+    if totals:
+        _increment(
+            connection, UserTotals.__table__, {"id": TOTALS_ID}, totals
+        )
+    for day, delta in sorted(signups.items()):
+        _increment(
+            connection, SignupDay.__table__, {"day": day}, {"signups": delta}
+        )
+
+
+def stats_queries(start, end):
+    """The selects of the totals row and the signups from start to end"""
+    totals = select([
+        UserTotals.total, UserTotals.active, UserTotals.admin
+    ]).where(UserTotals.id == TOTALS_ID)
+    signups = select([SignupDay.day, SignupDay.signups]).where(
+        SignupDay.day.between(start, end)
+    )
+    return totals, signups
+
+
+def format_stats(totals, signups, start, end):
+    """The stats from the rows stats_queries() returned"""
+    totals = totals or (0, 0, 0)
+    signups = dict(signups)
+    days = (end - start).days + 1
+    return {
+        "total": totals[0],
+        "active": totals[1],
+        "admin": totals[2],
+        "signups": [
+            {"day": day.isoformat(), "count": signups.get(day, 0)}
+            for day in (start + timedelta(days=i) for i in range(days))
+        ],
+    }
+
+
+def get_stats(start, end):
+    """Totals, and the signups for every day from start to end"""
+    totals, signups = stats_queries(start, end)
+    return format_stats(
+        db.session.execute(totals).first(),
+        db.session.execute(signups).fetchall(),
+        start, end,
+    )
+
+
+def _count_queries(*totals_prefix):
+    """The selects of the user totals and of the signups per day"""
+    totals = select(list(totals_prefix) + [
+        func.count(User.id),
+        func.coalesce(func.sum(case([(User.active, 1)], else_=0)), 0),
+        func.coalesce(func.sum(case([(User.admin, 1)], else_=0)), 0),
+    ])
+    day = func.date(User.created_at, type_=db.Date)
+    signups = select([day, func.count(User.id)]).group_by(day)
+    return totals, signups
+
+
+def rebuild_stats():
+    """Recompute the rollup tables from users, in one transaction
+
+    With USER_SHARDS, the counts of every shard are added up.
+    """
+    connection = db.session.connection()
+    totals_table = UserTotals.__table__
+    days_table = SignupDay.__table__
+    shards = get_shards()
+    if shards:
+        totals, signups = _count_queries()
+        counts = [0, 0, 0]
+        for rows in shards.scatter(totals):
+            counts = [a + b for a, b in zip(counts, rows[0])]
+        days = Counter()
+        for rows in shards.scatter(signups):
+            days.update(dict(rows))
+        connection.execute(totals_table.delete())
+        connection.execute(days_table.delete())
+        connection.execute(totals_table.insert().values(
+            id=TOTALS_ID, total=counts[0], active=counts[1], admin=counts[2]
+        ))
+        if days:
+            connection.execute(days_table.insert(), [
+                {"day": day, "signups": count}
+                for day, count in sorted(days.items())
+            ])
+        db.session.commit()
+        return
+
+    if connection.dialect.name == "postgresql":
+        # keep users from changing until the new counts are committed
+        connection.execute(text("LOCK TABLE users IN SHARE MODE"))
+    totals, signups = _count_queries(literal(TOTALS_ID))
+    connection.execute(totals_table.delete())
+    connection.execute(days_table.delete())
+    connection.execute(totals_table.insert().from_select(
+        ["id", "total", "active", "admin"], totals,
+    ))
+    connection.execute(days_table.insert().from_select(
+        ["day", "signups"], signups,
+    ))
+    db.session.commit()
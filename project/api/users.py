@@ -1,7 +1,18 @@
-from flask import Blueprint, jsonify, request, render_template
+from datetime import datetime, timedelta
+
+from flask import Blueprint, current_app, jsonify, request, render_template
 from sqlalchemy import exc
 
+from project.api.auth import admin_required
+from project.api.invalidation import get_bus
 from project.api.models import User
+from project.api.outbox import user_registered
+from project.api.records import (
+    add_sharded_user, find_user_id, list_users, load_user, load_users
+)
+from project.api.resilience import db_route
+from project.api.shards import get_shards
+from project.api.stats import get_stats
 from project import db
 
 users_blueprint = Blueprint("users", __name__, template_folder="./templates")
@@ -14,6 +25,7 @@ def ping_pong():
     })
 
 @users_blueprint.route("/users", methods=["POST"])
+@db_route("write")
 def add_user():
     invalid_response = {
         "status": "fail",
@@ -30,8 +42,7 @@ def add_user():
     if email is None or username is None: 
         return jsonify(invalid_response), 400
 
-    user_exists = User.query.filter_by(email=email).first()
-    if user_exists:
+    if find_user_id(email=email) is not None:
         response_object = {
             "status": "fail",
             "message": "Sorry. That email already exists."
@@ -39,8 +50,14 @@ def add_user():
         return jsonify(response_object), 400
 
     try:
-        user = User(username=username, email=email, password=password)
-        db.session.add(user)
+        if get_shards():
+            user = add_sharded_user(username, email, password)
+        else:
+            user = User(username=username, email=email, password=password)
+            db.session.add(user)
+            db.session.flush()
+        get_bus().publish_user_changed(user.id)
+        user_registered(user)
         db.session.commit()
     except (exc.IntegrityError, ValueError) as e:
         db.session.rollback()
@@ -53,7 +70,78 @@ def add_user():
     # 201 response == `created`
     return jsonify(response_object), 201
 
+def stats_range(args):
+    """(start, end) dates of a stats request, or ValueError with the
+    message to answer with
+    """
+    try:
+        end = args.get("to")
+        end = datetime.strptime(end, "%Y-%m-%d").date() if end \
+            else datetime.utcnow().date()
+        start = args.get("from")
+        start = datetime.strptime(start, "%Y-%m-%d").date() if start \
+            else end - timedelta(
+                days=current_app.config.get("USER_STATS_DEFAULT_DAYS") - 1
+            )
+    except ValueError:
+        raise ValueError("Invalid date range.")
+    if start > end:
+        raise ValueError("Invalid date range.")
+    max_days = current_app.config.get("USER_STATS_MAX_DAYS")
+    if (end - start).days + 1 > max_days:
+        raise ValueError(
+            f"Date range too long. The maximum is {max_days} days."
+        )
+    return start, end
+
+def page_args(args):
+    """(limit, offset) of a ?page=&per_page= request, (None, 0) for all
+    users, or ValueError with the message to answer with
+    """
+    if "page" not in args and "per_page" not in args:
+        return None, 0
+    max_per_page = current_app.config.get("USERS_MAX_PER_PAGE")
+    try:
+        page = int(args.get("page", 1))
+        per_page = int(
+            args.get("per_page", current_app.config.get("USERS_PER_PAGE"))
+        )
+    except ValueError:
+        raise ValueError("Invalid page.")
+    if page < 1 or per_page < 1:
+        raise ValueError("Invalid page.")
+    if per_page > max_per_page:
+        raise ValueError(
+            f"Page too large. The maximum is {max_per_page} users."
+        )
+    return per_page, (page - 1) * per_page
+
+@users_blueprint.route("/users/stats", methods=["GET"])
+@db_route("read")
+@admin_required
+def get_user_stats():
+    """User totals and signups per day, from the rollup tables
+
+    ?from=YYYY-MM-DD&to=YYYY-MM-DD, both included. Defaults to the last
+    USER_STATS_DEFAULT_DAYS days.
+    """
+    try:
+        start, end = stats_range(request.args)
+    except ValueError as e:
+        response_object = {
+            "status": "fail",
+            "message": str(e),
+        }
+        return jsonify(response_object), 400
+
+    response_object = {
+        "status": "success",
+        "data": get_stats(start, end),
+    }
+    return jsonify(response_object), 200
+
 @users_blueprint.route("/users/<user_id>", methods=["GET"])
+@db_route("read")
 def get_single_user(user_id):
     """Get single user details"""
 
@@ -66,33 +154,37 @@ def get_single_user(user_id):
     except ValueError:
         return jsonify(response_object), 404
 
-    user = User.query.filter_by(id=user_id).first()
+    user = load_user(user_id)
     if not user:
         return jsonify(response_object), 404
 
     del response_object["message"]
     response_object.update({
         "status": "success",
-        "data": {
-            "username": user.username,
-            "email": user.email,
-            "created_at": user.created_at,
-        }
+        "data": user.to_dict("username", "email", "created_at"),
     })
     return jsonify(response_object), 200
 
 @users_blueprint.route("/users", methods=["GET"])
+@db_route("read")
 def get_all_users():
-    """Get all users"""
-    users = User.query.order_by(User.created_at.desc()).all()
-    users_list = []
-    for user in users:
-        users_list.append({
-            "id": user.id,
-            "username": user.username,
-            "email": user.email,
-            "created_at": user.created_at,
-        })
+    """Get all users, newest first, or a page of them"""
+    if "ids" in request.args:
+        return lookup_users(request.args["ids"])
+
+    try:
+        limit, offset = page_args(request.args)
+    except ValueError as e:
+        response_object = {
+            "status": "fail",
+            "message": str(e),
+        }
+        return jsonify(response_object), 400
+
+    users_list = [
+        user.to_dict("id", "username", "email", "created_at")
+        for user in list_users(limit, offset)
+    ]
 
     response_object = {
         "status": "success",
@@ -100,4 +192,42 @@ def get_all_users():
             "users": users_list
         },
     }
-    return jsonify(response_object), 200
\ No newline at end of file
+    return jsonify(response_object), 200
+
+def lookup_users(ids_arg):
+    """Get the users for a comma separated list of ids in one query"""
+    response_object = {
+        "status": "fail",
+        "message": "Invalid payload."
+    }
+    try:
+        user_ids = [int(user_id) for user_id in ids_arg.split(",")]
+    except ValueError:
+        return jsonify(response_object), 400
+
+    max_ids = current_app.config.get("USERS_LOOKUP_MAX_IDS")
+    if len(user_ids) > max_ids:
+        response_object["message"] = f"Too many ids. The maximum is {max_ids}."
+        return jsonify(response_object), 400
+
+    users_by_id = load_users(user_ids)
+    users_list = []
+    missing = []
+    for user_id in user_ids:
+        user = users_by_id.get(user_id)
+        if not user:
+            missing.append(user_id)
+            continue
+        users_list.append(
+            user.to_dict("id", "username", "email", "created_at")
+        )
+
+    del response_object["message"]
+    response_object.update({
+        "status": "success",
+        "data": {
+            "users": users_list,
+            "missing": missing,
+        },
+    })
+    return jsonify(response_object), 200
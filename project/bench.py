@@ -0,0 +1,273 @@
+"""Micro-benchmarks run through manage.py"""
+import asyncio
+import gc
+import json
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import create_engine, or_
+from sqlalchemy.orm import Session
+
+from project.api.models import User
+from project.api.records import (
+    CREDENTIALS_BY_EMAIL, USER_BY_ID, USER_ID_BY_USERNAME_OR_EMAIL,
+    USER_RECORD_COLUMNS, UserRecord, query_cache,
+)
+from project.loadgen import Target, percentile
+from project.logs import AsyncLogWriter
+
+# a bcrypt hash is what a loaded User carries around
+PASSWORD_HASH = "$2b$13$" + "x" * 53
+
+
+def _measure(build):
+    """Bytes allocated and still held by what build() returns"""
+    gc.collect()
+    tracemalloc.start()
+    kept = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    gc.collect()
+    return size
+
+
+def _rows(count):
+    now = datetime.utcnow()
+    return [
+        (i, f"user{i}", f"user{i}@example.com", True, False, now)
+        for i in range(count)
+    ]
+
+
+def _orm_users(rows):
+    """Detached Users as the orm would load them, without bcrypt"""
+    manager = User.__mapper__.class_manager
+    users = []
+    for user_id, username, email, active, admin, created_at in rows:
+        user = manager.new_instance()
+        user.id = user_id
+        user.username = username
+        user.email = email
+        user.password = PASSWORD_HASH
+        user.active = active
+        user.admin = admin
+        user.created_at = created_at
+        users.append(user)
+    return users
+
+
+def bench_records(count):
+    """Memory per user of User instances against UserRecords"""
+    rows = _rows(count)
+    results = {
+        "User": _measure(lambda: _orm_users(rows)),
+        "UserRecord": _measure(
+            lambda: [UserRecord.from_row(row) for row in rows]
+        ),
+    }
+    for name, size in results.items():
+        print(f"{name:<12} {size / count:8.0f} bytes/user "
+              f"{size / 2 ** 20:10.1f} MiB for {count} users")
+    print(f"UserRecord is {results['User'] / results['UserRecord']:.1f}x "
+          "smaller")
+    return results
+
+
+def _time_calls(call, records):
+    """Mean and p99 microseconds per call"""
+    timings = []
+    for record in records:
+        started = time.perf_counter()
+        call(record)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return (
+        sum(timings) / len(timings) * 1e6,
+        timings[int(len(timings) * 0.99)] * 1e6,
+    )
+
+
+class _SyncLogWriter:
+    """Writes every record on the request path, what the access log would
+    cost without AsyncLogWriter
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def emit(self, record):
+        self.stream.write(json.dumps(record, default=str) + "\n")
+        self.stream.flush()
+
+
+def bench_logging(count):
+    """Round trip of a request without an access log, with a synchronous
+    json log write, and with the AsyncLogWriter
+    """
+    app = current_app._get_current_object()
+    client = app.test_client()
+    config = {
+        key: app.config.get(key)
+        for key in ("ACCESS_LOG", "ACCESS_LOG_SAMPLE_RATES")
+    }
+    writer = app.extensions.pop("log_writer", None)
+    results = {}
+    try:
+        # log every request, to a route that does no db work
+        app.config["ACCESS_LOG_SAMPLE_RATES"] = {}
+        app.config["ACCESS_LOG"] = None
+        results["no log"] = _time_calls(
+            lambda i: client.get("/ping"), range(count)
+        )
+        app.config["ACCESS_LOG"] = "bench"
+        with tempfile.TemporaryFile("w") as stream:
+            app.extensions["log_writer"] = _SyncLogWriter(stream)
+            results["sync write"] = _time_calls(
+                lambda i: client.get("/ping"), range(count)
+            )
+        with tempfile.TemporaryFile("w") as stream:
+            queued = app.extensions["log_writer"] = AsyncLogWriter(
+                stream, max_queue=count
+            )
+            results["async buffer"] = _time_calls(
+                lambda i: client.get("/ping"), range(count)
+            )
+            queued.flush(timeout=60)
+    finally:
+        app.config.update(config)
+        app.extensions.pop("log_writer", None)
+        if writer is not None:
+            app.extensions["log_writer"] = writer
+
+    for name, (mean, p99) in results.items():
+        print(f"{name:<12} mean {mean:7.2f}us  p99 {p99:7.2f}us")
+    print(f"async buffer written {queued.written} dropped {queued.dropped}")
+    return results
+
+
+def _cpu_per_call(call, count):
+    """Mean microseconds of cpu per call"""
+    call(0)
+    started = time.process_time()
+    for i in range(count):
+        call(i)
+    return (time.process_time() - started) / count * 1e6
+
+
+def bench_queries(count):
+    """Cpu per lookup of the hot user queries, built and compiled per call
+    as the views used to, against the baked queries of records.py
+    """
+    engine = create_engine("sqlite://")
+    User.__table__.create(engine)
+    engine.execute(User.__table__.insert(), [{
+        "username": f"user{i}",
+        "email": f"user{i}@example.com",
+        "password": PASSWORD_HASH,
+        "active": True,
+        "admin": False,
+        "created_at": datetime.utcnow(),
+    } for i in range(1, 101)])
+    session = Session(bind=engine)
+
+    lookups = {
+        "by id": (
+            lambda i: session.query(*USER_RECORD_COLUMNS).filter(
+                User.id == i % 100 + 1
+            ).first(),
+            lambda i: USER_BY_ID(session).params(
+                user_id=i % 100 + 1
+            ).first(),
+        ),
+        "by email": (
+            lambda i: session.query(
+                *USER_RECORD_COLUMNS, User.password
+            ).filter(User.email == f"user{i % 100}@example.com").first(),
+            lambda i: CREDENTIALS_BY_EMAIL(session).params(
+                email=f"user{i % 100}@example.com"
+            ).first(),
+        ),
+        "username or email": (
+            lambda i: session.query(User.id).filter(or_(
+                User.username == f"user{i % 100}",
+                User.email == f"user{i % 100}@example.com",
+            )).first(),
+            lambda i: USER_ID_BY_USERNAME_OR_EMAIL(session).params(
+                username=f"user{i % 100}",
+                email=f"user{i % 100}@example.com",
+            ).first(),
+        ),
+    }
+    results = {}
+    for name, (built, baked) in lookups.items():
+        results[name] = (
+            _cpu_per_call(built, count), _cpu_per_call(baked, count)
+        )
+        print(f"{name:<18} built {results[name][0]:7.1f}us  "
+              f"baked {results[name][1]:7.1f}us  "
+              f"{results[name][0] / results[name][1]:.1f}x")
+    stats = query_cache.stats()
+    print(f"query cache hits {stats['hits']} misses {stats['misses']}")
+    session.close()
+    return results
+
+
+async def _closed_loop(target, paths, concurrency, duration):
+    """Latencies and errors of concurrency clients, each sending its next
+    request as soon as the last one is answered
+    """
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client(offset):
+        nonlocal errors
+        i = offset
+        while time.perf_counter() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            started = time.perf_counter()
+            try:
+                status, _ = await target.send(
+                    "GET", path, token=target.auth_token
+                )
+            except OSError:
+                status = None
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors += 1
+
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    return latencies, errors
+
+
+async def _bench_server(url, email, password, concurrency, duration):
+    target = Target(url, email, password)
+    await target.login()
+    _, body = await target.send("GET", "/auth/status", token=target.auth_token)
+    user_id = json.loads(body)["data"]["id"]
+    paths = ["/auth/status", f"/users/{user_id}"]
+    return await _closed_loop(target, paths, concurrency, duration)
+
+
+def bench_servers(urls, email, password, concurrency, duration):
+    """Throughput and latency of running instances, e.g. the gunicorn and
+    the runserver_async deployments, under the same closed loop load of
+    /auth/status and /users/<id>
+    """
+    loop = asyncio.get_event_loop()
+    results = {}
+    for url in urls:
+        latencies, errors = loop.run_until_complete(_bench_server(
+            url, email, password, concurrency, duration
+        ))
+        results[url] = latencies, errors
+        print(f"{url:<28} {len(latencies) / duration:8.1f} req/s  "
+              f"p50 {percentile(latencies, 50) * 1000:7.1f}ms  "
+              f"p99 {percentile(latencies, 99) * 1000:7.1f}ms  "
+              f"errors {errors}")
+    return results
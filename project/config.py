@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 class BaseConfig:
     """Base configuration"""
@@ -9,6 +10,93 @@ class BaseConfig:
     BCRYPT_LOG_ROUNDS = 13
     TOKEN_EXPIRATION_DAYS = 30
     TOKEN_EXPIRATION_SECONDS = 0
+    REFRESH_TOKEN_EXPIRATION_DAYS = 30
+    # HS256/384/512 sign with SECRET_KEY. RS* and ES* sign with the key
+    # JWT_SIGNING_KID from JWT_KEYS_DIR and publish every key in the dir
+    # at /.well-known/jwks.json
+    JWT_ALGORITHM = os.environ.get("JWT_ALGORITHM", "HS256")
+    JWT_KEYS_DIR = os.environ.get("JWT_KEYS_DIR")
+    JWT_SIGNING_KID = os.environ.get("JWT_SIGNING_KID")
+    JWKS_MAX_AGE = 3600
+    # answer /auth/status from the access token claims instead of the db.
+    # profile changes show up once the access token is refreshed, so keep
+    # TOKEN_EXPIRATION_* short when this is on
+    AUTH_STATUS_FROM_CLAIMS = False
+    USERS_LOOKUP_MAX_IDS = 100
+    USERS_PER_PAGE = 20
+    USERS_MAX_PER_PAGE = 100
+    AUTH_INTROSPECT_MAX_TOKENS = 100
+    USER_STATS_DEFAULT_DAYS = 30
+    USER_STATS_MAX_DAYS = 366
+    # per route class, statement timeouts in ms (postgres only) and pool
+    # checkout timeouts in seconds. timeouts answer 503 with Retry-After
+    DB_STATEMENT_TIMEOUTS = {"read": 2000, "write": 5000, "auth": 3000}
+    DB_CHECKOUT_TIMEOUTS = {"read": 1, "write": 3, "auth": 2}
+    DB_RETRY_AFTER = 5
+    # shed db bound requests after this many failures in a row, until a
+    # background probe of the db succeeds
+    DB_CIRCUIT_BREAKER = False
+    DB_CIRCUIT_BREAKER_THRESHOLD = 5
+    DB_CIRCUIT_BREAKER_RESET_SECONDS = 5
+    # seconds a worker caches a user for, 0 turns the cache off. with more
+    # than one worker use the postgres INVALIDATION_BUS so writes on one
+    # worker drop stale entries on all of them
+    USER_CACHE_TTL = 0
+    INVALIDATION_BUS = os.environ.get("INVALIDATION_BUS", "memory")
+    # seconds a message missing from the bus's sequence may still arrive
+    # in, before the worker resyncs its caches
+    INVALIDATION_GAP_WAIT = 2
+    # seconds to wait on another request's load of the same user
+    SINGLE_FLIGHT_TIMEOUT = 5
+    # json access and audit log file, "-" for stdout. records go through
+    # a bounded queue to a background writer, see project/logs.py
+    ACCESS_LOG = os.environ.get("ACCESS_LOG")
+    ACCESS_LOG_SAMPLE_RATES = {"/auth/status": 0.1, "/ping": 0.01}
+    LOG_QUEUE_SIZE = 10000
+    LOG_BATCH_SIZE = 256
+    LOG_FLUSH_INTERVAL = 0.5
+    # user events go to the outbox_events table and are delivered by
+    # `manage.py dispatch_outbox`, see project/api/outbox.py
+    OUTBOX_SINK = os.environ.get("OUTBOX_SINK", "file")
+    OUTBOX_FILE = os.environ.get("OUTBOX_FILE", "outbox.jsonl")
+    OUTBOX_BATCH_SIZE = 100
+    OUTBOX_MAX_ATTEMPTS = 10
+    # seconds, doubled on every failed attempt
+    OUTBOX_BACKOFF = 1
+    OUTBOX_MAX_BACKOFF = 600
+    OUTBOX_POLL_INTERVAL = 1
+    OUTBOX_RETENTION_DAYS = 7
+    # run migrations without long locks on live tables, see
+    # project/online_migrations.py. also `db upgrade -x online=1`
+    ONLINE_MIGRATIONS = os.environ.get("ONLINE_MIGRATIONS") == "1"
+    MIGRATION_LOCK_TIMEOUT = 2000
+    MIGRATION_LOCK_RETRIES = 10
+    MIGRATION_BACKFILL_BATCH_SIZE = 1000
+    MIGRATION_BACKFILL_PAUSE = 0.1
+    # `manage.py runserver_async`, see project/aio
+    ASYNC_DB_POOL_SIZE = 10
+    ASYNC_BCRYPT_WORKERS = 4
+    # keep users in these dbs (space separated uris) instead of the main
+    # one, placed by a hash of their email. see project/api/shards.py
+    USER_SHARDS = os.environ.get("USER_SHARDS", "").split()
+    SHARD_REBALANCE_BATCH_SIZE = 1000
+    # seconds before rebalance_shards deletes a shard row that no
+    # directory entry points at
+    SHARD_STRAY_GRACE = 600
+    # sampling profiles of live requests, started through POST
+    # /admin/profile. seconds between samples and the longest window
+    PROFILER_INTERVAL = 0.005
+    PROFILER_MAX_DURATION = 600
+    # shared by the workers of a host: the running profile, and what each
+    # worker sampled of it. seconds between a worker's looks at the
+    # running profile, and between saves of its samples
+    PROFILER_DIR = os.environ.get(
+        "PROFILER_DIR", os.path.join(tempfile.gettempdir(), "users-profiles")
+    )
+    PROFILER_POLL_INTERVAL = 1
+    PROFILER_SAVE_INTERVAL = 1
+    # append every request to this file, see project/loadgen.py
+    TRAFFIC_CAPTURE_PATH = os.environ.get("TRAFFIC_CAPTURE_PATH")
 
 class DevelopmentConfig(BaseConfig):
     """Development configuration"""
@@ -0,0 +1,329 @@
+"""Record the request mix the service sees and replay it open-loop
+
+Traffic is recorded either with the capture hook (TRAFFIC_CAPTURE_PATH)
+or by converting a gunicorn access log. Each record is one json line
+with the method, the route rule and the concrete path. Replay sends
+requests from that mix at fixed arrival rates, whether or not earlier
+requests have finished, and reports latency and errors per route.
+Logouts are left out of the mix: they would revoke the token every other
+replayed request uses.
+"""
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+from flask import request
+
+# routes not replayed
+SKIPPED_ROUTES = ("/auth/logout",)
+
+# gunicorn's default access log format
+ACCESS_LOG_RE = re.compile(
+    r'^\S+ \S+ \S+ \[[^\]]+\] "(?P<method>[A-Z]+) (?P<path>\S+) [^"]*" '
+    r'(?P<status>\d{3}) '
+)
+
+
+def init_capture(app):
+    """Append every request to TRAFFIC_CAPTURE_PATH when it is set"""
+    lock = threading.Lock()
+
+    @app.after_request
+    def capture_request(response):
+        path = app.config.get("TRAFFIC_CAPTURE_PATH")
+        if path and request.url_rule is not None:
+            record = json.dumps({
+                "ts": time.time(),
+                "method": request.method,
+                "route": request.url_rule.rule,
+                "path": request.full_path.rstrip("?"),
+                "status": response.status_code,
+            })
+            with lock, open(path, "a") as f:
+                f.write(record + "\n")
+        return response
+
+
+def parse_access_log(app, lines):
+    """Turn access log lines into capture records"""
+    adapter = app.url_map.bind("localhost")
+    records = []
+    for line in lines:
+        match = ACCESS_LOG_RE.match(line)
+        if not match:
+            continue
+        method, path = match.group("method"), match.group("path")
+        try:
+            rule, _ = adapter.match(
+                urlsplit(path).path, method, return_rule=True
+            )
+        except Exception:
+            # not one of our routes
+            continue
+        records.append({
+            "method": method,
+            "route": rule.rule,
+            "path": path,
+            "status": int(match.group("status")),
+        })
+    return records
+
+
+def load_capture(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of values"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(pct / 100 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class Target:
+    """The instance being replayed against, with the credentials to use"""
+
+    def __init__(self, url, email=None, password=None):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.email = email
+        self.password = password
+        self.auth_token = None
+        self.refresh_token = None
+
+    async def login(self):
+        if not self.email:
+            return
+        status, body = await self.send("POST", "/auth/login", {
+            "email": self.email,
+            "password": self.password,
+        })
+        if status != 200:
+            raise RuntimeError(f"Could not log in as {self.email}: {status}")
+        data = json.loads(body)
+        self.auth_token = data["auth_token"]
+        self.refresh_token = data.get("refresh_token")
+
+    def build_request(self, record):
+        """The headers token and json body to send for a recorded request"""
+        route = record["route"]
+        token = self.auth_token
+        body = None
+        if route == "/auth/login":
+            body = {"email": self.email, "password": self.password}
+        elif route in ("/auth/register", "/users") and \
+                record["method"] == "POST":
+            name = uuid.uuid4().hex[:16]
+            body = {
+                "username": name,
+                "email": f"{name}@loadgen.example.com",
+                "password": name,
+            }
+        elif route == "/auth/refresh":
+            token = self.refresh_token
+        elif route == "/auth/introspect":
+            body = {"tokens": [self.auth_token]}
+        return token, body
+
+    async def send(self, method, path, body=None, token=None):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            payload = json.dumps(body).encode() if body is not None else b""
+            headers = [
+                f"{method} {path} HTTP/1.1",
+                f"Host: {self.host}:{self.port}",
+                "Connection: close",
+                f"Content-Length: {len(payload)}",
+            ]
+            if body is not None:
+                headers.append("Content-Type: application/json")
+            if token:
+                headers.append(f"Authorization: Bearer {token}")
+            writer.write(
+                ("\r\n".join(headers) + "\r\n\r\n").encode() + payload
+            )
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        head, _, body = response.partition(b"\r\n\r\n")
+        status = int(head.split(b" ", 2)[1])
+        return status, body
+
+
+class StepResult:
+    """Latencies and errors per route for one offered rate"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.counts = defaultdict(int)
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        # arrivals not sent, as max_in_flight requests were outstanding
+        self.dropped = defaultdict(int)
+        self.arrivals = 0
+        self.completed = 0
+        # seconds requests were sent for, and until the last one finished
+        self.send_window = 0
+        self.elapsed = 0
+
+    def record(self, route, latency, ok):
+        """Count a request that was sent"""
+        self.counts[route] += 1
+        self.latencies[route].append(latency)
+        if ok:
+            self.completed += 1
+        else:
+            self.errors[route] += 1
+
+    def drop(self, route):
+        """Count an arrival the client did not send"""
+        self.dropped[route] += 1
+
+    @property
+    def throughput(self):
+        return self.completed / self.elapsed if self.elapsed else 0
+
+    @property
+    def offered(self):
+        """The arrival rate actually offered, rather than the nominal one"""
+        return self.arrivals / self.send_window if self.send_window else 0
+
+    def error_rate(self, route=None):
+        routes = [route] if route else list(self.counts)
+        total = sum(self.counts[r] for r in routes)
+        errors = sum(self.errors[r] for r in routes)
+        return errors / total if total else 0
+
+    def p99(self, route):
+        return percentile(self.latencies[route], 99)
+
+    def report(self):
+        lines = [
+            f"offered {self.rate}/s ({self.offered:.1f}/s sent), "
+            f"completed {self.throughput:.1f}/s, "
+            f"errors {self.error_rate():.1%}, "
+            f"dropped by the client {sum(self.dropped.values())}"
+        ]
+        for route in sorted(self.counts):
+            pcts = [
+                percentile(self.latencies[route], pct) for pct in (50, 90, 99)
+            ]
+            lines.append(
+                "  {:<24} n={:<6} {} errors={:.1%} dropped={}".format(
+                    route, self.counts[route],
+                    " ".join(
+                        f"p{pct}=" + ("-" if value is None else
+                                      f"{value * 1000:.1f}ms")
+                        for pct, value in zip((50, 90, 99), pcts)
+                    ),
+                    self.error_rate(route),
+                    self.dropped[route],
+                )
+            )
+        return "\n".join(lines)
+
+
+def find_saturation(steps, latency_factor=2, max_error_rate=0.01):
+    """The first step and route where the service stops keeping up
+
+    A step is saturated when it completes under 90% of the rate its
+    arrivals were sent at, or a route's error rate or p99 grows past the
+    thresholds compared to the first step. The route reported is the one
+    that degraded most.
+    return: (StepResult, route)|None
+    """
+    if not steps:
+        return None
+    baseline = steps[0]
+    for step in steps[1:]:
+        worst, worst_factor = None, 0
+        for route in step.counts:
+            if step.error_rate(route) > max_error_rate:
+                return step, route
+            base_p99 = baseline.p99(route)
+            if base_p99 and step.p99(route) is not None:
+                factor = step.p99(route) / base_p99
+                if factor > worst_factor:
+                    worst, worst_factor = route, factor
+        if worst_factor > latency_factor or \
+                step.throughput < 0.9 * step.offered:
+            return step, worst
+    return None
+
+
+async def _request(target, record, result):
+    token, body = target.build_request(record)
+    started = time.perf_counter()
+    try:
+        status, _ = await target.send(
+            record["method"], record["path"], body, token
+        )
+        ok = status < 500
+    except (OSError, ValueError, IndexError):
+        ok = False
+    result.record(record["route"], time.perf_counter() - started, ok)
+
+
+async def run_step(target, records, rate, duration, max_in_flight=1000):
+    """Send requests at `rate` per second for `duration` seconds
+
+    Arrivals are poisson distributed and do not wait for responses. When
+    max_in_flight requests are outstanding new arrivals are dropped by
+    the client, and counted apart from the errors of the service.
+    """
+    result = StepResult(rate)
+    in_flight = set()
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    next_arrival = started
+    while next_arrival < started + duration:
+        delay = next_arrival - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        record = random.choice(records)
+        result.arrivals += 1
+        if len(in_flight) >= max_in_flight:
+            result.drop(record["route"])
+        else:
+            task = loop.create_task(_request(target, record, result))
+            task.add_done_callback(in_flight.discard)
+            in_flight.add(task)
+        next_arrival += random.expovariate(rate)
+    result.send_window = max(duration, loop.time() - started)
+    if in_flight:
+        await asyncio.wait(in_flight)
+    result.elapsed = loop.time() - started
+    return result
+
+
+async def replay(target, records, rates, duration):
+    skipped = len(records)
+    records = [r for r in records if r["route"] not in SKIPPED_ROUTES]
+    skipped -= len(records)
+    if skipped:
+        print(f"Left {skipped} requests to {', '.join(SKIPPED_ROUTES)} "
+              "out of the mix")
+    await target.login()
+    steps = []
+    for rate in rates:
+        step = await run_step(target, records, rate, duration)
+        print(step.report())
+        steps.append(step)
+    saturation = find_saturation(steps)
+    if saturation:
+        step, route = saturation
+        print(f"Saturation starts at {step.rate}/s on {route}")
+    else:
+        print("No saturation at the offered rates")
+    return steps
@@ -0,0 +1,182 @@
+"""Structured json access and audit logs, written off the request path
+
+Requests only build a small dict and append it to a bounded buffer. A
+background thread serializes and writes the records in batches. When the
+buffer is full the record is dropped and counted instead of blocking the
+request. Access logs of high volume routes can be sampled with
+ACCESS_LOG_SAMPLE_RATES; audit records are never sampled. When the process
+exits, the records still buffered are written before it does.
+"""
+import atexit
+import json
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+from flask import current_app, g, request
+
+# how long an exiting process waits for the buffered records to be written
+CLOSE_TIMEOUT = 5
+
+
+class AsyncLogWriter:
+    """Writes json records to a stream from a background thread
+
+    emit() is a length check and a deque append under a lock held for
+    nothing else. The writer thread wakes every flush_interval and drains
+    the buffer in batches of batch_size, and once more when it is closed,
+    which happens at exit.
+    """
+
+    def __init__(self, stream, max_queue=10000, batch_size=256,
+                 flush_interval=0.5):
+        self.stream = stream
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self._failed = 0
+        self._buffer = deque()
+        self._thread = None
+        self._closing = threading.Event()
+        self._lock = threading.Lock()
+        # guards the buffer length check and the counters
+        self._count_lock = threading.Lock()
+
+    def emit(self, record):
+        """Buffer a record without blocking, dropping it if the buffer is
+        full
+        """
+        if self._thread is None:
+            self._start()
+        with self._count_lock:
+            if (len(self._buffer) >= self.max_queue or
+                    self._closing.is_set()):
+                self.dropped += 1
+                return
+            self._buffer.append(record)
+            self.queued += 1
+
+    def flush(self, timeout=None):
+        """Wait until everything buffered so far is written, for at most
+        timeout seconds. Returns whether it was
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        queued = self.queued
+        while self.written + self._failed < queued:
+            if not self._thread.is_alive():
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.flush_interval / 10)
+        return True
+
+    def close(self, timeout=None):
+        """Write what is buffered and stop the writer thread, waiting for
+        at most timeout seconds. Records emitted afterwards are dropped.
+        Returns whether everything was written
+        """
+        self._closing.set()
+        with self._lock:
+            thread = self._thread
+        if thread is None:
+            return True
+        thread.join(timeout)
+        return not thread.is_alive()
+
+    def _start(self):
+        with self._lock:
+            # started lazily so every forked worker gets its own thread,
+            # and its own exit handler
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+                atexit.register(self.close, CLOSE_TIMEOUT)
+
+    def _run(self):
+        while not self._closing.wait(self.flush_interval):
+            self._drain()
+        self._drain()
+
+    def _drain(self):
+        while self._buffer:
+            batch = []
+            while self._buffer and len(batch) < self.batch_size:
+                batch.append(self._buffer.popleft())
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self.stream.write("".join(
+                json.dumps(record, default=str) + "\n" for record in batch
+            ))
+            self.stream.flush()
+        except Exception:
+            with self._count_lock:
+                self._failed += len(batch)
+                self.dropped += len(batch)
+        else:
+            with self._count_lock:
+                self.written += len(batch)
+
+
+def get_log_writer():
+    """The app's AsyncLogWriter, None when ACCESS_LOG is not set"""
+    app = current_app._get_current_object()
+    path = app.config.get("ACCESS_LOG")
+    if not path:
+        return None
+    writer = app.extensions.get("log_writer")
+    if writer is None:
+        stream = sys.stdout if path == "-" else open(path, "a")
+        writer = AsyncLogWriter(
+            stream,
+            app.config.get("LOG_QUEUE_SIZE"),
+            app.config.get("LOG_BATCH_SIZE"),
+            app.config.get("LOG_FLUSH_INTERVAL"),
+        )
+        app.extensions["log_writer"] = writer
+    return writer
+
+
+def audit(event, **fields):
+    """Log an audit event, like a login or a registration"""
+    writer = get_log_writer()
+    if writer is not None:
+        fields.update({"type": "audit", "event": event, "ts": time.time()})
+        writer.emit(fields)
+
+
+def init_access_log(app):
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def log_request(response):
+        writer = get_log_writer()
+        if writer is None or request.url_rule is None:
+            return response
+        route = request.url_rule.rule
+        rate = app.config.get("ACCESS_LOG_SAMPLE_RATES").get(route, 1)
+        if rate < 1 and random.random() >= rate:
+            return response
+        writer.emit({
+            "type": "access",
+            "ts": time.time(),
+            "method": request.method,
+            "route": route,
+            "path": request.path,
+            "status": response.status_code,
+            "duration_ms": round(
+                (time.perf_counter() - g.request_started) * 1000, 3
+            ),
+            "remote_addr": request.remote_addr,
+            "sample_rate": rate,
+        })
+        return response
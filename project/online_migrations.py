@@ -0,0 +1,220 @@
+"""Helpers for migrations that run while the app keeps serving traffic
+
+In online mode migrations/env.py runs every statement on postgres in
+autocommit with a short lock_timeout. A step that waits on a lock held by
+a long transaction gives up quickly instead of blocking every query on
+the table queued up behind it, and is retried with backoff. Indexes are
+built CONCURRENTLY, unique constraints are added from those indexes, and
+backfills update a batch of rows at a time with a pause in between.
+
+Otherwise the helpers fall back to the plain alembic ops, run in the
+migration's transaction.
+
+A migration that fails halfway in online mode is not rolled back, so
+steps must be safe to run again.
+"""
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+from alembic import op
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger("alembic.online")
+
+# lock_not_available, raised when lock_timeout runs out
+LOCK_NOT_AVAILABLE = "55P03"
+
+settings = {
+    "online": False,
+    "lock_timeout": 2000,
+    "lock_retries": 10,
+    "lock_retry_wait": 0.5,
+    "backfill_batch_size": 1000,
+    "backfill_pause": 0.1,
+}
+
+# (step, seconds) of every step run so far
+timings = []
+
+
+def configure(**options):
+    """Called by migrations/env.py before the migrations run"""
+    unknown = set(options) - set(settings)
+    if unknown:
+        raise ValueError(f"unknown options: {', '.join(sorted(unknown))}")
+    settings.update(options)
+    del timings[:]
+
+
+def is_online():
+    """Online mode, against a live postgres db (not --sql)"""
+    context = op.get_context()
+    return (
+        settings["online"]
+        and not context.as_sql
+        and context.dialect.name == "postgresql"
+    )
+
+
+@contextmanager
+def step(name):
+    """Time a step of a migration and log how long it took"""
+    logger.info("%s ...", name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        timings.append((name, elapsed))
+        logger.info("%s took %.3fs", name, elapsed)
+
+
+def report():
+    """Log the time of every step, slowest first"""
+    if not timings:
+        return
+    logger.info("migration steps, slowest first:")
+    for name, elapsed in sorted(timings, key=lambda t: -t[1]):
+        logger.info("  %8.3fs  %s", elapsed, name)
+    logger.info("  %8.3fs  total", sum(elapsed for _, elapsed in timings))
+
+
+def _execute(sql, **params):
+    return op.get_bind().execute(text(sql), **params)
+
+
+def with_lock_timeout(name, run):
+    """Call run() in its own transaction, retrying when it can not get
+    its locks within lock_timeout
+    """
+    with step(name):
+        if not is_online():
+            run()
+            return
+        retries = settings["lock_retries"]
+        for attempt in range(retries + 1):
+            _execute("BEGIN")
+            try:
+                _execute(
+                    f"SET LOCAL lock_timeout = {settings['lock_timeout']:d}"
+                )
+                run()
+                _execute("COMMIT")
+                return
+            except OperationalError as e:
+                _execute("ROLLBACK")
+                if getattr(e.orig, "pgcode", None) != LOCK_NOT_AVAILABLE:
+                    raise
+                if attempt == retries:
+                    raise
+                wait = settings["lock_retry_wait"] * 2 ** attempt
+                wait *= random.uniform(0.5, 1.5)
+                logger.warning(
+                    "%s: lock timeout, retry %d/%d in %.2fs",
+                    name, attempt + 1, retries, wait,
+                )
+                time.sleep(wait)
+
+
+def create_index(name, table, columns, unique=False):
+    """CREATE INDEX CONCURRENTLY when online, op.create_index otherwise"""
+    if not is_online():
+        with step(f"create index {name}"):
+            op.create_index(name, table, columns, unique=unique)
+        return
+
+    with step(f"create index {name} concurrently"):
+        # a concurrent build that failed leaves an invalid index behind
+        invalid = _execute(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND NOT i.indisvalid",
+            name=name,
+        ).scalar()
+        if invalid:
+            _execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        # the build waits for every transaction older than itself, which
+        # lock_timeout would cut short
+        _execute("SET lock_timeout = 0")
+        try:
+            _execute(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY "
+                f"IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+            )
+        finally:
+            _execute(f"SET lock_timeout = {settings['lock_timeout']:d}")
+
+
+def add_unique_constraint(name, table, columns):
+    """Add a unique constraint
+
+    Online it builds a unique index concurrently first, so adding the
+    constraint only holds its lock for as long as it takes to attach it.
+    """
+    if not is_online():
+        with step(f"add constraint {name}"):
+            op.create_unique_constraint(name, table, columns)
+        return
+
+    exists = _execute(
+        "SELECT 1 FROM pg_constraint WHERE conname = :name", name=name
+    ).scalar()
+    if exists:
+        logger.info("constraint %s exists, skipping", name)
+        return
+    create_index(name, table, columns, unique=True)
+    with_lock_timeout(
+        f"add constraint {name} using index",
+        lambda: _execute(
+            f"ALTER TABLE {table} ADD CONSTRAINT {name} "
+            f"UNIQUE USING INDEX {name}"
+        ),
+    )
+
+
+def backfill(table, column, expression, key="id", where=None,
+             batch_size=None, pause=None):
+    """Set column to expression on every row where it is NULL
+
+    Online the rows are updated batch_size at a time, each batch in its
+    own transaction, pausing in between so replication and the app keep
+    up. expression must not be NULL for the rows it updates, or they are
+    picked up again. Otherwise it is one UPDATE. Returns the number of
+    rows updated, None when it is not known: with --sql, or when the
+    driver can not count them.
+    """
+    batch_size = batch_size or settings["backfill_batch_size"]
+    pause = settings["backfill_pause"] if pause is None else pause
+    condition = f"{column} IS NULL"
+    if where:
+        condition += f" AND ({where})"
+
+    with step(f"backfill {table}.{column}"):
+        if not is_online():
+            update = (
+                f"UPDATE {table} SET {column} = {expression} "
+                f"WHERE {condition}"
+            )
+            if op.get_context().as_sql:
+                op.execute(update)
+                return None
+            result = _execute(update)
+            if not result.supports_sane_rowcount():
+                return None
+            return result.rowcount
+
+        updated = 0
+        while True:
+            rowcount = _execute(
+                f"UPDATE {table} SET {column} = {expression} "
+                f"WHERE {key} IN (SELECT {key} FROM {table} "
+                f"WHERE {condition} LIMIT {int(batch_size)})"
+            ).rowcount
+            updated += rowcount
+            if rowcount < batch_size:
+                break
+            logger.info("backfill %s.%s: %d rows", table, column, updated)
+            time.sleep(pause)
+        return updated
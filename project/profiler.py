@@ -0,0 +1,340 @@
+"""Sampling profiles of live requests, started by an admin at runtime
+
+POST /admin/profile (project/api/profiling.py) profiles a fraction of the
+requests to some routes for a bounded window. While it runs, a background
+thread reads the stacks of the sampled requests' threads every
+PROFILER_INTERVAL seconds with sys._current_frames(), and counts them in
+collapsed stack format, ready for flamegraph.pl or speedscope:
+
+    POST /auth/login;bcrypt;werkzeug.serving:run_wsgi;...;bcrypt:hashpw 42
+
+The second frame is the kind of work the stack is doing, taken from the
+outermost frame that is in one of the modules of CATEGORIES, so the
+flamegraph splits into bcrypt, jwt, sql, serialization and app, and the
+json encoding jwt does counts as jwt.
+
+Every worker process takes part. The running profile is described by
+profile.json in PROFILER_DIR, which a worker looks at at most every
+PROFILER_POLL_INTERVAL seconds when it serves a request, and joins. Each
+worker saves what it sampled to <profile id>/<pid>.json every
+PROFILER_SAVE_INTERVAL seconds, and the endpoints merge those files, so
+any worker can answer them. With no profile running, requests pay for a
+clock check, and a read of profile.json once a poll interval.
+"""
+import glob
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import current_app, request
+
+# kinds of work, by module name prefix
+CATEGORIES = (
+    ("bcrypt", ("bcrypt", "flask_bcrypt")),
+    ("jwt", ("jwt", "cryptography", "project.api.keys")),
+    ("sql", ("sqlalchemy", "flask_sqlalchemy", "psycopg2", "sqlite3")),
+    ("serialization", ("json", "flask.json", "simplejson")),
+)
+
+_module_categories = {}
+
+
+def module_category(module):
+    """The category of a module name, None if it has none"""
+    try:
+        return _module_categories[module]
+    except KeyError:
+        pass
+    category = None
+    for name, prefixes in CATEGORIES:
+        if any(module == prefix or module.startswith(prefix + ".")
+               for prefix in prefixes):
+            category = name
+            break
+    _module_categories[module] = category
+    return category
+
+
+def collapse(frame):
+    """(root first frame names joined by ";", category) of a stack"""
+    names = []
+    category = None
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "?")
+        # the frames go outwards, so the last match is the outermost
+        category = module_category(module) or category
+        names.append(f"{module}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names), category or "app"
+
+
+def _write_json(path, data):
+    """Replace the json file at path, readers never see half of it"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp, "w") as f:
+        json.dump(data, f)
+    os.replace(temp, path)
+
+
+def _read_json(path):
+    """The json in path, None if there is none"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_running(spec):
+    return (
+        spec is not None and not spec["stopped"] and
+        time.time() < spec["ends_at"]
+    )
+
+
+class Profile:
+    """A worker's part of a profile, and the stacks it sampled"""
+
+    def __init__(self, spec):
+        self.id = spec["id"]
+        self.routes = frozenset(spec["routes"])
+        self.sample_rate = spec["sample_rate"]
+        self.interval = spec["interval"]
+        self.ends_at = spec["ends_at"]
+        self.running = True
+        self.requests = 0
+        self.samples = 0
+        self.stacks = Counter()
+        self.categories = Counter()
+        # thread ident -> "METHOD route" of the request it is serving
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def wants(self, route):
+        return route in self.routes and random.random() < self.sample_rate
+
+    def enter(self, label):
+        """Sample the current thread as serving label"""
+        with self._lock:
+            self._threads[threading.get_ident()] = label
+            self.requests += 1
+
+    def leave(self):
+        self._threads.pop(threading.get_ident(), None)
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, label in list(self._threads.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack, category = collapse(frame)
+                self.stacks[f"{label};{category};{stack}"] += 1
+                self.categories[category] += 1
+                self.samples += 1
+
+    def save(self, path):
+        with self._lock:
+            counts = {
+                "requests": self.requests,
+                "samples": self.samples,
+                "categories": dict(self.categories),
+                "stacks": dict(self.stacks),
+            }
+        _write_json(path, counts)
+
+
+class Profiler:
+    """Runs this worker's part of the profile of profile.json in
+    directory, and merges the parts of every worker
+    """
+
+    def __init__(self, directory, poll_interval=1, save_interval=1):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.save_interval = save_interval
+        # what the worker's files are named after, its pid unless set
+        self.worker = None
+        # checked on every request, None unless a profile is running here
+        self.running = None
+        self._next_poll = 0
+        self._lock = threading.Lock()
+
+    def _spec_path(self):
+        return os.path.join(self.directory, "profile.json")
+
+    def _part_path(self, profile):
+        worker = self.worker or os.getpid()
+        return os.path.join(self.directory, profile.id, f"{worker}.json")
+
+    def read_spec(self):
+        """The running or last profile, None if none was taken"""
+        return _read_json(self._spec_path())
+
+    def start(self, routes, sample_rate, duration, interval):
+        """Start a profile in every worker, returns its summary, None if
+        one is already running
+        """
+        with self._lock:
+            if _is_running(self.read_spec()):
+                return None
+            now = time.time()
+            spec = {
+                "id": uuid.uuid4().hex,
+                "routes": sorted(routes),
+                "sample_rate": sample_rate,
+                "interval": interval,
+                "started_at": now,
+                "ends_at": now + duration,
+                "stopped": False,
+            }
+            # only the last profile is kept
+            for path in glob.glob(os.path.join(self.directory, "*", "")):
+                shutil.rmtree(path, ignore_errors=True)
+            _write_json(self._spec_path(), spec)
+        self._join(spec)
+        return self.summary(spec)
+
+    def stop(self):
+        """Stop the running profile in every worker, returns its summary,
+        None if there is none
+        """
+        with self._lock:
+            spec = self.read_spec()
+            if not _is_running(spec):
+                return None
+            spec["stopped"] = True
+            _write_json(self._spec_path(), spec)
+            profile, self.running = self.running, None
+        if profile is not None:
+            profile.running = False
+            profile.save(self._part_path(profile))
+        return self.summary(spec)
+
+    def poll(self):
+        """Join the running profile, at most every poll_interval"""
+        now = time.monotonic()
+        if now < self._next_poll:
+            return
+        self._next_poll = now + self.poll_interval
+        spec = self.read_spec()
+        if _is_running(spec):
+            self._join(spec)
+
+    def _join(self, spec):
+        with self._lock:
+            if self.running is not None:
+                if self.running.id == spec["id"]:
+                    return
+                self.running.running = False
+            profile = self.running = Profile(spec)
+        threading.Thread(
+            target=self._run, args=(profile,), daemon=True
+        ).start()
+
+    def _run(self, profile):
+        next_save = time.monotonic() + self.save_interval
+        try:
+            while profile.running and time.time() < profile.ends_at:
+                time.sleep(profile.interval)
+                profile.sample()
+                if time.monotonic() >= next_save:
+                    next_save = time.monotonic() + self.save_interval
+                    profile.save(self._part_path(profile))
+                    spec = self.read_spec()
+                    # stopped or replaced through another worker
+                    if not _is_running(spec) or spec["id"] != profile.id:
+                        profile.running = False
+        finally:
+            profile.running = False
+            profile.save(self._part_path(profile))
+            with self._lock:
+                if self.running is profile:
+                    self.running = None
+
+    def _merge(self, profile_id):
+        merged = {
+            "requests": 0,
+            "samples": 0,
+            "categories": Counter(),
+            "stacks": Counter(),
+        }
+        parts = glob.glob(os.path.join(self.directory, profile_id, "*.json"))
+        for path in parts:
+            part = _read_json(path)
+            if part is None:
+                continue
+            merged["requests"] += part["requests"]
+            merged["samples"] += part["samples"]
+            merged["categories"].update(part["categories"])
+            merged["stacks"].update(part["stacks"])
+        return merged
+
+    def summary(self, spec=None):
+        """The running or last profile, without its stacks, None if none
+        was taken
+        """
+        spec = spec or self.read_spec()
+        if spec is None:
+            return None
+        merged = self._merge(spec["id"])
+        return {
+            "id": spec["id"],
+            "running": _is_running(spec),
+            "routes": spec["routes"],
+            "sample_rate": spec["sample_rate"],
+            "started_at": spec["started_at"],
+            "ends_at": spec["ends_at"],
+            "requests": merged["requests"],
+            "samples": merged["samples"],
+            "categories": dict(merged["categories"]),
+        }
+
+    def collapsed(self):
+        """The stacks of the running or last profile, None if none was
+        taken
+        """
+        spec = self.read_spec()
+        if spec is None:
+            return None
+        stacks = self._merge(spec["id"])["stacks"]
+        return "".join(
+            f"{stack} {count}\n" for stack, count in sorted(stacks.items())
+        )
+
+
+def get_profiler():
+    """The app's Profiler"""
+    return current_app.extensions["profiler"]
+
+
+def init_profiler(app):
+    profiler = app.extensions["profiler"] = Profiler(
+        app.config.get("PROFILER_DIR"),
+        app.config.get("PROFILER_POLL_INTERVAL"),
+        app.config.get("PROFILER_SAVE_INTERVAL"),
+    )
+
+    @app.before_request
+    def start_sampling():
+        profiler.poll()
+        profile = profiler.running
+        if profile is None or request.url_rule is None:
+            return
+        if profile.wants(request.url_rule.rule):
+            profile.enter(f"{request.method} {request.url_rule.rule}")
+
+    @app.teardown_request
+    def stop_sampling(error):
+        profile = profiler.running
+        if profile is not None:
+            profile.leave()
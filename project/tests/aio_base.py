@@ -0,0 +1,125 @@
+import asyncio
+import atexit
+import threading
+import unittest
+
+import aiohttp
+from aiohttp.test_utils import TestServer
+from flask_testing import TestCase
+
+from project import db
+from project.aio import create_async_app
+from project.api.cache import user_cache
+from project.tests import base
+
+
+class AsyncResponse:
+    """The parts of a flask test response the test cases use"""
+
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.headers = headers
+        self.data = data
+        self.content_type = headers.get("Content-Type")
+
+
+class AsyncClient:
+    """Sends the requests of a test case to the aiohttp app, with the
+    interface of flask's test client
+    """
+
+    def __init__(self, server):
+        self.server = server
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def open(self, method, path, data=None, content_type=None,
+             headers=None):
+        headers = dict(headers or {})
+        if content_type:
+            headers["Content-Type"] = content_type
+        # the app reads what the test committed, and the test sees what
+        # the app committed, like with the shared session of flask tests
+        db.session.commit()
+        response = self.server.run(self.server.request(
+            method, "/" + path.lstrip("/"), data, headers
+        ))
+        db.session.expire_all()
+        return response
+
+    def get(self, path, **kwargs):
+        return self.open("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open("POST", path, **kwargs)
+
+
+class AsyncServer:
+    """The aiohttp app, served from an event loop on its own thread"""
+
+    def __init__(self, flask_app):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.server = TestServer(create_async_app(flask_app))
+        self.run(self.server.start_server())
+        self.session = self.run(self._client_session())
+        atexit.register(self.close)
+
+    async def _client_session(self):
+        return aiohttp.ClientSession()
+
+    def close(self):
+        self.run(self.session.close())
+        self.run(self.server.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def request(self, method, path, data, headers):
+        async with self.session.request(
+            method, self.server.make_url(path), data=data, headers=headers
+        ) as response:
+            return AsyncResponse(
+                response.status, response.headers, await response.read()
+            )
+
+
+# started by the first async test case
+_server = None
+
+
+class AsyncTestCase(TestCase):
+    """Runs a test case's requests against the asyncio app
+
+    The app has its own connections, so the test data is committed for
+    real and deleted again after each test. Needs a db the app can reach,
+    not an in-memory sqlite db.
+    """
+
+    def create_app(self):
+        base.app.config.from_object("project.config.TestingConfig")
+        return base.app
+
+    def setUp(self):
+        global _server
+        if not base._schema_created:
+            base._create_schema()
+        if db.engine.dialect.name == "sqlite":
+            if db.engine.url.database in (None, "", ":memory:"):
+                raise unittest.SkipTest("needs a sqlite file")
+            # readers do not block the app's writers
+            db.engine.execute("PRAGMA journal_mode=WAL")
+        if _server is None:
+            _server = AsyncServer(base.app)
+        self.client = AsyncClient(_server)
+
+    def tearDown(self):
+        db.session.remove()
+        for table in reversed(db.metadata.sorted_tables):
+            db.engine.execute(table.delete())
+        user_cache.clear()
@@ -1,9 +1,31 @@
 from flask_testing import TestCase
+from sqlalchemy import event
 
 from project import create_app, db
 
 app = create_app()
 
+# the schema is only created by the first test of a run
+_schema_created = False
+
+
+def _create_schema():
+    global _schema_created
+    if db.engine.dialect.name == "sqlite":
+        # pysqlite begins transactions lazily, which breaks savepoints.
+        # let sqlalchemy emit BEGIN itself
+        @event.listens_for(db.engine, "connect")
+        def do_connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(db.engine, "begin")
+        def do_begin(connection):
+            connection.execute("BEGIN")
+
+    db.drop_all()
+    db.create_all()
+    _schema_created = True
+
 
 class BaseTestCase(TestCase):
     def create_app(self):
@@ -11,10 +33,29 @@ class BaseTestCase(TestCase):
         return app
 
     def setUp(self):
-        db.create_all()
-        db.session.commit()
+        if not _schema_created:
+            _create_schema()
+
+        # every test runs in a transaction that is rolled back in tearDown.
+        # commits and rollbacks in the code under test only reach a
+        # savepoint, which is restarted after each of them
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.app_session = db.session
+        db.session = db.create_scoped_session(
+            options={"bind": self.connection, "binds": {}}
+        )
+
+        @event.listens_for(db.session.session_factory, "after_transaction_end")
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        db.session.begin_nested()
 
     def tearDown(self):
         db.session.remove()
-        db.drop_all()
-
+        db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
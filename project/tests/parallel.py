@@ -0,0 +1,107 @@
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+
+
+def worker_database_url(url, worker):
+    """The test database url for one worker process"""
+    url = make_url(url)
+    if not url.database or url.database == ":memory:":
+        return str(url)
+    if url.drivername.startswith("sqlite"):
+        root, ext = os.path.splitext(url.database)
+        url.database = f"{root}_{worker}{ext}"
+        return str(url)
+
+    database = f"{url.database}_{worker}"
+    engine = create_engine(url, isolation_level="AUTOCOMMIT")
+    with engine.connect() as connection:
+        exists = connection.execute(
+            "SELECT 1 FROM pg_database WHERE datname = %s", database
+        ).scalar()
+        if not exists:
+            connection.execute(f'CREATE DATABASE "{database}"')
+    engine.dispose()
+    url.database = database
+    return str(url)
+
+
+def split_modules(processes, start_dir="project/tests"):
+    """Spread the test modules over the processes, biggest first"""
+    paths = sorted(
+        glob.glob(os.path.join(start_dir, "test*.py")),
+        key=os.path.getsize,
+        reverse=True,
+    )
+    buckets = [[] for _ in range(processes)]
+    sizes = [0] * processes
+    for path in paths:
+        i = sizes.index(min(sizes))
+        buckets[i].append(path[:-3].replace(os.sep, "."))
+        sizes[i] += os.path.getsize(path)
+    return [bucket for bucket in buckets if bucket]
+
+
+def run_workers(buckets):
+    """Runs each bucket of test modules in its own process and db, returns
+    (success, wall time)
+    """
+    started = time.time()
+    workers = []
+    for worker, modules in enumerate(buckets, 1):
+        env = dict(os.environ)
+        env["DATABASE_TEST_URL"] = worker_database_url(
+            os.environ["DATABASE_TEST_URL"], worker
+        )
+        output = tempfile.TemporaryFile()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "unittest", *modules],
+            env=env,
+            stdout=output,
+            stderr=subprocess.STDOUT,
+        )
+        workers.append((modules, output, process))
+
+    for modules, output, process in workers:
+        process.wait()
+    elapsed = time.time() - started
+
+    success = True
+    for modules, output, process in workers:
+        output.seek(0)
+        print(f"### {', '.join(modules)}")
+        print(output.read().decode())
+        success = success and process.returncode == 0
+    return success, elapsed
+
+
+def run_parallel(processes, compare=False):
+    """Runs the test modules in separate processes, each with its own db
+
+    With compare, the modules first run one after another in a single
+    process, and the speedup is the serial wall time over the parallel
+    one.
+    """
+    buckets = split_modules(processes)
+    serial = None
+    if compare:
+        modules = [module for bucket in buckets for module in bucket]
+        print("## In one process")
+        success, serial = run_workers([modules])
+        if not success:
+            return False
+        print(f"## In {len(buckets)} processes")
+    success, elapsed = run_workers(buckets)
+    print(f"Ran {len(buckets)} processes in {elapsed:.2f}s.")
+    if serial is not None:
+        print(
+            f"Run in one process, the tests took {serial:.2f}s, "
+            f"a {serial / elapsed:.1f}x speedup."
+        )
+    return success
@@ -0,0 +1,48 @@
+import json
+
+from project.api.models import OutboxEvent, SignupDay, UserTotals
+from project.tests import test_auth, test_users
+from project.tests.aio_base import AsyncTestCase
+
+
+class TestAuthBlueprintAsync(AsyncTestCase, test_auth.TestAuthBluePrint):
+    """The auth tests, against the asyncio app"""
+
+
+class TestUsersAsync(AsyncTestCase, test_users.TestDevelopmentConfig):
+    """The users tests, against the asyncio app"""
+
+
+class TestAsyncApp(AsyncTestCase):
+
+    def register(self):
+        return self.client.post(
+            "/auth/register",
+            data=json.dumps({
+                "username": "test",
+                "email": "test@test.com",
+                "password": "test",
+            }),
+            content_type="application/json",
+        )
+
+    def test_registration_writes_outbox_and_stats(self):
+        response = self.register()
+        self.assertEqual(response.status_code, 201)
+        event = OutboxEvent.query.one()
+        self.assertEqual(event.event_type, "user.registered")
+        self.assertEqual(json.loads(event.payload)["username"], "test")
+        self.assertEqual(UserTotals.query.one().total, 1)
+        self.assertEqual(SignupDay.query.one().signups, 1)
+
+    def test_duplicate_registration(self):
+        self.register()
+        response = self.register()
+        data = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data["message"], "Sorry. That user already exists.")
+
+    def test_jwks(self):
+        response = self.client.get("/.well-known/jwks.json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("public", response.headers["Cache-Control"])
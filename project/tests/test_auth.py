@@ -215,4 +215,185 @@ class TestAuthBluePrint(BaseTestCase):
             self.assertTrue(
                 data["message"] == "Invalid Token. Please log in again."
             )
-            self.assertTrue(response.status_code == 401)
\ No newline at end of file
+            self.assertTrue(response.status_code == 401)
+
+    def test_user_status_from_claims(self):
+        """Test /status is answered from the token claims"""
+        user = add_user("test", "test@test.com", "test")
+        current_app.config["AUTH_STATUS_FROM_CLAIMS"] = True
+        token = user.encode_auth_token(user.id).decode()
+        # the claims are used, so the db row is not read
+        db.session.delete(user)
+        db.session.commit()
+        with self.client:
+            response = self.client.get(
+                "/auth/status",
+                headers={"Authorization": f"Bearer {token}"}
+            )
+            data = json.loads(response.data.decode())
+            self.assertTrue(data["status"] == "success")
+            self.assertTrue(data["data"]["username"] == "test")
+            self.assertTrue(data["data"]["email"] == "test@test.com")
+            self.assertTrue(data["data"]["active"] is True)
+            self.assertTrue(data["data"]["created_at"])
+            self.assertTrue(response.status_code == 200)
+
+    def test_refresh_auth_token(self):
+        add_user("test", "test@test.com", "test")
+        with self.client:
+            resp_login = self.client.post(
+                "/auth/login",
+                data=json.dumps({
+                    "email": "test@test.com",
+                    "password": "test",
+                }),
+                content_type="application/json"
+            )
+            refresh_token = json.loads(
+                resp_login.data.decode()
+            )["refresh_token"]
+            response = self.client.post(
+                "/auth/refresh",
+                headers={"Authorization": f"Bearer {refresh_token}"}
+            )
+            data = json.loads(response.data.decode())
+            self.assertTrue(data["status"] == "success")
+            self.assertTrue(data["message"] == "Successfully refreshed.")
+            self.assertEqual(response.status_code, 200)
+
+            response = self.client.get(
+                "/auth/status",
+                headers={"Authorization": f"Bearer {data['auth_token']}"}
+            )
+            self.assertEqual(response.status_code, 200)
+
+    def test_refresh_token_is_not_an_auth_token(self):
+        user = add_user("test", "test@test.com", "test")
+        refresh_token = user.encode_refresh_token(user.id).decode()
+        auth_token = user.encode_auth_token(user.id).decode()
+        with self.client:
+            response = self.client.get(
+                "/auth/status",
+                headers={"Authorization": f"Bearer {refresh_token}"}
+            )
+            data = json.loads(response.data.decode())
+            self.assertTrue(
+                data["message"] == "Invalid Token. Please log in again."
+            )
+            self.assertEqual(response.status_code, 401)
+
+            response = self.client.post(
+                "/auth/refresh",
+                headers={"Authorization": f"Bearer {auth_token}"}
+            )
+            data = json.loads(response.data.decode())
+            self.assertTrue(
+                data["message"] == "Invalid Token. Please log in again."
+            )
+            self.assertEqual(response.status_code, 401)
+
+    def test_logout_revokes_the_session(self):
+        add_user("test", "test@test.com", "test")
+        with self.client:
+            resp_login = self.client.post(
+                "/auth/login",
+                data=json.dumps({
+                    "email": "test@test.com",
+                    "password": "test",
+                }),
+                content_type="application/json"
+            )
+            tokens = json.loads(resp_login.data.decode())
+            refresh_headers = {
+                "Authorization": f"Bearer {tokens['refresh_token']}"
+            }
+            response = self.client.post(
+                "/auth/refresh", headers=refresh_headers
+            )
+            refreshed_token = json.loads(response.data.decode())["auth_token"]
+
+            response = self.client.get(
+                "/auth/logout",
+                headers={"Authorization": f"Bearer {tokens['auth_token']}"}
+            )
+            self.assertEqual(response.status_code, 200)
+
+            response = self.client.post(
+                "/auth/refresh", headers=refresh_headers
+            )
+            data = json.loads(response.data.decode())
+            self.assertTrue(
+                data["message"] == "Token revoked. Please log in again."
+            )
+            self.assertEqual(response.status_code, 401)
+
+            # auth tokens refreshed in the session go with it
+            response = self.client.get(
+                "/auth/status",
+                headers={"Authorization": f"Bearer {refreshed_token}"}
+            )
+            self.assertEqual(response.status_code, 401)
+
+    def test_introspect_tokens(self):
+        user = add_user("test", "test@test.com", "test")
+        inactive = add_user("inactive", "inactive@test.com", "test")
+        inactive.active = False
+        db.session.commit()
+        token = user.encode_auth_token(user.id).decode()
+        inactive_token = inactive.encode_auth_token(inactive.id).decode()
+        with self.client:
+            response = self.client.post(
+                "/auth/introspect",
+                data=json.dumps({
+                    "tokens": [token, "NONE", inactive_token, token],
+                }),
+                content_type="application/json"
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data["status"] == "success")
+            results = data["data"]["tokens"]
+            self.assertEqual(len(results), 4)
+            self.assertTrue(results[0]["active"])
+            self.assertEqual(results[0]["sub"], user.id)
+            self.assertTrue(results[0]["exp"])
+            self.assertFalse(results[1]["active"])
+            self.assertEqual(
+                results[1]["message"], "Invalid Token. Please log in again."
+            )
+            self.assertFalse(results[2]["active"])
+            self.assertEqual(results[3], results[0])
+
+    def test_introspect_invalid_payload(self):
+        with self.client:
+            response = self.client.post(
+                "/auth/introspect",
+                data=json.dumps({"tokens": "NONE"}),
+                content_type="application/json"
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("Invalid payload.", data["message"])
+
+    def test_introspect_non_object_payload(self):
+        with self.client:
+            response = self.client.post(
+                "/auth/introspect",
+                data=json.dumps(["t"]),
+                content_type="application/json"
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("Invalid payload.", data["message"])
+
+    def test_introspect_too_many_tokens(self):
+        max_tokens = current_app.config["AUTH_INTROSPECT_MAX_TOKENS"]
+        with self.client:
+            response = self.client.post(
+                "/auth/introspect",
+                data=json.dumps({"tokens": ["NONE"] * (max_tokens + 1)}),
+                content_type="application/json"
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("Too many tokens.", data["message"])
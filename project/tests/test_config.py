@@ -50,6 +50,8 @@ class TestTestingConfig(TestCase):
         self.assertTrue(app.config["BCRYPT_LOG_ROUNDS"] == 4)
         self.assertTrue(app.config["TOKEN_EXPIRATION_DAYS"] == 0)
         self.assertTrue(app.config["TOKEN_EXPIRATION_SECONDS"] == 3)
+        self.assertTrue(app.config["REFRESH_TOKEN_EXPIRATION_DAYS"] == 30)
+        self.assertFalse(app.config["AUTH_STATUS_FROM_CLAIMS"])
 
 
 class TestProductionConfig(TestCase):
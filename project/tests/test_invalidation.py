@@ -0,0 +1,175 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from project import create_app, db
+from project.api.cache import LocalCache, revoked_tokens, user_cache
+from project.api.invalidation import get_bus, prune_revoked_tokens
+from project.api.models import RevokedToken, User
+from project.api.records import load_user, load_users
+from project.tests.base import BaseTestCase
+from project.tests.utils import add_user
+
+
+class TestInvalidation(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        current_app.config["USER_CACHE_TTL"] = 60
+        user_cache.clear()
+
+    def tearDown(self):
+        user_cache.clear()
+        super().tearDown()
+
+    def test_user_changed_drops_cached_user(self):
+        user = add_user("test", "test@test.com", "test")
+        self.assertEqual(load_user(user.id).username, "test")
+        user.username = "changed"
+        db.session.commit()
+        # still served from the cache
+        self.assertEqual(load_user(user.id).username, "test")
+
+        get_bus().publish_user_changed(user.id)
+        self.assertEqual(load_user(user.id).username, "changed")
+
+    def test_lookup_serves_cache_hits(self):
+        user_one = add_user("test", "test@test.com", "test")
+        user_two = add_user("test2", "test2@test.com", "test")
+        load_user(user_one.id)
+        user_one.username = "changed"
+        user_two.username = "changed2"
+        db.session.commit()
+        users = load_users([user_one.id, user_two.id])
+        self.assertEqual(users[user_one.id].username, "test")
+        self.assertEqual(users[user_two.id].username, "changed2")
+
+    def test_add_user_publishes(self):
+        bus = get_bus()
+        last_seq = bus.last_seq or 0
+        with self.client:
+            response = self.client.post(
+                "/users",
+                data=json.dumps({
+                    "username": "test",
+                    "email": "test@test.com",
+                    "password": "test",
+                }),
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 201)
+        self.assertEqual(bus.last_seq, last_seq + 1)
+
+    def test_logout_revokes_token(self):
+        user = add_user("test", "test@test.com", "test")
+        token = user.encode_auth_token(user.id).decode()
+        headers = {"Authorization": f"Bearer {token}"}
+        with self.client:
+            response = self.client.get("/auth/logout", headers=headers)
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get("/auth/status", headers=headers)
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(
+                data["message"], "Token revoked. Please log in again."
+            )
+        self.assertEqual(RevokedToken.query.count(), 1)
+
+    def test_new_worker_rejects_revoked_tokens(self):
+        user = add_user("test", "test@test.com", "test")
+        token = user.encode_auth_token(user.id).decode()
+        db.session.add(RevokedToken(
+            jti=User.decode_auth_payload(token)["jti"],
+            expires_at=datetime.utcnow() + timedelta(seconds=60),
+        ))
+        db.session.commit()
+        # a worker that never wrote anything since it started
+        revoked_tokens.replace([])
+        app = create_app()
+        app.config.from_object("project.config.TestingConfig")
+        with app.test_client() as client:
+            response = client.get(
+                "/auth/status",
+                headers={"Authorization": f"Bearer {token}"},
+            )
+            self.assertEqual(response.status_code, 401)
+        self.assertIn("invalidation_bus", app.extensions)
+
+    def test_gap_resyncs(self):
+        user = add_user("test", "test@test.com", "test")
+        load_user(user.id)
+        db.session.add(RevokedToken(
+            jti="missed",
+            expires_at=datetime.utcnow() + timedelta(seconds=60),
+        ))
+        db.session.commit()
+        self.assertNotIn("missed", revoked_tokens)
+
+        bus = get_bus()
+        bus.publish_user_changed(0)
+        resyncs = bus.resyncs
+        gap_wait = bus.gap_wait
+        bus.gap_wait = 0
+        try:
+            bus.apply({"seq": bus.last_seq + 3, "kind": "user", "key": 0})
+        finally:
+            bus.gap_wait = gap_wait
+        # the missing messages may still come
+        self.assertEqual(bus.resyncs, resyncs)
+        self.assertEqual(len(user_cache), 1)
+
+        bus.check_gaps()
+        self.assertEqual(bus.resyncs, resyncs + 1)
+        self.assertIn("missed", revoked_tokens)
+        self.assertEqual(len(user_cache), 0)
+
+        # late messages are still applied
+        bus.apply({"seq": bus.last_seq - 1, "kind": "token",
+                   "key": ["late", time.time() + 60]})
+        self.assertEqual(bus.resyncs, resyncs + 1)
+        self.assertIn("late", revoked_tokens)
+
+    def test_gap_filled_in_time(self):
+        bus = get_bus()
+        bus.publish_user_changed(0)
+        resyncs = bus.resyncs
+        seq = bus.last_seq
+        # committed out of order
+        bus.apply({"seq": seq + 2, "kind": "user", "key": 0})
+        bus.apply({"seq": seq + 1, "kind": "user", "key": 0})
+        bus.check_gaps()
+        self.assertEqual(bus.resyncs, resyncs)
+
+        # too big a gap to wait on
+        bus.apply({"seq": seq + 5000, "kind": "user", "key": 0})
+        self.assertEqual(bus.resyncs, resyncs + 1)
+
+    def test_prune_revoked_tokens(self):
+        now = datetime.utcnow()
+        db.session.add_all([
+            RevokedToken(jti="expired", expires_at=now - timedelta(seconds=1)),
+            RevokedToken(jti="live", expires_at=now + timedelta(seconds=60)),
+        ])
+        db.session.commit()
+        self.assertEqual(prune_revoked_tokens(), 1)
+        self.assertEqual(
+            [token.jti for token in RevokedToken.query], ["live"]
+        )
+
+    def test_local_cache(self):
+        cache = LocalCache(2)
+        cache.set("a", 1, 60)
+        cache.set("b", 2, 60)
+        cache.get("a")
+        cache.set("c", 3, 60)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("d", 4, -1)
+        self.assertIsNone(cache.get("d"))
+
+        version = cache.version
+        cache.delete("a")
+        cache.set("a", 5, 60, version)
+        self.assertIsNone(cache.get("a"))
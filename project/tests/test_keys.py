@@ -0,0 +1,167 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+
+import jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from flask import current_app
+
+from project.api.keys import get_jwks, is_asymmetric
+from project.api.models import User
+from project.tests.base import BaseTestCase
+from project.tests.utils import add_user
+
+
+def write_rsa_key(keys_dir, kid, private=True):
+    key = rsa.generate_private_key(65537, 2048, default_backend())
+    if private:
+        pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    else:
+        pem = key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+    with open(os.path.join(keys_dir, f"{kid}.pem"), "wb") as f:
+        f.write(pem)
+
+
+class TestAsymmetricKeys(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.keys_dir = tempfile.mkdtemp()
+        write_rsa_key(self.keys_dir, "old")
+        write_rsa_key(self.keys_dir, "new")
+        current_app.config.update({
+            "JWT_ALGORITHM": "RS256",
+            "JWT_KEYS_DIR": self.keys_dir,
+            "JWT_SIGNING_KID": "old",
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.keys_dir)
+        super().tearDown()
+
+    def test_decode_auth_token(self):
+        user = add_user("justatest", "test@test.com", "test")
+        auth_token = user.encode_auth_token(user.id)
+        header = jwt.get_unverified_header(auth_token)
+        self.assertEqual(header["alg"], "RS256")
+        self.assertEqual(header["kid"], "old")
+        self.assertEqual(User.decode_auth_token(auth_token), user.id)
+
+    def test_decode_auth_token_after_rotation(self):
+        user = add_user("justatest", "test@test.com", "test")
+        auth_token = user.encode_auth_token(user.id)
+        current_app.config["JWT_SIGNING_KID"] = "new"
+        self.assertEqual(User.decode_auth_token(auth_token), user.id)
+        new_token = user.encode_auth_token(user.id)
+        self.assertEqual(jwt.get_unverified_header(new_token)["kid"], "new")
+        self.assertEqual(User.decode_auth_token(new_token), user.id)
+
+    def test_decode_auth_token_unknown_kid(self):
+        user = add_user("justatest", "test@test.com", "test")
+        auth_token = jwt.encode(
+            {"sub": user.id}, "secret", algorithm="HS256",
+            headers={"kid": "missing"},
+        )
+        self.assertEqual(
+            User.decode_auth_token(auth_token),
+            "Invalid Token. Please log in again."
+        )
+
+    def test_jwks(self):
+        with self.client:
+            response = self.client.get("/.well-known/jwks.json")
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                sorted(key["kid"] for key in data["keys"]), ["new", "old"]
+            )
+            for key in data["keys"]:
+                self.assertEqual(key["kty"], "RSA")
+                self.assertEqual(key["alg"], "RS256")
+                self.assertTrue(key["n"])
+                self.assertTrue(key["e"])
+            self.assertIn("max-age=3600", response.headers["Cache-Control"])
+
+    def test_jwks_verifies_tokens(self):
+        user = add_user("justatest", "test@test.com", "test")
+        auth_token = user.encode_auth_token(user.id)
+        response = self.client.get("/.well-known/jwks.json")
+        jwk = [
+            key for key in json.loads(response.data.decode())["keys"]
+            if key["kid"] == "old"
+        ][0]
+        public_key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+        payload = jwt.decode(auth_token, public_key, algorithms=["RS256"])
+        self.assertEqual(payload["sub"], user.id)
+
+
+class TestKeyConfig(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.keys_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.keys_dir)
+        super().tearDown()
+
+    def test_hmac_algorithms_are_symmetric(self):
+        user = add_user("justatest", "test@test.com", "test")
+        for algorithm in ("HS256", "HS384", "HS512"):
+            current_app.config["JWT_ALGORITHM"] = algorithm
+            self.assertFalse(is_asymmetric())
+            self.assertEqual(get_jwks(), {"keys": []})
+            auth_token = user.encode_auth_token(user.id)
+            self.assertEqual(
+                jwt.get_unverified_header(auth_token)["alg"], algorithm
+            )
+            self.assertEqual(User.decode_auth_token(auth_token), user.id)
+
+    def test_asymmetric_algorithm_needs_keys_dir(self):
+        current_app.config.update({
+            "JWT_ALGORITHM": "RS256",
+            "JWT_KEYS_DIR": None,
+        })
+        with self.assertRaisesRegex(RuntimeError, "JWT_KEYS_DIR"):
+            get_jwks()
+
+    def test_ec_coordinates_are_padded(self):
+        # about 1 in 128 P-256 keys has a coordinate with a leading zero
+        # byte
+        for i in range(2000):
+            key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+            numbers = key.public_key().public_numbers()
+            if min(numbers.x, numbers.y).bit_length() <= 248:
+                break
+        else:
+            self.fail("no key with a short coordinate")
+        pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        with open(os.path.join(self.keys_dir, "ec.pem"), "wb") as f:
+            f.write(pem)
+        current_app.config.update({
+            "JWT_ALGORITHM": "ES256",
+            "JWT_KEYS_DIR": self.keys_dir,
+            "JWT_SIGNING_KID": "ec",
+        })
+        jwk = get_jwks()["keys"][0]
+        coordinates = []
+        for coordinate in ("x", "y"):
+            data = base64.urlsafe_b64decode(jwk[coordinate] + "=")
+            self.assertEqual(len(data), 32)
+            coordinates.append(int.from_bytes(data, "big"))
+        self.assertEqual(coordinates, [numbers.x, numbers.y])
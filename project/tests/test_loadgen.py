@@ -0,0 +1,124 @@
+import asyncio
+import os
+import tempfile
+
+from flask import current_app
+
+from project.loadgen import (
+    StepResult, find_saturation, load_capture, parse_access_log, percentile,
+    run_step,
+)
+from project.tests.base import BaseTestCase
+from project.tests.utils import add_user
+
+
+class SlowTarget:
+    """Answers every request after a while, without a server"""
+
+    def build_request(self, record):
+        return None, None
+
+    async def send(self, method, path, body=None, token=None):
+        await asyncio.sleep(0.05)
+        return 200, b"{}"
+
+
+def step_result(rate, arrivals, completed, elapsed, latency=0.01):
+    step = StepResult(rate)
+    step.arrivals = arrivals
+    step.send_window = 1
+    step.elapsed = elapsed
+    for _ in range(completed):
+        step.record("/ping", latency, True)
+    return step
+
+
+class TestLoadgen(BaseTestCase):
+
+    def test_capture(self):
+        user = add_user("test", "test@test.com", "test")
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        current_app.config["TRAFFIC_CAPTURE_PATH"] = path
+        try:
+            with self.client:
+                self.client.get(f"/users/{user.id}")
+                self.client.get("/users?ids=1,2")
+            records = load_capture(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]["route"], "/users/<user_id>")
+        self.assertEqual(records[0]["path"], f"/users/{user.id}")
+        self.assertEqual(records[0]["status"], 200)
+        self.assertEqual(records[1]["route"], "/users")
+        self.assertEqual(records[1]["path"], "/users?ids=1,2")
+
+    def test_parse_access_log(self):
+        lines = [
+            '10.0.0.1 - - [19/Oct/2026:10:00:00 +0000] '
+            '"GET /users/12 HTTP/1.1" 200 95 "-" "curl/7.58"',
+            '10.0.0.1 - - [19/Oct/2026:10:00:01 +0000] '
+            '"POST /auth/login HTTP/1.1" 401 60 "-" "curl/7.58"',
+            '10.0.0.1 - - [19/Oct/2026:10:00:02 +0000] '
+            '"GET /nope HTTP/1.1" 404 10 "-" "curl/7.58"',
+            'not an access log line',
+        ]
+        records = parse_access_log(self.app, lines)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]["route"], "/users/<user_id>")
+        self.assertEqual(records[0]["method"], "GET")
+        self.assertEqual(records[1]["route"], "/auth/login")
+        self.assertEqual(records[1]["status"], 401)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 99), 3)
+        self.assertIsNone(percentile([], 50))
+
+    def test_find_saturation(self):
+        steps = []
+        for rate, latency in ((10, 0.01), (20, 0.012), (40, 0.05)):
+            step = StepResult(rate)
+            for _ in range(rate):
+                step.record("/auth/status", latency, True)
+                step.record("/ping", 0.001, True)
+            step.elapsed = 1
+            steps.append(step)
+        step, route = find_saturation(steps)
+        self.assertEqual(step.rate, 40)
+        self.assertEqual(route, "/auth/status")
+        self.assertIsNone(find_saturation(steps[:2]))
+
+    def test_saturation_is_measured_against_the_arrivals_sent(self):
+        # fewer arrivals than the nominal rate is poisson noise
+        steps = [
+            step_result(10, 10, 10, 1.01),
+            step_result(20, 16, 16, 1.02),
+        ]
+        self.assertIsNone(find_saturation(steps))
+        # completing them takes twice the send window
+        steps.append(step_result(40, 40, 40, 2))
+        step, _ = find_saturation(steps)
+        self.assertEqual(step.rate, 40)
+
+    def test_client_drops_are_not_errors(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            result = loop.run_until_complete(run_step(
+                SlowTarget(),
+                [{"method": "GET", "route": "/ping", "path": "/ping"}],
+                200, 0.2, max_in_flight=1,
+            ))
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+        self.assertGreater(result.dropped["/ping"], 0)
+        self.assertEqual(result.error_rate(), 0)
+        self.assertEqual(
+            result.arrivals, result.counts["/ping"] + result.dropped["/ping"]
+        )
+        self.assertIn("dropped=", result.report())
@@ -0,0 +1,168 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import unittest
+
+from project.logs import AsyncLogWriter
+from project.tests.base import BaseTestCase
+from project.tests.utils import add_user
+
+
+def read_records(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+class TestAsyncLogWriter(unittest.TestCase):
+
+    def test_records_are_written_in_batches(self):
+        stream = io.StringIO()
+        writer = AsyncLogWriter(stream, batch_size=10, flush_interval=0.01)
+        for i in range(25):
+            writer.emit({"n": i})
+        writer.flush()
+        self.assertEqual([r["n"] for r in read_records(stream)],
+                         list(range(25)))
+        self.assertEqual(writer.written, 25)
+        self.assertEqual(writer.dropped, 0)
+
+    def test_full_buffer_drops_records(self):
+        stream = io.StringIO()
+        # the writer thread only wakes up long after the emits
+        writer = AsyncLogWriter(stream, max_queue=5, flush_interval=0.2)
+        for i in range(8):
+            writer.emit({"n": i})
+        writer.flush()
+        self.assertEqual(writer.written, 5)
+        self.assertEqual(writer.dropped, 3)
+        self.assertEqual(len(read_records(stream)), 5)
+
+    def test_flush_without_records(self):
+        writer = AsyncLogWriter(io.StringIO())
+        self.assertTrue(writer.flush())
+        self.assertEqual(writer.written, 0)
+
+    def test_emits_from_many_threads_are_counted(self):
+        stream = io.StringIO()
+        writer = AsyncLogWriter(stream, flush_interval=0.01)
+
+        def emit():
+            for i in range(1000):
+                writer.emit({"n": i})
+        threads = [threading.Thread(target=emit) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(writer.flush())
+        self.assertEqual(writer.queued, 8000)
+        self.assertEqual(writer.written, 8000)
+        self.assertEqual(len(read_records(stream)), 8000)
+
+    def test_flush_gives_up(self):
+        release = threading.Event()
+
+        class StuckStream(io.StringIO):
+            def write(self, data):
+                release.wait()
+                return super().write(data)
+        writer = AsyncLogWriter(StuckStream(), flush_interval=0.01)
+        writer.emit({"n": 1})
+        self.assertFalse(writer.flush(timeout=0.05))
+        release.set()
+        self.assertTrue(writer.flush(timeout=5))
+
+        # the writer thread is gone, nothing will write the record
+        writer = AsyncLogWriter(io.StringIO(), flush_interval=0.01)
+        writer._thread = threading.Thread(target=lambda: None)
+        writer._thread.start()
+        writer._thread.join()
+        writer.emit({"n": 2})
+        self.assertFalse(writer.flush())
+
+    def test_close_writes_what_is_buffered(self):
+        stream = io.StringIO()
+        writer = AsyncLogWriter(stream, batch_size=10, flush_interval=60)
+        for i in range(25):
+            writer.emit({"n": i})
+        self.assertTrue(writer.close(timeout=5))
+        self.assertEqual(
+            [record["n"] for record in read_records(stream)], list(range(25))
+        )
+        self.assertFalse(writer._thread.is_alive())
+
+        writer.emit({"n": 25})
+        self.assertEqual(writer.dropped, 1)
+        self.assertTrue(AsyncLogWriter(io.StringIO()).close())
+
+    def test_records_are_written_at_exit(self):
+        with tempfile.NamedTemporaryFile("r") as log:
+            script = textwrap.dedent(f"""
+                from project.logs import AsyncLogWriter
+                writer = AsyncLogWriter(
+                    open({log.name!r}, "a"), flush_interval=60
+                )
+                for i in range(100):
+                    writer.emit({{"n": i}})
+            """)
+            subprocess.run(
+                [sys.executable, "-c", script],
+                check=True,
+                timeout=30,
+                cwd=os.getcwd(),
+            )
+            records = [json.loads(line) for line in log.read().splitlines()]
+        self.assertEqual([record["n"] for record in records], list(range(100)))
+
+
+class TestAccessLog(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.stream = io.StringIO()
+        self.writer = AsyncLogWriter(self.stream, flush_interval=0.01)
+        self.app.config["ACCESS_LOG"] = "-"
+        self.app.extensions["log_writer"] = self.writer
+
+    def tearDown(self):
+        self.app.config["ACCESS_LOG"] = None
+        del self.app.extensions["log_writer"]
+        super().tearDown()
+
+    def records(self):
+        self.writer.flush()
+        return read_records(self.stream)
+
+    def test_access_record(self):
+        self.client.get("/users")
+        records = self.records()
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record["type"], "access")
+        self.assertEqual(record["route"], "/users")
+        self.assertEqual(record["status"], 200)
+        self.assertIn("duration_ms", record)
+
+    def test_sampled_out_routes_are_not_logged(self):
+        rates = self.app.config["ACCESS_LOG_SAMPLE_RATES"]
+        self.app.config["ACCESS_LOG_SAMPLE_RATES"] = {"/ping": 0}
+        try:
+            self.client.get("/ping")
+        finally:
+            self.app.config["ACCESS_LOG_SAMPLE_RATES"] = rates
+        self.assertEqual(self.records(), [])
+
+    def test_login_is_audited(self):
+        add_user("test", "test@test.com", "test")
+        self.client.post(
+            "/auth/login",
+            data=json.dumps({"email": "test@test.com", "password": "test"}),
+            content_type="application/json",
+        )
+        audits = [r for r in self.records() if r["type"] == "audit"]
+        self.assertEqual(len(audits), 1)
+        self.assertEqual(audits[0]["event"], "login")
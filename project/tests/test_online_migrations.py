@@ -0,0 +1,99 @@
+import io
+import unittest
+from unittest import mock
+
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import create_engine
+
+from project import online_migrations
+from project.online_migrations import (
+    backfill, configure, create_index, is_online, timings, with_lock_timeout
+)
+
+
+class TestOnlineMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = dict(online_migrations.settings)
+        self.connection = create_engine("sqlite://").connect()
+        self.connection.execute(
+            "CREATE TABLE users (id INTEGER PRIMARY KEY, email TEXT, "
+            "username TEXT)"
+        )
+        for i in range(25):
+            self.connection.execute(
+                "INSERT INTO users (id, email) VALUES (?, ?)",
+                i, f"User{i}@Example.com",
+            )
+        self.operations = Operations.context(
+            MigrationContext.configure(self.connection)
+        )
+        self.operations.__enter__()
+
+    def tearDown(self):
+        self.operations.__exit__(None, None, None)
+        self.connection.close()
+        online_migrations.settings.update(self.settings)
+
+    def test_configure_rejects_unknown_options(self):
+        with self.assertRaises(ValueError):
+            configure(lock_timout=100)
+
+    def test_online_needs_postgres(self):
+        configure(online=True)
+        self.assertFalse(is_online())
+
+    def test_backfill_in_batches(self):
+        configure(online=True, backfill_batch_size=10, backfill_pause=0)
+        # batches are only for live postgres, the sql is the same on sqlite
+        is_online = mock.patch(
+            "project.online_migrations.is_online", return_value=True
+        )
+        is_online.start()
+        self.addCleanup(is_online.stop)
+        updated = backfill("users", "username", "lower(email)")
+        self.assertEqual(updated, 25)
+        self.assertEqual(self.connection.execute(
+            "SELECT username FROM users WHERE id = 3"
+        ).scalar(), "user3@example.com")
+        # running it again finds nothing left to do
+        self.assertEqual(backfill("users", "username", "lower(email)"), 0)
+
+    def test_backfill_where(self):
+        configure(online=False)
+        updated = backfill("users", "username", "'old'", where="id < 5")
+        self.assertEqual(updated, 5)
+
+    def test_backfill_online_on_sqlite_is_one_update(self):
+        configure(online=True, backfill_batch_size=10)
+        self.assertEqual(backfill("users", "username", "lower(email)"), 25)
+
+    def test_backfill_as_sql(self):
+        configure(online=True)
+        output = io.StringIO()
+        context = MigrationContext.configure(
+            dialect_name="postgresql",
+            opts={"as_sql": True, "output_buffer": output},
+        )
+        with Operations.context(context):
+            self.assertIsNone(
+                backfill("users", "username", "lower(email)")
+            )
+        self.assertEqual(
+            output.getvalue().strip(),
+            "UPDATE users SET username = lower(email) "
+            "WHERE username IS NULL;",
+        )
+
+    def test_steps_are_timed(self):
+        configure(online=True)
+        calls = []
+        with_lock_timeout("noop", lambda: calls.append(1))
+        create_index("ix_users_email", "users", ["email"])
+        self.assertEqual(calls, [1])
+        self.assertEqual(
+            [name for name, _ in timings],
+            ["noop", "create index ix_users_email"],
+        )
+        self.assertTrue(all(elapsed >= 0 for _, elapsed in timings))
@@ -0,0 +1,128 @@
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from project import db
+from project.api.models import OutboxEvent
+from project.api.outbox import (
+    FileSink, MemorySink, OutboxDispatcher, record_event
+)
+from project.tests.base import BaseTestCase
+
+
+class TestOutbox(BaseTestCase):
+
+    def register(self, username):
+        return self.client.post(
+            "/auth/register",
+            data=json.dumps({
+                "username": username,
+                "email": f"{username}@test.com",
+                "password": "test",
+            }),
+            content_type="application/json",
+        )
+
+    def test_registration_writes_an_event(self):
+        with self.client:
+            self.register("test")
+        event = OutboxEvent.query.one()
+        self.assertEqual(event.event_type, "user.registered")
+        self.assertEqual(json.loads(event.payload)["email"], "test@test.com")
+        self.assertIsNone(event.dispatched_at)
+
+    def test_add_user_writes_an_event(self):
+        with self.client:
+            self.client.post(
+                "/users",
+                data=json.dumps({
+                    "username": "test",
+                    "email": "test@test.com",
+                    "password": "test",
+                }),
+                content_type="application/json",
+            )
+        self.assertEqual(OutboxEvent.query.count(), 1)
+
+    def test_rolled_back_events_are_not_sent(self):
+        record_event("user.registered", {"id": 1})
+        db.session.rollback()
+        self.assertEqual(OutboxEvent.query.count(), 0)
+
+    def test_dispatch_in_batches(self):
+        with self.client:
+            for i in range(5):
+                self.register(f"user{i}")
+        sink = MemorySink()
+        dispatcher = OutboxDispatcher(sink, batch_size=2)
+        self.assertEqual(dispatcher.dispatch_batch(), 2)
+        self.assertEqual(dispatcher.dispatch_batch(), 2)
+        self.assertEqual(dispatcher.dispatch_batch(), 1)
+        self.assertEqual(dispatcher.dispatch_batch(), 0)
+        self.assertEqual(
+            [event["payload"]["username"] for event in sink.events],
+            [f"user{i}" for i in range(5)],
+        )
+        self.assertEqual(OutboxEvent.query.filter(
+            OutboxEvent.dispatched_at.is_(None)
+        ).count(), 0)
+
+    def test_failed_events_back_off(self):
+        record_event("user.registered", {"id": 1})
+        record_event("user.registered", {"id": 2})
+        db.session.commit()
+        first, second = OutboxEvent.query.order_by(OutboxEvent.id)
+        sink = MemorySink()
+        sink.fail[second.id] = "503 from the consumer"
+        dispatcher = OutboxDispatcher(sink, backoff=10, max_attempts=2)
+        now = datetime.utcnow()
+
+        self.assertEqual(dispatcher.dispatch_batch(now), 2)
+        self.assertEqual([e["id"] for e in sink.events], [first.id])
+        self.assertEqual(second.attempts, 1)
+        self.assertEqual(second.last_error, "503 from the consumer")
+        self.assertEqual(second.next_attempt_at, now + timedelta(seconds=10))
+
+        # not retried before its backoff is up
+        self.assertEqual(dispatcher.dispatch_batch(now), 0)
+        later = now + timedelta(seconds=11)
+        self.assertEqual(dispatcher.dispatch_batch(later), 1)
+        self.assertEqual(second.attempts, 2)
+        self.assertEqual(
+            second.next_attempt_at, later + timedelta(seconds=20)
+        )
+
+        # and given up after max_attempts
+        self.assertEqual(dispatcher.dispatch_batch(now + timedelta(1)), 0)
+        self.assertEqual((dispatcher.delivered, dispatcher.failed), (1, 2))
+
+    def test_sink_errors_fail_the_batch(self):
+        class BrokenSink:
+            def send(self, events):
+                raise ConnectionError("consumer down")
+
+        record_event("user.registered", {"id": 1})
+        db.session.commit()
+        dispatcher = OutboxDispatcher(BrokenSink())
+        self.assertEqual(dispatcher.dispatch_batch(), 1)
+        event = OutboxEvent.query.one()
+        self.assertIsNone(event.dispatched_at)
+        self.assertIn("consumer down", event.last_error)
+
+    def test_file_sink_and_purge(self):
+        record_event("user.registered", {"id": 1})
+        db.session.commit()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            dispatcher = OutboxDispatcher(FileSink(path))
+            dispatcher.dispatch_batch()
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        finally:
+            os.remove(path)
+        self.assertEqual(lines[0]["payload"], {"id": 1})
+
+        self.assertEqual(dispatcher.purge(datetime.utcnow() - timedelta(1)), 0)
+        self.assertEqual(dispatcher.purge(datetime.utcnow() + timedelta(1)), 1)
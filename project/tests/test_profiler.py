@@ -0,0 +1,218 @@
+import json
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from project import bcrypt, db
+from project.profiler import (
+    Profile, Profiler, collapse, get_profiler, module_category,
+)
+from project.tests.base import BaseTestCase
+from project.tests.utils import add_user
+
+
+class TestProfiler(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        get_profiler().directory = self.directory
+
+    def tearDown(self):
+        get_profiler().stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        super().tearDown()
+
+    def spec(self, **spec):
+        return dict({
+            "id": "test", "routes": ["/auth/login"], "sample_rate": 1,
+            "interval": 0.001, "ends_at": time.time() + 10,
+        }, **spec)
+
+    def add_admin(self):
+        admin = add_user("admin", "admin@test.com", "test")
+        admin.admin = True
+        db.session.commit()
+        return admin.encode_auth_token(admin.id).decode()
+
+    def profile_request(self, method, token, body=None, path="/admin/profile"):
+        return self.client.open(
+            path,
+            method=method,
+            data=json.dumps(body) if body is not None else None,
+            content_type="application/json",
+            headers=dict(Authorization="Bearer " + token),
+        )
+
+    def test_module_categories(self):
+        self.assertEqual(module_category("bcrypt"), "bcrypt")
+        self.assertEqual(module_category("jwt.api_jws"), "jwt")
+        self.assertEqual(module_category("sqlalchemy.engine.base"), "sql")
+        self.assertEqual(module_category("flask.json"), "serialization")
+        self.assertIsNone(module_category("flask.app"))
+        self.assertIsNone(module_category("jsonschema"))
+
+        stack, category = collapse(sys._getframe())
+        self.assertEqual(category, "app")
+        self.assertTrue(stack.endswith(f";{__name__}:test_module_categories"))
+
+    def test_outermost_category_wins(self):
+        # json called from jwt is jwt's work
+        stacks = []
+        json_module = {"__name__": "json.encoder", "collapse": collapse,
+                       "sys": sys, "stacks": stacks}
+        exec("def encode():\n    stacks.append(collapse(sys._getframe()))",
+             json_module)
+        jwt_module = {"__name__": "jwt.api_jws",
+                      "encode": json_module["encode"]}
+        exec("def sign():\n    encode()", jwt_module)
+        jwt_module["sign"]()
+        stack, category = stacks[0]
+        self.assertEqual(category, "jwt")
+        self.assertTrue(stack.endswith(
+            "jwt.api_jws:sign;json.encoder:encode"
+        ))
+
+    def test_samples_what_a_request_thread_does(self):
+        profile = Profile(self.spec())
+        profiler = Profiler(self.directory, save_interval=0.05)
+        sampler = threading.Thread(target=profiler._run, args=(profile,))
+        sampler.start()
+
+        def login():
+            profile.enter("POST /auth/login")
+            deadline = time.time() + 0.3
+            while time.time() < deadline:
+                bcrypt.generate_password_hash("test", 4)
+            profile.leave()
+        worker = threading.Thread(target=login)
+        worker.start()
+        worker.join()
+        profile.running = False
+        sampler.join()
+
+        self.assertEqual(profile.requests, 1)
+        self.assertGreater(profile.categories["bcrypt"], 0)
+        stacks = profiler._merge("test")["stacks"]
+        self.assertEqual(stacks, profile.stacks)
+        self.assertTrue(stacks)
+        for stack, count in stacks.items():
+            self.assertTrue(stack.startswith("POST /auth/login;"))
+            self.assertGreater(count, 0)
+        self.assertTrue(any(
+            stack.startswith("POST /auth/login;bcrypt;") and
+            "flask_bcrypt:generate_password_hash" in stack
+            for stack in stacks
+        ))
+
+    def test_workers_share_a_profile(self):
+        first = Profiler(self.directory, poll_interval=0, save_interval=0.01)
+        first.worker = "first"
+        second = Profiler(self.directory, poll_interval=0, save_interval=0.01)
+        second.worker = "second"
+
+        started = first.start(["/ping"], 1, 30, 0.001)
+        self.assertIsNone(second.start(["/ping"], 1, 30, 0.001))
+        second.poll()
+        self.assertEqual(second.running.id, started["id"])
+        for profiler in (first, second):
+            profiler.running.enter("GET /ping")
+        time.sleep(0.05)
+
+        # stopped through the first, the second notices on its next save
+        stopped = first.stop()
+        self.assertFalse(stopped["running"])
+        deadline = time.time() + 2
+        while second.running is not None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(second.running)
+
+        summary = second.summary()
+        self.assertEqual(summary["id"], started["id"])
+        self.assertEqual(summary["requests"], 2)
+        self.assertGreater(summary["samples"], 0)
+        lines = second.collapsed().splitlines()
+        self.assertTrue(lines)
+        self.assertEqual(
+            sum(int(line.rsplit(" ", 1)[1]) for line in lines),
+            summary["samples"],
+        )
+
+    def test_profile_endpoints(self):
+        token = self.add_admin()
+        profiler = get_profiler()
+        self.assertIsNone(profiler.running)
+        with self.client:
+            response = self.profile_request("GET", token)
+            self.assertEqual(response.status_code, 404)
+
+            response = self.profile_request("POST", token, {
+                "routes": ["/ping"], "sample_rate": 1, "duration": 30,
+            })
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(data["data"]["routes"], ["/ping"])
+            self.assertTrue(data["data"]["running"])
+
+            response = self.profile_request("POST", token, {
+                "routes": ["/ping"],
+            })
+            self.assertEqual(response.status_code, 409)
+
+            self.client.get("/ping")
+            self.client.get("/users")
+            response = self.profile_request("DELETE", token)
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data["data"]["requests"], 1)
+            self.assertIsNone(profiler.running)
+
+            response = self.profile_request("GET", token)
+            data = json.loads(response.data.decode())
+            self.assertFalse(data["data"]["running"])
+
+            response = self.profile_request(
+                "GET", token, path="/admin/profile/collapsed"
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, "text/plain")
+            self.assertIn("attachment", response.headers["Content-Disposition"])
+
+    def test_profile_window_ends(self):
+        profiler = get_profiler()
+        profiler.start(["/ping"], 1, 0.05, 0.01)
+        time.sleep(0.2)
+        self.assertFalse(profiler.summary()["running"])
+        self.assertIsNone(profiler.running)
+
+    def test_invalid_profile_requests(self):
+        token = self.add_admin()
+        max_duration = self.app.config["PROFILER_MAX_DURATION"]
+        with self.client:
+            for body, message in [
+                ({"routes": "/ping"}, "Invalid payload."),
+                ({"routes": ["/nope"]}, "Unknown route /nope."),
+                ({"routes": ["/ping"], "sample_rate": 0}, "sample rate"),
+                ({"routes": ["/ping"], "duration": max_duration + 1},
+                 "duration"),
+            ]:
+                response = self.profile_request("POST", token, body)
+                data = json.loads(response.data.decode())
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(message, data["message"])
+        self.assertIsNone(get_profiler().summary())
+
+    def test_profile_admin_only(self):
+        user = add_user("test", "test@test.com", "test")
+        token = user.encode_auth_token(user.id).decode()
+        with self.client:
+            response = self.client.get("/admin/profile/collapsed")
+            self.assertEqual(response.status_code, 401)
+            response = self.profile_request("POST", token, {
+                "routes": ["/ping"],
+            })
+            self.assertEqual(response.status_code, 403)
+        self.assertIsNone(get_profiler().running)
+
@@ -0,0 +1,185 @@
+import json
+from unittest import mock
+
+from flask import current_app, g
+from sqlalchemy import exc
+
+from project.api.records import user_loads
+from project.api.resilience import (
+    CircuitBreaker, RouteTimeoutQueuePool, get_circuit_breaker,
+)
+from project.api.singleflight import SingleFlightTimeout
+from project.tests.base import BaseTestCase
+
+
+class QueryCanceled(Exception):
+    pgcode = "57014"
+
+
+def statement_timeout(*args, **kwargs):
+    raise exc.OperationalError(
+        "SELECT 1", {},
+        QueryCanceled("canceling statement due to statement timeout"),
+    )
+
+
+def connection_lost(*args, **kwargs):
+    raise exc.OperationalError(
+        "SELECT 1", {}, Exception("server closed the connection"),
+        connection_invalidated=True,
+    )
+
+
+def connection_refused(*args, **kwargs):
+    # how the pool reports a db it can not connect to
+    raise exc.OperationalError(
+        None, None,
+        Exception("could not connect to server: Connection refused"),
+    )
+
+
+class Psycopg2Error(Exception):
+    pgcode = None
+
+
+Psycopg2Error.__module__ = "psycopg2"
+
+
+def server_gone(*args, **kwargs):
+    raise exc.OperationalError(
+        "SELECT 1", {},
+        Psycopg2Error("server closed the connection unexpectedly"),
+    )
+
+
+def bad_statement(*args, **kwargs):
+    raise exc.OperationalError(
+        "SELECT 1", {}, Exception('column "nope" does not exist'),
+    )
+
+
+class TestResilience(BaseTestCase):
+
+    def tearDown(self):
+        current_app.extensions.pop("db_circuit_breaker", None)
+        super().tearDown()
+
+    def test_db_timeout_returns_503(self):
+        with mock.patch("project.api.users.load_user", statement_timeout):
+            with self.client:
+                response = self.client.get("/users/1")
+                data = json.loads(response.data.decode())
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.headers["Retry-After"], "5")
+                self.assertIn("fail", data["status"])
+                self.assertIn("Service unavailable.", data["message"])
+
+    def test_login_db_timeout_returns_503(self):
+        with mock.patch(
+                "project.api.auth.load_credentials", statement_timeout):
+            with self.client:
+                response = self.client.post(
+                    "/auth/login",
+                    data=json.dumps({
+                        "email": "test@test.com",
+                        "password": "test",
+                    }),
+                    content_type="application/json"
+                )
+                self.assertEqual(response.status_code, 503)
+
+    def test_lost_connection_returns_503(self):
+        with mock.patch("project.api.users.load_user", connection_lost):
+            with self.client:
+                response = self.client.get("/users/1")
+                self.assertEqual(response.status_code, 503)
+
+    def test_db_down_opens_the_circuit_breaker(self):
+        current_app.config.update({
+            "DB_CIRCUIT_BREAKER": True,
+            "DB_CIRCUIT_BREAKER_THRESHOLD": 2,
+            "DB_CIRCUIT_BREAKER_RESET_SECONDS": 60,
+        })
+        breaker = get_circuit_breaker()
+        for error in (connection_refused, server_gone):
+            with mock.patch("project.api.users.load_user", error):
+                with self.client:
+                    response = self.client.get("/users/1")
+                    self.assertEqual(response.status_code, 503)
+        self.assertTrue(breaker.is_open)
+
+    def test_other_db_errors_are_not_503(self):
+        current_app.config.update({
+            "DB_CIRCUIT_BREAKER": True,
+            "DB_CIRCUIT_BREAKER_THRESHOLD": 1,
+            "DB_CIRCUIT_BREAKER_RESET_SECONDS": 60,
+        })
+        breaker = get_circuit_breaker()
+        # answered like any uncaught error, instead of raised in the test
+        self.app.config["PROPAGATE_EXCEPTIONS"] = False
+        try:
+            with mock.patch("project.api.users.load_user", bad_statement):
+                with self.client:
+                    response = self.client.get("/users/1")
+        finally:
+            self.app.config["PROPAGATE_EXCEPTIONS"] = None
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(breaker.failures, 0)
+        self.assertFalse(breaker.is_open)
+
+    def test_single_flight_timeout_returns_503(self):
+        with mock.patch.object(
+                user_loads, "do", side_effect=SingleFlightTimeout(1)):
+            with self.client:
+                response = self.client.get("/users/1")
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.headers["Retry-After"], "5")
+                response = self.client.post(
+                    "/auth/login",
+                    data=json.dumps({
+                        "email": "test@test.com",
+                        "password": "test",
+                    }),
+                    content_type="application/json"
+                )
+                self.assertEqual(response.status_code, 503)
+
+    def test_circuit_breaker_sheds_traffic(self):
+        current_app.config.update({
+            "DB_CIRCUIT_BREAKER": True,
+            "DB_CIRCUIT_BREAKER_THRESHOLD": 2,
+            "DB_CIRCUIT_BREAKER_RESET_SECONDS": 60,
+        })
+        breaker = get_circuit_breaker()
+        with mock.patch("project.api.users.load_user", statement_timeout):
+            for _ in range(2):
+                self.client.get("/users/1")
+        self.assertTrue(breaker.is_open)
+
+        with mock.patch("project.api.users.load_user") as load_user:
+            response = self.client.get("/users/1")
+            self.assertEqual(response.status_code, 503)
+            self.assertFalse(load_user.called)
+            # db independent routes keep answering
+            self.assertEqual(self.client.get("/ping").status_code, 200)
+
+    def test_circuit_breaker_probe(self):
+        probe = mock.Mock(side_effect=[Exception("down"), None])
+        breaker = CircuitBreaker(1, 60, probe)
+        with mock.patch("threading.Thread"):
+            breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.try_close())
+        self.assertTrue(breaker.is_open)
+        self.assertTrue(breaker.try_close())
+        self.assertFalse(breaker.is_open)
+        self.assertEqual(breaker.failures, 0)
+
+    def test_checkout_timeout_per_route_class(self):
+        pool = RouteTimeoutQueuePool(mock.Mock(), timeout=30)
+        self.assertEqual(pool._timeout, 30)
+        with self.app.test_request_context("/users/1"):
+            g.db_route_class = "read"
+            self.assertEqual(pool._timeout, 1)
+            g.db_route_class = "write"
+            self.assertEqual(pool._timeout, 3)
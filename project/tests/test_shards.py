@@ -0,0 +1,219 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from unittest import mock
+
+from project import db
+from project.api.cache import user_cache
+from project.api.models import OutboxEvent, User, UserDirectory, UserTotals
+from project.api.records import add_sharded_user, load_users
+from project.api.resilience import RouteTimeoutQueuePool, _route_setting
+from project.api.shards import ShardSet, get_shards, jump_hash, name_hash
+from project.api.stats import rebuild_stats
+from project.tests.base import BaseTestCase
+
+
+class TestShards(BaseTestCase):
+    """Users on two, then three sqlite files"""
+
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.uris = [
+            "sqlite:///" + os.path.join(self.dir, f"shard{i}.db")
+            for i in range(3)
+        ]
+        self.app.config["USER_SHARDS"] = self.uris[:2]
+        get_shards().create_schema()
+
+    def tearDown(self):
+        self.app.config["USER_SHARDS"] = []
+        self.app.extensions.pop("user_shards").close()
+        user_cache.clear()
+        shutil.rmtree(self.dir)
+        super().tearDown()
+
+    def register(self, username, email=None):
+        return self.client.post(
+            "/auth/register",
+            data=json.dumps({
+                "username": username,
+                "email": email or f"{username}@test.com",
+                "password": "test",
+            }),
+            content_type="application/json",
+        )
+
+    def add_users(self, count):
+        users = [
+            add_sharded_user(f"user{i}", f"user{i}@test.com", "test")
+            for i in range(count)
+        ]
+        db.session.commit()
+        return users
+
+    def shard_ids(self, shard):
+        users = User.__table__
+        with get_shards().engines[shard].connect() as connection:
+            return {
+                user_id for user_id, in connection.execute(
+                    users.select().with_only_columns([users.c.id])
+                )
+            }
+
+    def test_jump_hash(self):
+        keys = [name_hash(f"user{i}@test.com") for i in range(1000)]
+        before = [jump_hash(key, 2) for key in keys]
+        after = [jump_hash(key, 3) for key in keys]
+        self.assertEqual(set(before), {0, 1})
+        # going from 2 to 3 shards only ever moves keys to the new one
+        for old, new in zip(before, after):
+            self.assertIn(new, (old, 2))
+        self.assertTrue(250 < after.count(2) < 420)
+
+    def test_register_places_the_user_on_its_shard(self):
+        with self.client:
+            response = self.register("test")
+        self.assertEqual(response.status_code, 201)
+        entry = UserDirectory.query.one()
+        shard = get_shards().placement("test@test.com")
+        self.assertEqual(entry.shard, shard)
+        self.assertEqual(self.shard_ids(shard), {entry.id})
+        self.assertEqual(self.shard_ids(1 - shard), set())
+        self.assertEqual(User.query.count(), 0)
+        self.assertEqual(UserTotals.query.one().total, 1)
+        self.assertEqual(OutboxEvent.query.count(), 1)
+
+    def test_lookups_go_to_the_right_shard(self):
+        with self.client:
+            for i in range(6):
+                self.register(f"user{i}")
+            for i in range(6):
+                response = self.client.post(
+                    "/auth/login",
+                    data=json.dumps({
+                        "email": f"user{i}@test.com",
+                        "password": "test",
+                    }),
+                    content_type="application/json",
+                )
+                self.assertEqual(response.status_code, 200)
+                token = json.loads(response.data.decode())["auth_token"]
+                response = self.client.get(
+                    "/auth/status",
+                    headers=dict(Authorization="Bearer " + token),
+                )
+                data = json.loads(response.data.decode())["data"]
+                self.assertEqual(data["username"], f"user{i}")
+                response = self.client.get(f"/users/{data['id']}")
+                data = json.loads(response.data.decode())["data"]
+                self.assertEqual(data["email"], f"user{i}@test.com")
+        self.assertTrue(self.shard_ids(0) and self.shard_ids(1))
+
+    def test_names_are_unique_across_shards(self):
+        with self.client:
+            self.register("test", "one@test.com")
+            for username, email in [
+                ("test", "two@test.com"),
+                ("other", "one@test.com"),
+            ]:
+                response = self.register(username, email)
+                data = json.loads(response.data.decode())
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(
+                    data["message"], "Sorry. That user already exists."
+                )
+        self.assertEqual(UserDirectory.query.count(), 1)
+
+    def test_all_users_pages_merge_shards(self):
+        users = self.add_users(7)
+        newest_first = [user.username for user in reversed(users)]
+        with self.client:
+            response = self.client.get("/users")
+            data = json.loads(response.data.decode())
+            self.assertEqual(
+                [user["username"] for user in data["data"]["users"]],
+                newest_first,
+            )
+            paged = []
+            for page in (1, 2, 3):
+                response = self.client.get(f"/users?page={page}&per_page=3")
+                data = json.loads(response.data.decode())
+                paged += [user["username"] for user in data["data"]["users"]]
+        self.assertEqual(paged, newest_first)
+        self.assertEqual(set(load_users([u.id for u in users])), {
+            user.id for user in users
+        })
+
+    def test_rebalance_after_adding_a_shard(self):
+        users = self.add_users(30)
+        self.app.config["USER_SHARDS"] = self.uris
+        shards = get_shards()
+        moved, deleted = shards.rebalance(batch_size=7)
+        placed = {
+            user.id: jump_hash(name_hash(user.email), 3) for user in users
+        }
+        self.assertEqual(moved, list(placed.values()).count(2))
+        self.assertEqual(deleted, 0)
+        for shard in range(3):
+            self.assertEqual(self.shard_ids(shard), {
+                user_id for user_id, placement in placed.items()
+                if placement == shard
+            })
+        for user in users:
+            self.assertEqual(shards.user_row(user.id)[1], user.username)
+            self.assertEqual(shards.credentials_row(user.email)[0], user.id)
+        self.assertEqual(shards.rebalance(), (0, 0))
+
+    def test_rebalance_deletes_strays(self):
+        user, = self.add_users(1)
+        shards = get_shards()
+        shard = shards.shard_of(user.id)
+        # left behind by a registration that failed after the shard write
+        with shards.engines[shard].begin() as connection:
+            connection.execute(User.__table__.insert().values(
+                id=user.id + 1, username="stray", email="stray@test.com",
+                password="x", active=True, admin=False,
+                created_at=datetime.utcnow() - timedelta(hours=1),
+            ))
+        self.assertEqual(shards.rebalance(), (0, 1))
+        self.assertEqual(self.shard_ids(shard), {user.id})
+
+    def test_rebuild_stats_counts_every_shard(self):
+        self.add_users(5)
+        UserTotals.query.delete()
+        db.session.commit()
+        rebuild_stats()
+        self.assertEqual(UserTotals.query.one().total, 5)
+
+    def test_shard_queries_use_the_route_timeouts(self):
+        self.add_users(4)
+        timeouts = []
+
+        def apply_statement_timeout(connection):
+            timeouts.append((
+                threading.current_thread() is threading.main_thread(),
+                _route_setting("DB_STATEMENT_TIMEOUTS"),
+            ))
+        with mock.patch(
+                "project.api.shards.apply_statement_timeout",
+                apply_statement_timeout):
+            with self.client:
+                response = self.client.get("/users")
+                self.assertEqual(response.status_code, 200)
+        read_timeout = self.app.config["DB_STATEMENT_TIMEOUTS"]["read"]
+        # one query per shard, on the executor's threads
+        self.assertEqual(timeouts, [(False, read_timeout)] * 2)
+
+        with mock.patch("project.api.shards.create_engine") as create_engine:
+            ShardSet(["postgresql://localhost/shard0", self.uris[0]])
+        self.assertEqual(create_engine.call_args_list, [
+            mock.call(
+                "postgresql://localhost/shard0",
+                poolclass=RouteTimeoutQueuePool,
+            ),
+            mock.call(self.uris[0]),
+        ])
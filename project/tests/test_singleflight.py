@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import unittest
+
+from project.api.singleflight import SingleFlight, SingleFlightTimeout
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def run_threads(self, group, key, load, count=5, timeout=None):
+        results = [None] * count
+
+        def call(i):
+            try:
+                results[i] = group.do(key, load, timeout)
+            except Exception as e:
+                results[i] = e
+
+        threads = [
+            threading.Thread(target=call, args=(i,)) for i in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def wait_for_followers(self, group, count):
+        while group.coalesced < count:
+            threading.Event().wait(0.001)
+
+    def test_concurrent_loads_are_coalesced(self):
+        group = SingleFlight()
+        release = threading.Event()
+        loads = []
+
+        def load():
+            loads.append(1)
+            release.wait()
+            return "user"
+
+        threads, results = self.run_threads(group, 1, load)
+        self.wait_for_followers(group, 4)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(results, ["user"] * 5)
+        self.assertEqual(group.stats(), {"calls": 5, "coalesced": 4})
+
+        # nothing is cached once the load is done
+        self.assertEqual(group.do(1, lambda: "again"), "again")
+
+    def test_errors_are_shared(self):
+        group = SingleFlight()
+        release = threading.Event()
+
+        def load():
+            release.wait()
+            raise ValueError("db down")
+
+        threads, results = self.run_threads(group, 1, load, count=3)
+        self.wait_for_followers(group, 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+
+    def test_timeout(self):
+        group = SingleFlight()
+        release = threading.Event()
+        threads, results = self.run_threads(
+            group, 1, lambda: release.wait(), count=1
+        )
+        while not group._calls:
+            threading.Event().wait(0.001)
+        with self.assertRaises(SingleFlightTimeout):
+            group.do(1, lambda: "follower", timeout=0.01)
+        release.set()
+        threads[0].join()
+        self.assertEqual(results, [True])
+
+    def test_async_loads_are_coalesced(self):
+        group = SingleFlight()
+        loads = []
+
+        async def load():
+            loads.append(1)
+            await asyncio.sleep(0.01)
+            return "user"
+
+        async def main():
+            return await asyncio.gather(
+                *[group.do_async("a", load) for _ in range(5)]
+            )
+
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(main())
+        finally:
+            loop.close()
+        self.assertEqual(results, ["user"] * 5)
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(group.coalesced, 4)
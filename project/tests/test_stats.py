@@ -0,0 +1,152 @@
+import json
+from datetime import datetime, timedelta
+
+from project import db
+from project.api.models import SignupDay, User, UserTotals
+from project.api.stats import get_stats, rebuild_stats
+from project.tests.base import BaseTestCase
+from project.tests.utils import add_user
+
+DAY = datetime(2026, 10, 1, 12)
+
+
+class TestUserStats(BaseTestCase):
+
+    def add_admin(self):
+        admin = add_user("admin", "admin@test.com", "test", DAY)
+        admin.admin = True
+        db.session.commit()
+        return admin.encode_auth_token(admin.id).decode()
+
+    def get_stats(self, token, query=""):
+        return self.client.get(
+            "/users/stats" + query,
+            headers=dict(Authorization="Bearer " + token),
+        )
+
+    def rollup(self):
+        start = DAY.date() - timedelta(days=1)
+        return get_stats(start, start + timedelta(days=3))
+
+    def test_counts_follow_user_changes(self):
+        add_user("one", "one@test.com", "test", DAY)
+        two = add_user("two", "two@test.com", "test", DAY)
+        add_user("three", "three@test.com", "test", DAY + timedelta(days=1))
+
+        stats = self.rollup()
+        self.assertEqual(
+            (stats["total"], stats["active"], stats["admin"]), (3, 3, 0)
+        )
+        self.assertEqual(
+            [day["count"] for day in stats["signups"]], [0, 2, 1, 0]
+        )
+
+        two.active = False
+        db.session.commit()
+        self.assertEqual(self.rollup()["active"], 2)
+
+        # setting it to what it already is changes nothing
+        two.active = False
+        db.session.commit()
+        self.assertEqual(self.rollup()["active"], 2)
+
+        db.session.delete(two)
+        db.session.commit()
+        stats = self.rollup()
+        self.assertEqual((stats["total"], stats["active"]), (2, 2))
+        self.assertEqual(
+            [day["count"] for day in stats["signups"]], [0, 1, 1, 0]
+        )
+
+    def test_rebuild_matches_incremental(self):
+        add_user("one", "one@test.com", "test", DAY)
+        two = add_user("two", "two@test.com", "test", DAY)
+        two.admin = True
+        db.session.commit()
+        incremental = self.rollup()
+
+        db.session.query(UserTotals).delete()
+        db.session.query(SignupDay).delete()
+        db.session.commit()
+        self.assertEqual(self.rollup()["total"], 0)
+
+        rebuild_stats()
+        self.assertEqual(self.rollup(), incremental)
+
+    def test_stats_endpoint(self):
+        token = self.add_admin()
+        with self.client:
+            self.client.post(
+                "/auth/register",
+                data=json.dumps({
+                    "username": "test",
+                    "email": "test@test.com",
+                    "password": "test",
+                }),
+                content_type="application/json",
+            )
+            response = self.get_stats(
+                token, "?from=2026-09-30&to=2026-10-01"
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data["status"], "success")
+            self.assertEqual(data["data"]["total"], 2)
+            self.assertEqual(data["data"]["admin"], 1)
+            self.assertEqual(data["data"]["signups"], [
+                {"day": "2026-09-30", "count": 0},
+                {"day": "2026-10-01", "count": 1},
+            ])
+
+            # defaults to the last 30 days, ending today
+            response = self.get_stats(token)
+            signups = json.loads(response.data.decode())["data"]["signups"]
+            self.assertEqual(len(signups), 30)
+            self.assertEqual(
+                signups[-1]["day"], datetime.utcnow().date().isoformat()
+            )
+
+    def test_register_counts_today(self):
+        before = datetime.utcnow()
+        with self.client:
+            response = self.client.post(
+                "/auth/register",
+                data=json.dumps({
+                    "username": "test",
+                    "email": "test@test.com",
+                    "password": "test",
+                }),
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 201)
+        user = User.query.filter_by(email="test@test.com").one()
+        self.assertGreaterEqual(user.created_at, before)
+        today = user.created_at.date()
+        self.assertEqual(
+            get_stats(today, today)["signups"],
+            [{"day": today.isoformat(), "count": 1}],
+        )
+
+    def test_stats_invalid_range(self):
+        token = self.add_admin()
+        with self.client:
+            for query in ("?from=yesterday", "?from=2026-10-02&to=2026-10-01",
+                          "?from=2020-01-01&to=2026-10-01"):
+                response = self.get_stats(token, query)
+                data = json.loads(response.data.decode())
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(data["status"], "fail")
+
+    def test_stats_admin_only(self):
+        user = add_user("test", "test@test.com", "test")
+        token = user.encode_auth_token(user.id).decode()
+        with self.client:
+            response = self.client.get("/users/stats")
+            self.assertEqual(response.status_code, 401)
+
+            response = self.get_stats(token)
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(
+                data["message"], "You do not have permission to do that."
+            )
@@ -4,6 +4,11 @@ from sqlalchemy.exc import IntegrityError
 
 from project import db
 from project.api.models import User
+from project.api.cache import user_cache
+from project.api.records import (
+    UserRecord, find_user_id, load_credentials, load_user, load_users,
+    query_cache,
+)
 from project.tests.base import BaseTestCase
 from project.tests.utils import add_user
 
@@ -47,4 +52,42 @@ class TestUserModel(BaseTestCase):
         user = add_user("justatest", "test@test.com", "test")
         auth_token = user.encode_auth_token(user.id)
         self.assertTrue(isinstance(auth_token, bytes))
-        self.assertEqual(User.decode_auth_token(auth_token), user.id)
\ No newline at end of file
+        self.assertEqual(User.decode_auth_token(auth_token), user.id)
+
+    def test_user_record(self):
+        user = add_user("justatest", "test@test.com", "test")
+        record = load_user(user.id)
+        self.assertIsInstance(record, UserRecord)
+        self.assertEqual(record.id, user.id)
+        self.assertEqual(record.username, "justatest")
+        self.assertEqual(record.email, "test@test.com")
+        self.assertIs(record.active, True)
+        self.assertIs(record.admin, False)
+        self.assertEqual(
+            record.created_at, user.created_at.replace(microsecond=0)
+        )
+        self.assertEqual(
+            record.to_dict("id", "email"),
+            {"id": user.id, "email": "test@test.com"}
+        )
+        with self.assertRaises(AttributeError):
+            record.username = "changed"
+        self.assertIsNone(load_user(user.id + 1))
+        self.assertEqual(list(load_users([user.id, user.id + 1])), [user.id])
+
+    def test_baked_lookups(self):
+        user = add_user("justatest", "test@test.com", "test")
+        self.assertEqual(find_user_id("justatest", "other@test.com"), user.id)
+        self.assertEqual(find_user_id(email="test@test.com"), user.id)
+        self.assertIsNone(find_user_id("other", "other@test.com"))
+        record, password = load_credentials("test@test.com")
+        self.assertEqual(record.id, user.id)
+        self.assertEqual(password, user.password)
+
+        # built and compiled the first time only
+        load_user(user.id)
+        user_cache.clear()
+        hits, misses = query_cache.hits, query_cache.misses
+        self.assertEqual(load_user(user.id).id, user.id)
+        self.assertGreater(query_cache.hits, hits)
+        self.assertEqual(query_cache.misses, misses)
@@ -169,4 +169,78 @@ class TestDevelopmentConfig(BaseTestCase):
     def test_encode_with_auth_token(self):
         user = add_user("justatest", "test@test.com", "test")
         auth_token = user.encode_auth_token(user.id)
-        self.assertTrue(isinstance(auth_token, bytes))
\ No newline at end of file
+        self.assertTrue(isinstance(auth_token, bytes))
+
+    def test_lookup_users(self):
+        """Ensure users can be looked up by a list of ids"""
+        user_one = add_user("bwallad", "bwallad@example.com", "pass1")
+        user_two = add_user("martin", "martinRules@example.com", "pass2")
+        with self.client:
+            response = self.client.get(
+                f"/users?ids={user_two.id},999,{user_one.id}"
+            )
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("success", data["status"])
+
+            response_users = data["data"]["users"]
+            self.assertEqual(len(response_users), 2)
+            self.assertEqual(response_users[0]["username"], "martin")
+            self.assertEqual(response_users[1]["username"], "bwallad")
+            self.assertIn("created_at", response_users[0])
+            self.assertEqual(data["data"]["missing"], [999])
+
+    def test_lookup_users_invalid_ids(self):
+        """Ensure Error is thrown if an id is not an integer"""
+        with self.client:
+            response = self.client.get("/users?ids=1,blahBlah")
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("Invalid payload.", data["message"])
+            self.assertIn("fail", data["status"])
+
+    def test_lookup_users_too_many_ids(self):
+        """Ensure Error is thrown if more ids than allowed are requested"""
+        max_ids = self.app.config["USERS_LOOKUP_MAX_IDS"]
+        ids = ",".join(str(i) for i in range(max_ids + 1))
+        with self.client:
+            response = self.client.get(f"/users?ids={ids}")
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("Too many ids.", data["message"])
+            self.assertIn("fail", data["status"])
+
+    def test_all_users_pages(self):
+        """Ensure get all users can be paged, newest first"""
+        for day in range(5):
+            add_user(
+                f"user{day}", f"user{day}@example.com", "pass",
+                datetime.datetime.utcnow() - datetime.timedelta(day),
+            )
+        with self.client:
+            pages = []
+            for page in (1, 2, 3):
+                response = self.client.get(f"/users?page={page}&per_page=2")
+                data = json.loads(response.data.decode())
+                self.assertEqual(response.status_code, 200)
+                pages.append(
+                    [user["username"] for user in data["data"]["users"]]
+                )
+            self.assertEqual(
+                pages, [["user0", "user1"], ["user2", "user3"], ["user4"]]
+            )
+
+    def test_all_users_invalid_page(self):
+        """Ensure Error is thrown for a bad page or page size"""
+        max_per_page = self.app.config["USERS_MAX_PER_PAGE"]
+        with self.client:
+            for query, message in [
+                ("page=0", "Invalid page."),
+                ("page=x", "Invalid page."),
+                (f"per_page={max_per_page + 1}", "Page too large."),
+            ]:
+                response = self.client.get(f"/users?{query}")
+                data = json.loads(response.data.decode())
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(message, data["message"])
+                self.assertIn("fail", data["status"])
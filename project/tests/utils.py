@@ -1,10 +1,9 @@
 
-import datetime
 from project import db
 from project.api.models import User
 
 
-def add_user(username, email, password, created_at=datetime.datetime.utcnow()):
+def add_user(username, email, password, created_at=None):
     """helper function to add a user to db"""
     user = User(
         username=username,